@@ -7,24 +7,37 @@ from oic.utils.keyio import KeyJar
 from fedoidc import MetadataStatement
 from fedoidc.signing_service import InternalSigningService
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-r', dest='request')
-parser.add_argument('-a', dest='alg', default='RS256')
-parser.add_argument(dest="nickname")
-args = parser.parse_args()
 
-if not os.path.isdir(args.nickname):
-    print('No such entity')
-    exit(-1)
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', dest='request', action='append')
+    parser.add_argument('-a', dest='alg', default='RS256')
+    parser.add_argument('-p', dest='processes', type=int, default=0)
+    parser.add_argument(dest="nickname")
+    args = parser.parse_args()
 
-kj = KeyJar()
-iss = open(os.path.join(args.nickname, 'iss')).read()
-jwks = open(os.path.join(args.nickname, 'jwks')).read()
-kj.import_jwks(jwks=json.loads(jwks), issuer=iss)
+    if not os.path.isdir(args.nickname):
+        print('No such entity')
+        exit(-1)
 
-sigserv = InternalSigningService(iss=iss, signing_keys=kj, alg=args.alg)
+    kj = KeyJar()
+    iss = open(os.path.join(args.nickname, 'iss')).read()
+    jwks = open(os.path.join(args.nickname, 'jwks')).read()
+    kj.import_jwks(jwks=json.loads(jwks), issuer=iss)
 
-msg = MetadataStatement()
-msg.from_json(open(args.request).read())
+    sigserv = InternalSigningService(iss=iss, signing_keys=kj, alg=args.alg)
 
-print(sigserv(msg))
+    msgs = []
+    for req in args.request:
+        msg = MetadataStatement()
+        msg.from_json(open(req).read())
+        msgs.append(msg)
+
+    for sms in sigserv.sign_many(msgs, processes=args.processes):
+        print(sms)
+
+
+if __name__ == '__main__':
+    # Guarded since sign_many may start worker processes that import this
+    # module.
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Compare is_lesser with a compiled policy when evaluating a subordinate
+metadata statement against a superior one with large list valued claims.
+"""
+import argparse
+import json
+import timeit
+
+from fedoidc import compile_policy
+from fedoidc import is_lesser
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', dest='size', type=int, default=1000,
+                    help='Number of items in the superior lists')
+parser.add_argument('-r', dest='rounds', type=int, default=100)
+args = parser.parse_args()
+
+sup = {
+    'redirect_uris': ['https://rp{}.example.com/cb'.format(i)
+                      for i in range(args.size)],
+    'contacts': ['admin{}@example.com'.format(i) for i in range(args.size)],
+    'scope': ['openid'] + ['scope{}'.format(i) for i in range(args.size)],
+    'response_types': ['code', 'id_token', 'code id_token'],
+}
+# The subordinate uses the last half of each list
+sub = dict([(k, v[len(v) // 2:]) for k, v in sup.items()])
+
+
+def old():
+    for k, v in sub.items():
+        assert is_lesser(v, sup[k])
+
+
+def new():
+    _policy = dict([(k, compile_policy(v)) for k, v in sup.items()])
+    for k, v in sub.items():
+        assert _policy[k](v)
+
+
+_policy = dict([(k, compile_policy(v)) for k, v in sup.items()])
+
+
+def precompiled():
+    for k, v in sub.items():
+        assert _policy[k](v)
+
+
+res = {'size': args.size, 'rounds': args.rounds}
+for name, func in [('is_lesser', old), ('compile_and_check', new),
+                   ('precompiled', precompiled)]:
+    res[name] = timeit.timeit(func, number=args.rounds) / args.rounds
+
+print(json.dumps(res, indent=2))
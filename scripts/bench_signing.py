@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare the throughput of InternalSigningService, which keeps the signing
+key it has picked, with building a JWT instance and picking the key for
+every statement and copying the request with copy.deepcopy.
+"""
+import argparse
+import copy
+import json
+import timeit
+
+from fedoidc import MetadataStatement
+from fedoidc.signing_service import InternalSigningService
+
+from oic.utils.jwt import JWT
+from oic.utils.keyio import build_keyjar
+
+KEYDEFS = {
+    'RSA': [{"type": "RSA", "key": '', "use": ["sig"]}],
+    'EC': [{"type": "EC", "crv": "P-256", "use": ["sig"]}]
+}
+
+ALG = {'RSA': 'RS256', 'EC': 'ES256'}
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-k', dest='key_type', choices=list(KEYDEFS.keys()),
+                    default='RSA')
+parser.add_argument('-n', dest='number', type=int, default=200,
+                    help='Number of statements to sign')
+parser.add_argument('-e', dest='embedded', type=int, default=0,
+                    help='Number of embedded metadata statements and keys')
+args = parser.parse_args()
+
+ISS = 'https://example.org'
+keyjar = build_keyjar(KEYDEFS[args.key_type])[1]
+alg = ALG[args.key_type]
+req = MetadataStatement(
+    redirect_uris=['https://example.org/cb{}'.format(i) for i in range(10)],
+    contacts=['admin@example.org'])
+if args.embedded:
+    req['signing_keys'] = {'keys': [
+        {'kty': 'RSA', 'kid': 'k{}'.format(i), 'e': 'AQAB', 'n': 'x' * 342,
+         'use': 'sig'} for i in range(args.embedded)]}
+    req['metadata_statements'] = dict(
+        [('https://fo{}.example.org'.format(i), 'x' * 2000)
+         for i in range(args.embedded)])
+
+service = InternalSigningService(ISS, keyjar, alg=alg)
+
+
+def per_call_jwt():
+    _metadata = copy.deepcopy(req)
+    _jwt = JWT(keyjar, iss=ISS, msgtype=_metadata.__class__, lifetime=3600)
+    _jwt.sign_alg = alg
+    if ISS in keyjar.issuer_keys:
+        owner = ISS
+    else:
+        owner = ''
+    return _jwt.pack(cls_instance=_metadata, owner=owner)
+
+
+def prepared():
+    return service(req)
+
+
+res = {'key_type': args.key_type, 'number': args.number,
+       'embedded': args.embedded}
+for name, func in [('per_call_jwt', per_call_jwt), ('prepared', prepared)]:
+    func()
+    res[name] = args.number / timeit.timeit(func, number=args.number)
+
+print(json.dumps(res, indent=2))
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Benchmark the federation pipeline on a synthetic federation.
+
+Measures JWKSBundle.create_signed_bundle,
+Signer.create_signed_metadata_statement,
+Operator.unpack_metadata_statement and
+Operator.evaluate_metadata_statement and prints throughput, latency
+percentiles, peak memory and the counters reported through
+fedoidc.instrument, like cache hits and misses, per stage as JSON.
+
+If a baseline, output from an earlier run, is given the exit code is 1 if
+the median latency of any stage has grown more than the tolerance.
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from fedoidc import ClientMetadataStatement
+from fedoidc import instrument
+from fedoidc.cache import EvaluationCache
+from fedoidc.cache import VerifiedStatementCache
+from fedoidc.operator import Operator
+from fedoidc.signing_service import InternalSigningService
+from fedoidc.signing_service import Signer
+from fedoidc.test_utils import make_jwks_bundle
+from fedoidc.test_utils import make_signed_metadata_statements
+
+from oic.utils.keyio import build_keyjar
+
+KEYDEFS = {
+    'RSA': [{"type": "RSA", "key": '', "use": ["sig"]}],
+    'EC': [{"type": "EC", "crv": "P-256", "use": ["sig"]}]
+}
+
+ALG = {'RSA': 'RS256', 'EC': 'ES256'}
+
+CONTEXT = 'registration'
+LEAF = 'https://rp.example.org'
+
+
+def fo_id(n):
+    return 'https://fo{}.example.org'.format(n)
+
+
+def level_id(n):
+    return 'https://level{}.example.org'.format(n)
+
+
+def chain_def(fo, depth, claims, alg):
+    """
+    A description of a chain of signed metadata statements starting with
+    a FO and ending with the leaf entity.
+    """
+    _contacts = ['admin{}@example.org'.format(i) for i in range(claims)]
+    _scope = ['openid'] + ['scope{}'.format(i) for i in range(claims)]
+
+    _signers = [fo] + [level_id(i) for i in range(1, depth)]
+    _requesters = _signers[1:] + [LEAF]
+
+    _chain = []
+    for _signer, _requester in zip(_signers, _requesters):
+        if _signer == fo:
+            _add = {'scope': _scope, 'federation_usage': CONTEXT}
+        else:
+            _add = {}
+        _chain.append({'request': {'contacts': _contacts},
+                       'requester': _requester, 'signer': _signer,
+                       'signer_add': _add, 'uri': False, 'alg': alg})
+    return _chain
+
+
+def make_federation(depth, fanout, key_type, claims, lifetime=3600):
+    """
+    Build a federation with *fanout* FOs, each with a chain of *depth*
+    signed metadata statements down to the same leaf entity.
+
+    :param lifetime: Lifetime of the signed metadata statements
+    :return: Dictionary with the JWKS bundle, the leaf Signer and a request
+    """
+    _keydefs = KEYDEFS[key_type]
+    _alg = ALG[key_type]
+
+    _fos = [fo_id(n) for n in range(fanout)]
+    jb = make_jwks_bundle('https://bundle.example.org', _fos,
+                          build_keyjar(_keydefs)[1], _keydefs)
+
+    operator = {}
+    for fo in _fos:
+        operator[fo] = Operator(iss=fo, keyjar=jb[fo], lifetime=lifetime)
+    for iss in [level_id(i) for i in range(1, depth)] + [LEAF]:
+        operator[iss] = Operator(iss=iss, keyjar=build_keyjar(_keydefs)[1],
+                                 lifetime=lifetime)
+
+    _smsdef = [chain_def(fo, depth, claims, _alg) for fo in _fos]
+    _sms = {}
+    for res in make_signed_metadata_statements(_smsdef, operator):
+        _sms.update(res['ms'])
+
+    signer = Signer(InternalSigningService(LEAF, operator[LEAF].keyjar,
+                                           alg=_alg, lifetime=lifetime))
+    signer.metadata_statements = {CONTEXT: _sms}
+
+    def request():
+        return ClientMetadataStatement(
+            redirect_uris=['https://rp.example.org/cb{}'.format(i)
+                           for i in range(claims)],
+            contacts=['admin{}@example.org'.format(i)
+                      for i in range(claims // 2)],
+            signing_keys=operator[LEAF].signing_keys_as_jwks())
+
+    return {'jb': jb, 'signer': signer, 'request': request, 'alg': _alg}
+
+
+def percentile(values, pct):
+    _idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[_idx]
+
+
+def measure(func, rounds, mem_rounds):
+    """
+    Run a function a number of times and collect statistics.
+
+    :param func: The function to run, takes no arguments
+    :param rounds: How many times it should be timed
+    :param mem_rounds: How many times it should be run while tracing
+        memory allocations.
+    :return: Dictionary with the statistics
+    """
+    func()  # warm up
+
+    _lat = []
+    _start = time.perf_counter()
+    for _ in range(rounds):
+        _t = time.perf_counter()
+        func()
+        _lat.append(time.perf_counter() - _t)
+    _total = time.perf_counter() - _start
+    _lat.sort()
+
+    tracemalloc.start()
+    for _ in range(mem_rounds):
+        func()
+    _peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'rounds': rounds,
+        'throughput': rounds / _total,
+        'latency_ms': {
+            'min': _lat[0] * 1000,
+            'p50': percentile(_lat, 50) * 1000,
+            'p90': percentile(_lat, 90) * 1000,
+            'p99': percentile(_lat, 99) * 1000,
+            'max': _lat[-1] * 1000},
+        'peak_memory_bytes': _peak
+    }
+
+
+def counters(func, rounds):
+    """
+    Run a function a number of times with a
+    :py:class:`fedoidc.instrument.HistogramInstrument` installed. Not done
+    while timing since the instrument adds to the latency.
+
+    :param func: The function to run, takes no arguments
+    :param rounds: How many times it should be run
+    :return: Dictionary with the counters
+    """
+    _inst = instrument.HistogramInstrument()
+    instrument.set_instrument(_inst)
+    try:
+        for _ in range(rounds):
+            func()
+    finally:
+        instrument.set_instrument()
+    return _inst.snapshot()['counters']
+
+
+def run(args):
+    fed = make_federation(args.depth, args.fanout, args.key_type, args.claims,
+                          args.lifetime)
+    jb = fed['jb']
+    signer = fed['signer']
+    request = fed['request']
+
+    def receiver():
+        if args.cache:
+            return Operator(jwks_bundle=jb,
+                            statement_cache=VerifiedStatementCache(),
+                            evaluation_cache=EvaluationCache())
+        return Operator(jwks_bundle=jb)
+
+    _sms = signer.create_signed_metadata_statement(request(), CONTEXT,
+                                                   single=True)
+    _op = receiver()
+    _pi = _op.unpack_metadata_statement(jwt_ms=_sms)
+    if not _pi.result:
+        raise SystemExit('Could not verify the synthetic statement')
+
+    stages = [
+        ('create_signed_bundle',
+         lambda: jb.create_signed_bundle(sign_alg=fed['alg'])),
+        ('create_signed_metadata_statement',
+         lambda: signer.create_signed_metadata_statement(request(), CONTEXT,
+                                                         single=True)),
+    ]
+    if args.cache:
+        # One receiver that is reused, as in a long running service
+        stages.extend([
+            ('unpack_metadata_statement',
+             lambda: _op.unpack_metadata_statement(jwt_ms=_sms)),
+            ('evaluate_metadata_statement',
+             lambda: _op.evaluate_metadata_statement(_pi.result))])
+    else:
+        stages.extend([
+            ('unpack_metadata_statement',
+             lambda: receiver().unpack_metadata_statement(jwt_ms=_sms)),
+            ('evaluate_metadata_statement',
+             lambda: receiver().evaluate_metadata_statement(_pi.result))])
+
+    res = {
+        'config': {
+            'depth': args.depth, 'fanout': args.fanout,
+            'key_type': args.key_type, 'claims': args.claims,
+            'cache': args.cache, 'lifetime': args.lifetime,
+            'statement_size': len(_sms)},
+        'stages': {}
+    }
+    for name, func in stages:
+        if args.stage and name not in args.stage:
+            continue
+        res['stages'][name] = measure(func, args.rounds, args.mem_rounds)
+        res['stages'][name]['counters'] = counters(func, args.mem_rounds)
+
+    return res
+
+
+def regressions(res, baseline, tolerance):
+    """
+    Compare the median latencies with those in a baseline.
+
+    :return: List of descriptions of the stages that have regressed
+    """
+    _err = []
+    for name, stats in res['stages'].items():
+        try:
+            _base = baseline['stages'][name]['latency_ms']['p50']
+        except KeyError:
+            continue
+        _now = stats['latency_ms']['p50']
+        if _now > _base * (1 + tolerance):
+            _err.append('{}: p50 {:.3f} ms, baseline {:.3f} ms'.format(
+                name, _now, _base))
+    return _err
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', dest='depth', type=int, default=3,
+                        help='Number of signed levels under each FO')
+    parser.add_argument('-f', dest='fanout', type=int, default=2,
+                        help='Number of FOs')
+    parser.add_argument('-k', dest='key_type', choices=list(KEYDEFS.keys()),
+                        default='RSA')
+    parser.add_argument('-c', dest='claims', type=int, default=10,
+                        help='Number of items in list valued claims')
+    parser.add_argument('-r', dest='rounds', type=int, default=50)
+    parser.add_argument('-m', dest='mem_rounds', type=int, default=5)
+    parser.add_argument('-s', dest='stage', action='append',
+                        help='Only run this stage, can be repeated')
+    parser.add_argument('-l', dest='lifetime', type=int, default=3600,
+                        help='Lifetime of the signed metadata statements')
+    parser.add_argument('--cache', action='store_true',
+                        help='Use statement and evaluation caches')
+    parser.add_argument('-o', dest='output', help='Write the result here')
+    parser.add_argument('-b', dest='baseline',
+                        help='Result from an earlier run to compare with')
+    parser.add_argument('-t', dest='tolerance', type=float, default=0.2,
+                        help='Allowed relative slow down')
+    args = parser.parse_args()
+
+    if args.depth < 1 or args.fanout < 1:
+        parser.error('depth and fanout must be at least 1')
+
+    res = run(args)
+    _out = json.dumps(res, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(_out)
+    else:
+        print(_out)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            _err = regressions(res, json.load(fp), args.tolerance)
+        for line in _err:
+            print(line, file=sys.stderr)
+        if _err:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,21 @@
+import copy
 import json
 import logging
+import re
 
+from fedoidc import instrument
+from fedoidc.cache import JWKSCache
+from jwkest import BadSignature
+from jwkest import Invalid
+from jwkest import as_bytes
 from jwkest import as_unicode
+from jwkest import b64d
+from jwkest.jws import FormatError
+from jwkest.jws import NoSuitableSigningKeys
+from jwkest.jws import SIGNER_ALGS
+from jwkest.jws import SignerAlgError
+from jwkest.jws import UnknownSignerAlg
+from jwkest.jws import alg2keytype
 from jwkest.jws import factory
 from oic.utils import keyio
 from six import PY2
@@ -33,6 +47,62 @@ class MetadataStatementError(Exception):
     pass
 
 
+#: Members a JWK must have, per key type
+JWK_MEMBERS = {'RSA': ['n', 'e'], 'EC': ['crv', 'x', 'y'], 'OCT': ['k']}
+
+B64URL = re.compile('^[A-Za-z0-9_-]+=*$')
+
+B64 = re.compile('^[A-Za-z0-9+/]+=*$')
+
+
+def _is_b64(val, pattern=B64URL):
+    # A single character left over can not be decoded
+    return pattern.match(val) is not None and len(val.rstrip('=')) % 4 != 1
+
+#: Shared by everyone checking or importing signing_keys
+JWKS_CACHE = JWKSCache()
+
+
+def is_jwks(jwks):
+    """
+    Check that something looks like a JWKS, without building any key
+    objects from it.
+
+    :param jwks: Dictionary representation of a JWKS
+    :return: True or False
+    """
+    try:
+        _keys = jwks['keys']
+    except (KeyError, TypeError, IndexError):
+        return False
+    if not isinstance(_keys, list):
+        return False
+
+    for jwk in _keys:
+        try:
+            _members = JWK_MEMBERS[jwk['kty'].upper()]
+        except (KeyError, TypeError, AttributeError):
+            return False
+
+        if jwk['kty'].upper() == 'RSA' and 'n' not in jwk and 'x5c' in jwk:
+            _x5c = jwk['x5c']
+            if not isinstance(_x5c, list) or not _x5c:
+                return False
+            for _cert in _x5c:
+                if not isinstance(_cert, string_types) or not _is_b64(
+                        _cert, B64):
+                    return False
+            continue
+
+        for member in _members:
+            _val = jwk.get(member)
+            if not isinstance(_val, string_types):
+                return False
+            if member != 'crv' and not _is_b64(_val):
+                return False
+    return True
+
+
 class MetadataStatement(JasonWebToken):
     """
     A base class for metadata statements
@@ -60,10 +130,7 @@ class MetadataStatement(JasonWebToken):
                     '"signing_keys_uri" in a metadata statement')
             else:
                 # signing_keys MUST be a JWKS
-                kj = KeyJar()
-                try:
-                    kj.import_jwks(self['signing_keys'], '')
-                except Exception:
+                if not JWKS_CACHE.is_valid(self['signing_keys']):
                     raise VerificationError('"signing_keys" not a proper JWKS')
 
         if "metadata_statements" in self and "metadata_statement_uris" in self:
@@ -97,16 +164,127 @@ class ProviderConfigurationResponse(message.ProviderConfigurationResponse):
     c_param.update(message.ProviderConfigurationResponse.c_param.copy())
 
 
+class CompactJWS(object):
+    """
+    A signed JWT in compact serialization. The JWT is split into its parts
+    once, the header and the payload are decoded the first time they are
+    asked for. The decoded payload is what :py:meth:`verify` returns, so it
+    is only parsed once even if the signature is checked later.
+    """
+
+    def __init__(self, jwt):
+        """
+        :param jwt: A signed JWT
+        """
+        self.jwt = as_unicode(jwt)
+        self.b64part = self.jwt.split('.')
+        if len(self.b64part) != 3:
+            raise FormatError(
+                'Wrong number of parts: {}'.format(len(self.b64part)))
+        self._header = None
+        self._payload = None
+
+    def _b64d(self, part):
+        try:
+            return b64d(as_bytes(self.b64part[part]))
+        except (Invalid, ValueError, TypeError) as err:
+            raise FormatError('Could not decode JWT: {}'.format(err))
+
+    def _decode(self, part):
+        _part = self._b64d(part)
+        try:
+            _val = json.loads(as_unicode(_part))
+        except (ValueError, TypeError) as err:
+            raise FormatError('Could not decode JWT: {}'.format(err))
+        if not isinstance(_val, dict):
+            raise FormatError('JWS {} not a JSON object'.format(
+                ['header', 'payload'][part]))
+        return _val
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = self._decode(0)
+        return self._header
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = self._decode(1)
+        return self._payload
+
+    def pick_keys(self, keys):
+        """
+        Pick the keys that can be used to verify the signature, based on
+        the alg and kid in the header.
+
+        :param keys: List of keys
+        :return: List of keys
+        """
+        _kty = alg2keytype(self.header.get('alg'))
+        _kid = self.header.get('kid')
+        return [k for k in keys if
+                k.kty.upper() == (_kty or '').upper() and
+                k.use in ('', 'sig', None) and
+                (not _kid or not k.kid or k.kid == _kid)]
+
+    def verify(self, keys):
+        """
+        Verify the signature.
+
+        :param keys: List of keys that can be used
+        :return: The payload
+        """
+        _alg = self.header.get('alg')
+        if not _alg or _alg.lower() == 'none':
+            raise SignerAlgError('none not allowed')
+        try:
+            verifier = SIGNER_ALGS[_alg]
+        except KeyError:
+            raise UnknownSignerAlg(_alg)
+
+        _keys = self.pick_keys(keys)
+        if not _keys:
+            raise NoSuitableSigningKeys(
+                'No key for alg={}, kid={}'.format(_alg,
+                                                   self.header.get('kid')))
+
+        _input = as_bytes('.'.join(self.b64part[:2]))
+        _sig = self._b64d(2)
+        for key in _keys:
+            try:
+                _ok = verifier.verify(_input, _sig,
+                                      key.get_key(alg=_alg, private=False))
+            except (BadSignature, IndexError, ValueError):
+                continue
+            if _ok:
+                return self.payload
+        raise BadSignature()
+
+
 def unfurl(jwt):
     """
     Return the body of a signed JWT, without verifying the signature.
     
     :param jwt: A signed JWT 
-    :return: The body of the JWT as a 'UTF-8' string
+    :return: The body of the JWT as a dictionary
+    """
+    return CompactJWS(jwt).payload
+
+
+def shallow_copy_message(msg):
     """
+    Make a copy of a Message instance to which claims can be added, or in
+    which claims can be replaced, without affecting the original.
+    The claim values are shared with the original, they are not copied, so
+    they must not be modified in place.
 
-    _rp_jwt = factory(jwt)
-    return json.loads(_rp_jwt.jwt.part[1].decode('utf8'))
+    :param msg: A :py:class:`oic.oauth2.message.Message` instance
+    :return: A new instance of the same class
+    """
+    _msg = copy.copy(msg)
+    _msg._dict = msg._dict.copy()
+    return _msg
 
 
 def keyjar_from_metadata_statements(iss, msl):
@@ -182,6 +360,104 @@ def is_lesser(a, b):
     return False
 
 
+def _compile_elements(b):
+    """
+    Compile a list of items into a function that checks that every item in
+    another list is lesser than or equal to at least one of them.
+    Strings and booleans are put in sets, integers and floats are reduced
+    to their max value and lists and dictionaries are compiled into
+    subpolicies.
+
+    :param b: A list of items
+    :return: A function that takes an iterable as argument
+    """
+    _eq = {}
+    _max = {}
+    _sub = {}
+    for e in b:
+        _type = type(e)
+        if isinstance(e, string_types) or isinstance(e, bool):
+            _eq.setdefault(_type, set()).add(e)
+        elif isinstance(e, list) or isinstance(e, dict):
+            _sub.setdefault(_type, []).append(compile_policy(e))
+        elif isinstance(e, int) or isinstance(e, float):
+            try:
+                if _max[_type] < e:
+                    _max[_type] = e
+            except KeyError:
+                _max[_type] = e
+
+    def all_match(items):
+        for element in items:
+            _type = type(element)
+            try:
+                if element in _eq[_type]:
+                    continue
+            except KeyError:
+                pass
+            try:
+                if element <= _max[_type]:
+                    continue
+            except KeyError:
+                pass
+            try:
+                _policies = _sub[_type]
+            except KeyError:
+                return False
+            for _policy in _policies:
+                if _policy(element):
+                    break
+            else:
+                return False
+        return True
+
+    return all_match
+
+
+def compile_policy(b):
+    """
+    Compile a value from a superior metadata statement into a policy.
+    The policy is a function that given a value returns the same thing as
+    is_lesser(value, b) would but lists are compared in linear time.
+
+    :param b: An item
+    :return: A function that takes one item as argument and returns True
+        or False
+    """
+    if PY2:  # type mismatches are handled differently
+        return lambda a: is_lesser(a, b)
+
+    _type = type(b)
+
+    if isinstance(b, string_types) or isinstance(b, bool):
+        def policy(a):
+            return type(a) == _type and a == b
+    elif isinstance(b, list):
+        _all_match = _compile_elements(b)
+
+        def policy(a):
+            return type(a) == _type and _all_match(a)
+    elif isinstance(b, dict):
+        _keys_match = _compile_elements(list(b.keys()))
+        _sub = dict([(k, compile_policy(v)) for k, v in b.items()])
+
+        def policy(a):
+            if type(a) != _type or not _keys_match(a.keys()):
+                return False
+            for key, val in a.items():
+                if not _sub[key](val):
+                    return False
+            return True
+    elif isinstance(b, int) or isinstance(b, float):
+        def policy(a):
+            return type(a) == _type and a <= b
+    else:
+        def policy(a):
+            return False
+
+    return policy
+
+
 #: When flattening a grounded metadata statement these claims should be ignored.
 IgnoreKeys = list(JasonWebToken.c_param.keys())
 
@@ -210,6 +486,10 @@ class KeyBundle(keyio.KeyBundle):
                 self.verify_keys = KeyJar()
                 self.verify_keys.import_jwks(verify_keys, '')
 
+    def do_remote(self):
+        with instrument.timer('key_bundle.do_remote'):
+            return super(KeyBundle, self).do_remote()
+
     def _parse_remote_response(self, response):
         """
         Parse simple JWKS or signed JWKS from the HTTP response.
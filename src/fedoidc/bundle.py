@@ -3,6 +3,7 @@ import json
 import os
 
 from fedoidc.file_system import FileSystem
+from jwkest.jws import alg2keytype
 
 from oic.utils.jwt import JWT
 from oic.utils.keyio import KeyJar
@@ -27,6 +28,18 @@ class JWKSBundle(object):
         self.iss = iss
         self.sign_keys = sign_keys
         self.bundle = {}  # In memory database
+        self._version = 0
+        self._keyjar = None
+        self._keyjar_version = None
+        self._key_index = None
+
+    @property
+    def version(self):
+        """
+        A counter that is incremented every time the set of keys in the
+        bundle changes.
+        """
+        return self._version
 
     def __setitem__(self, key, value):
         """
@@ -57,6 +70,7 @@ class JWKSBundle(object):
             value = _val
 
         self.bundle[key] = value
+        self._version += 1
 
     def __getitem__(self, item):
         """
@@ -80,6 +94,7 @@ class JWKSBundle(object):
         :param key: Issuer ID
         """
         del self.bundle[key]
+        self._version += 1
 
     def create_signed_bundle(self, sign_alg='RS256', iss_list=None):
         """
@@ -111,6 +126,7 @@ class JWKSBundle(object):
             kj = KeyJar()
             kj.import_jwks(jwks, issuer=iss)
             self.bundle[iss] = kj
+        self._version += 1
         return self
 
     def dumps(self, iss_list=None):
@@ -169,19 +185,220 @@ class JWKSBundle(object):
         jwt = verify_signed_bundle(sign_bundle, ver_keys)
         self.loads(jwt['bundle'])
 
-    def as_keyjar(self):
+    def as_keyjar(self, version=None):
         """
         Convert a key bundle into a KeyJar instance.
+        The KeyJar is built once and then handed out until the set of keys
+        in the bundle changes. Since it's shared it MUST NOT be modified,
+        use :py:func:`shallow_copy_keyjar` to get a copy that can be.
         
+        :param version: The bundle version if the caller already has it
         :return: An :py:class:`oic.utils.keyio.KeyJar` instance 
         """
-        kj = KeyJar()
-        for iss, k in self.bundle.items():
+        if version is None:
+            version = self.version
+        if self._keyjar is None or self._keyjar_version != version:
+            kj = KeyJar()
+            for iss, k in self.bundle.items():
+                try:
+                    kj.issuer_keys[iss] = list(k.issuer_keys[iss])
+                except KeyError:
+                    kj.issuer_keys[iss] = list(k.issuer_keys[''])
+            self._keyjar = kj
+            self._keyjar_version = version
+        return self._keyjar
+
+    def key_bundles(self, iss):
+        """
+        The key bundles of one issuer. Only that issuer's keys are loaded.
+
+        :param iss: Issuer ID
+        :return: List of :py:class:`oic.utils.keyio.KeyBundle` instances,
+            empty if there are no keys for the issuer.
+        """
+        try:
+            kj = self.bundle[iss]
+        except KeyError:
+            return []
+        try:
+            return kj.issuer_keys[iss]
+        except KeyError:
+            return kj.issuer_keys.get('', [])
+
+    def key_index(self):
+        """
+        An index over the keys in the bundle. An issuer's keys are only
+        loaded, and indexed, when they are looked up.
+
+        :return: A :py:class:`KeyIndex` instance
+        """
+        if self._key_index is None:
+            self._key_index = KeyIndex(None, bundle=self)
+        return self._key_index
+
+
+class KeyIndex(object):
+    """
+    An index from (issuer, kid) and from (issuer, key type) to the
+    signature verification keys in a KeyJar and/or a :py:class:`JWKSBundle`.
+    The keys of an issuer in a JWKSBundle are only loaded when they are
+    looked up, and come before those in the KeyJar.
+    The index for an issuer is built the first time it's needed and rebuilt
+    if the list of key bundles for that issuer changes. A KeyIndex with a
+    parent also has the keys of the parent's JWKSBundle, and uses the
+    parent's index for the issuers where they do not differ. Meant for a
+    copy of a KeyJar, see :py:func:`shallow_copy_keyjar`, or a KeyJar that
+    only holds keys added to those of the JWKSBundle.
+    """
+
+    def __init__(self, keyjar, parent=None, bundle=None):
+        """
+        :param keyjar: A :py:class:`oic.utils.keyio.KeyJar` instance or None
+        :param parent: A KeyIndex for the keys this one adds to
+        :param bundle: A :py:class:`JWKSBundle` instance, only used if
+            there is no parent.
+        """
+        self.keyjar = keyjar
+        self.parent = parent
+        self.bundle = bundle
+        self._index = {}  # issuer -> (key bundles, kid map, key type map)
+        self._loaded = {}  # issuer -> key bundles from the JWKSBundle
+
+    @staticmethod
+    def _same(kbl, _kbl):
+        return len(kbl) == len(_kbl) and all(
+            a is b for a, b in zip(kbl, _kbl))
+
+    def _lookup(self, issuer, kbl):
+        _idx = self
+        while _idx is not None:
             try:
-                kj.issuer_keys[iss] = k.issuer_keys[iss]
+                _kbl, kids, types = _idx._index[issuer]
             except KeyError:
-                kj.issuer_keys[iss] = k.issuer_keys['']
-        return kj
+                pass
+            else:
+                if self._same(kbl, _kbl):
+                    return kids, types
+            _idx = _idx.parent
+        return None
+
+    def _bundle_keys(self, issuer):
+        if self.parent is None:
+            if self.bundle is None:
+                return []
+            # Always asked, the bundle may have changed
+            return self.bundle.key_bundles(issuer)
+
+        # Looked up once for the lifetime of this index
+        try:
+            return self._loaded[issuer]
+        except KeyError:
+            _kbl = self.parent._bundle_keys(issuer)
+            self._loaded[issuer] = _kbl
+            return _kbl
+
+    def _root(self):
+        _idx = self
+        while _idx.parent is not None:
+            _idx = _idx.parent
+        return _idx
+
+    def _issuer(self, issuer):
+        _own = []
+        if self.keyjar is not None:
+            _own = self.keyjar.issuer_keys.get(issuer, [])
+        kbl = list(self._bundle_keys(issuer)) + list(_own)
+        if not kbl:
+            return {}, {}
+
+        _res = self._lookup(issuer, kbl)
+        if _res is not None:
+            return _res
+
+        kids = {}
+        types = {}
+        for kb in kbl:
+            for key in kb.keys():
+                if key.use and key.use != 'sig':
+                    continue
+                if key.kid:
+                    kids[key.kid] = key
+                types.setdefault(key.kty.upper(), []).append(key)
+
+        if not any(kb.remote for kb in kbl):
+            # Holding on to the key bundles also makes sure they are not
+            # replaced by others that happen to get the same id.
+            # Keys that all come from the JWKSBundle are kept where every
+            # index using that bundle can find them.
+            _idx = self if _own else self._root()
+            _idx._index[issuer] = (tuple(kbl), kids, types)
+        return kids, types
+
+    def get(self, issuer, alg, kid=''):
+        """
+        Find the key that should be used to verify a signature.
+        If a kid is given the key with that kid is returned, otherwise the
+        issuer's key of the right type if it has only one.
+
+        :param issuer: The issuer of the signed document
+        :param alg: The signing algorithm
+        :param kid: Key ID
+        :return: A key or None if there is no key to use
+        """
+        _kty = alg2keytype(alg)
+        if not _kty or _kty == 'none':
+            return None
+
+        for _iss in [issuer, '']:
+            kids, types = self._issuer(_iss)
+            if kid:
+                try:
+                    _key = kids[kid]
+                except KeyError:
+                    continue
+                if _key.kty.upper() == _kty.upper():
+                    return _key
+                return None
+
+            _keys = types.get(_kty.upper(), [])
+            if len(_keys) == 1:
+                return _keys[0]
+            elif _keys:
+                return None
+        return None
+
+
+def shallow_copy_keyjar(keyjar):
+    """
+    Make a copy of a KeyJar where the lists of key bundles are copied but
+    the key bundles themselves are shared. Adding keys to the copy will
+    therefor not affect the original.
+
+    :param keyjar: A :py:class:`oic.utils.keyio.KeyJar` instance
+    :return: A :py:class:`oic.utils.keyio.KeyJar` instance
+    """
+    kj = KeyJar(verify_ssl=keyjar.verify_ssl)
+    for iss, kbl in keyjar.issuer_keys.items():
+        kj.issuer_keys[iss] = list(kbl)
+    return kj
+
+
+def keyjar_version(keyjar, issuers=None):
+    """
+    Something that changes when key bundles are added to or removed from a
+    KeyJar, or when keys are added to, removed from or updated in one of
+    the key bundles. Only the key bundles are looked at, not the keys.
+
+    :param keyjar: A :py:class:`oic.utils.keyio.KeyJar` instance
+    :param issuers: Only look at the keys of these issuers, None means all.
+    :return: A tuple
+    """
+    if issuers is None:
+        issuers = list(keyjar.issuer_keys.keys())
+    return tuple(
+        [(iss, tuple([(id(kb), kb.last_updated, len(kb)) for kb in
+                      keyjar.issuer_keys.get(iss, [])]))
+         for iss in issuers])
 
 
 def verify_signed_bundle(signed_bundle, ver_keys):
@@ -290,8 +507,15 @@ class FSJWKSBundle(JWKSBundle):
     """
     A JWKSBundle that keeps the key information in a 
     :py:class:`fedoidc.file_system.FileSystem` instance.
+    The JWKSs on disc are only converted to KeyJars when they are asked
+    for. :py:meth:`key_index`, which
+    :py:meth:`fedoidc.operator.Operator.unpack_metadata_statement` uses,
+    only asks for the issuers it has to verify signatures from. Note that
+    :py:meth:`as_keyjar` needs the keys of all the issuers, so every JWKS
+    is converted the first time it's called.
     """
-    def __init__(self, iss, sign_keys=None, fdir='./', key_conv=None):
+    def __init__(self, iss, sign_keys=None, fdir='./', key_conv=None,
+                 fs_cls=FileSystem):
         """
 
         :param iss: Issuer ID for this entity
@@ -300,8 +524,21 @@ class FSJWKSBundle(JWKSBundle):
         :param key_conv: Specification of directory key to file name conversion.
             A set of keys are represented in the local cache as a KeyJar 
             instance and as a JWKS on disc.
+        :param fs_cls: The class used to store the JWKSs,
+            :py:class:`fedoidc.file_system.FileSystem` or something with the
+            same interface.
         """
         JWKSBundle.__init__(self, iss, sign_keys=sign_keys)
-        self.bundle = FileSystem(fdir, key_conv=key_conv,
-                                 value_conv={'to': keyjar_to_jwks,
-                                             'from': jwks_to_keyjar})
+        # A KeyJar is only built when the keys of an issuer are asked for
+        self.bundle = fs_cls(fdir, key_conv=key_conv,
+                             value_conv={'to': keyjar_to_jwks,
+                                         'from': jwks_to_keyjar},
+                             lazy=True)
+
+    @property
+    def version(self):
+        """
+        Changes made to the files on disc are also counted.
+        """
+        self.bundle.sync()
+        return self._version + self.bundle.version
@@ -0,0 +1,479 @@
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import fedoidc
+from fedoidc import instrument
+from jwkest import JWKESTException
+from jwkest import as_bytes
+
+from oic.utils.keyio import KeyBundle
+
+logger = logging.getLogger(__name__)
+
+
+def digest(value):
+    """
+    Compute a hex encoded SHA-256 digest of a value.
+
+    :param value: A string or bytes
+    :return: Hex encoded digest
+    """
+    return hashlib.sha256(as_bytes(value)).hexdigest()
+
+
+class LRUCache(object):
+    """
+    A bounded, thread safe, cache with least recently used eviction.
+    Each entry can be given an absolute expiration time after which it will
+    not be returned.
+    """
+
+    def __init__(self, max_size=1000):
+        """
+        :param max_size: Max number of entries kept in the cache, 0 means
+            no limit.
+        """
+        self.max_size = max_size
+        self._db = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get the value bound to a key, if it has not expired.
+
+        :param key: The key
+        :param default: What to return if there is no usable value
+        :return: The value or default
+        """
+        with self._lock:
+            try:
+                value, expires = self._db[key]
+            except KeyError:
+                return default
+
+            if expires and expires <= time.time():
+                del self._db[key]
+                return default
+
+            self._db.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires=0):
+        """
+        Bind a value to a key.
+
+        :param key: The key
+        :param value: The value
+        :param expires: Time in seconds since epoch when this entry expires.
+            0 means it never expires.
+        """
+        with self._lock:
+            self._db[key] = (value, expires)
+            self._db.move_to_end(key)
+            if self.max_size:
+                while len(self._db) > self.max_size:
+                    self._db.popitem(last=False)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._db[key]
+
+    def __len__(self):
+        return len(self._db)
+
+    def clear(self):
+        with self._lock:
+            self._db.clear()
+
+
+class VerifiedStatementCache(LRUCache):
+    """
+    Keeps verified metadata statements. The key is a digest of the signed
+    JWT and the value the :py:class:`fedoidc.operator.ParseInfo` instance
+    that was the result of unpacking and verifying it.
+    Entries are bound to the version of the JWKS bundle that was used when
+    they were verified, if that changes the entries are no longer usable.
+    """
+
+    def get_statement(self, jwt_ms, version):
+        """
+        :param jwt_ms: A signed metadata statement
+        :param version: Version of the JWKS bundle in use
+        :return: A ParseInfo instance or None
+        """
+        try:
+            _pi, _version = self.get(digest(jwt_ms))
+        except TypeError:  # nothing there
+            return None
+
+        if _version != version:
+            return None
+        return _pi
+
+    def set_statement(self, jwt_ms, pi, version):
+        """
+        :param jwt_ms: A signed metadata statement
+        :param pi: A :py:class:`fedoidc.operator.ParseInfo` instance
+        :param version: Version of the JWKS bundle in use
+        """
+        # The earliest expiration time in the chain, the entry must not
+        # outlive any of the statements that were verified.
+        _exp = getattr(pi.result, 'expires', 0)
+        if not _exp:
+            # Only statements with a limited lifetime are kept
+            return
+        self.set(digest(jwt_ms), (pi, version), _exp)
+
+
+class EvaluationCache(LRUCache):
+    """
+    Keeps the flattened result of evaluating inner metadata statements.
+    The key is the signed JWT the statement was verified from and the value
+    a tuple of the list of :py:class:`fedoidc.operator.LessOrEqual`
+    instances the evaluation produced, the statements expiration time and
+    its signing keys.
+    The LessOrEqual instances are shared between evaluations and must not
+    be modified.
+    """
+
+    @staticmethod
+    def key(ms):
+        """
+        :param ms: An inner metadata statement as a JSON document or as a
+            Message instance produced by verifying a signed JWT.
+        :return: The key or None if the statement can not be cached
+        """
+        if isinstance(ms, str):
+            return ms
+
+        _jwt = getattr(ms, 'jwt', None)
+        if not _jwt or not _signed_content(ms):
+            return None
+        return _jwt
+
+    def get_flattened(self, key):
+        """
+        :param key: A key as computed by :py:meth:`key`
+        :return: Tuple of LessOrEqual list, exp and signing keys or None
+        """
+        if key is None:
+            return None
+        return self.get(key)
+
+    def set_flattened(self, key, les, exp, signing_keys):
+        """
+        :param key: A key as computed by :py:meth:`key`
+        :param les: List of :py:class:`fedoidc.operator.LessOrEqual`
+            instances
+        :param exp: When the metadata statement expires
+        :param signing_keys: The signing keys in the metadata statement
+        """
+        if key is None:
+            return
+        self.set(key, (les, exp, signing_keys), exp)
+
+
+def _signed_content(ms):
+    """
+    Check that everything in a verified metadata statement comes from its
+    signed JWT. Statements fetched from metadata_statement_uris are not,
+    what's published there may change.
+
+    :param ms: A verified metadata statement
+    :return: True or False
+    """
+    if 'metadata_statement_uris' in ms:
+        return False
+    try:
+        _mss = ms['metadata_statements']
+    except KeyError:
+        return True
+    for _ms in _mss.values():
+        if not isinstance(_ms, str) and not _signed_content(_ms):
+            return False
+    return True
+
+
+class JWKSCache(LRUCache):
+    """
+    Keeps the result of checking that a JWKS is well formed, and the key
+    bundle built from it, keyed by a digest of the canonical JSON
+    representation of the JWKS.
+    """
+
+    @staticmethod
+    def key(jwks):
+        return digest(json.dumps(jwks, sort_keys=True, separators=(',', ':')))
+
+    def _entry(self, jwks):
+        _key = self.key(jwks)
+        _entry = self.get(_key)
+        if _entry is None:
+            instrument.count('operator.jwks_cache.miss')
+            # [well formed, key bundle]
+            _entry = [fedoidc.is_jwks(jwks), None]
+            self.set(_key, _entry)
+        else:
+            instrument.count('operator.jwks_cache.hit')
+        return _entry
+
+    def is_valid(self, jwks):
+        """
+        :param jwks: Dictionary representation of a JWKS
+        :return: True if the JWKS is well formed
+        """
+        try:
+            return self._entry(jwks)[0]
+        except (TypeError, ValueError):  # Not JSON serializable
+            return False
+
+    def key_bundle(self, jwks):
+        """
+        The keys in a JWKS. The key bundle is shared so it MUST NOT be
+        modified.
+
+        :param jwks: Dictionary representation of a JWKS
+        :return: A :py:class:`oic.utils.keyio.KeyBundle` instance
+        :raises ValueError: If the keys can not be imported
+        """
+        _entry = self._entry(jwks)
+        if _entry[1] is None:
+            try:
+                _entry[1] = KeyBundle(jwks['keys'])
+            except (JWKESTException, ValueError, TypeError, KeyError) as err:
+                # Looked right but the keys could not be built
+                _entry[0] = False
+                raise ValueError('Could not import JWKS: {}'.format(err))
+        return _entry[1]
+
+
+class SignedDocumentCache(object):
+    """
+    Keeps signed documents together with a description of the state they
+    were built from. If the state changes the document is rebuilt.
+    A document that is about to expire is rebuilt in the background while
+    the old one is still handed out.
+    """
+
+    def __init__(self, refresh_margin=60):
+        """
+        :param refresh_margin: How many seconds before a document expires
+            a rebuild should be started.
+        """
+        self.refresh_margin = refresh_margin
+        self._db = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def _build(self, key, state, build):
+        doc, expires = build()
+        with self._lock:
+            self._db[key] = (doc, expires, state)
+        return doc
+
+    def _refresh(self, key, state, build):
+        try:
+            self._build(key, state, build)
+        except Exception as err:
+            logger.error('Could not refresh {}: {}'.format(key, err))
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, key, state, build):
+        """
+        Return the document bound to a key, building it if necessary.
+
+        :param key: Identifier for the document
+        :param state: Something that can be compared with the state the
+            cached document was built from.
+        :param build: A function that returns a tuple of the document and
+            the time, in seconds since epoch, it expires. 0 means it never
+            expires.
+        :return: The document
+        """
+        _now = time.time()
+        with self._lock:
+            try:
+                doc, expires, _state = self._db[key]
+            except KeyError:
+                doc = None
+
+        if doc is None or _state != state or (expires and expires <= _now):
+            return self._build(key, state, build)
+
+        if expires and expires - self.refresh_margin <= _now:
+            with self._lock:
+                if key in self._refreshing:
+                    return doc
+                self._refreshing.add(key)
+            threading.Thread(target=self._refresh, args=(key, state, build),
+                             daemon=True).start()
+
+        return doc
+
+    def clear(self):
+        with self._lock:
+            self._db.clear()
+
+
+SHA256_HEX = re.compile('^[0-9a-f]{64}$')
+
+
+def cache_control(headers):
+    """
+    Parse the Cache-Control header of a HTTP response.
+
+    :param headers: The response headers
+    :return: Dictionary with directives as keys
+    """
+    try:
+        _val = headers['Cache-Control']
+    except (KeyError, TypeError):
+        return {}
+
+    res = {}
+    for part in _val.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            key, val = part.split('=', 1)
+            res[key.strip().lower()] = val.strip().strip('"')
+        else:
+            res[part.lower()] = ''
+    return res
+
+
+class CachedResponse(object):
+    def __init__(self, text=None, etag='', last_modified='', fresh_until=0,
+                 immutable=False):
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh_until = fresh_until
+        self.immutable = immutable
+
+    def is_fresh(self, now):
+        return self.immutable or now < self.fresh_until
+
+
+class URICache(object):
+    """
+    A HTTP cache for signed metadata statements published at
+    metadata_statement_uris.
+    Honours Cache-Control, ETag and Last-Modified and uses conditional
+    requests to revalidate stale entries. Failures are remembered for
+    *negative_ttl* seconds.
+    Statements published at URLs where the last path segment is the SHA-256
+    digest of the statement are regarded as immutable until they expire.
+    """
+
+    def __init__(self, max_size=1000, negative_ttl=60, default_ttl=0):
+        """
+        :param max_size: Max number of URLs kept in the cache
+        :param negative_ttl: How long, in seconds, a failed fetch should be
+            remembered.
+        :param default_ttl: How long a response without caching directives
+            is regarded as fresh.
+        """
+        self.negative_ttl = negative_ttl
+        self.default_ttl = default_ttl
+        self._db = LRUCache(max_size=max_size)
+
+    @staticmethod
+    def _content_addressed(url, text):
+        _name = urlparse(url).path.rsplit('/', 1)[-1]
+        if not SHA256_HEX.match(_name):
+            return False
+        if digest(text) != _name:
+            logger.warning('Content at {} does not match digest'.format(url))
+            return False
+        return True
+
+    def _fresh_until(self, headers, now):
+        _cc = cache_control(headers)
+        if 'no-cache' in _cc:
+            return 0
+        try:
+            return now + int(_cc['max-age'])
+        except (KeyError, ValueError):
+            return now + self.default_ttl
+
+    def _store(self, url, rsp, now):
+        _headers = getattr(rsp, 'headers', {}) or {}
+        if 'no-store' in cache_control(_headers):
+            try:
+                del self._db[url]
+            except KeyError:
+                pass
+            return rsp.text
+
+        if self._content_addressed(url, rsp.text):
+            try:
+                _exp = fedoidc.unfurl(rsp.text)['exp']
+            except Exception:
+                _exp = 0
+            if _exp:
+                self._db.set(url, CachedResponse(rsp.text, immutable=True),
+                             _exp)
+                return rsp.text
+
+        _entry = CachedResponse(
+            rsp.text, etag=_headers.get('ETag', ''),
+            last_modified=_headers.get('Last-Modified', ''),
+            fresh_until=self._fresh_until(_headers, now))
+        self._db.set(url, _entry)
+        return rsp.text
+
+    def _fail(self, url, now):
+        self._db.set(url, CachedResponse(fresh_until=now + self.negative_ttl))
+        return None
+
+    def fetch(self, httpcli, url):
+        """
+        Get the document at a URL.
+
+        :param httpcli: A HTTP client with a *http_request* method
+        :param url: The URL
+        :return: The document or None if it could not be fetched.
+        """
+        _now = time.time()
+        _entry = self._db.get(url)
+        if _entry is not None and _entry.is_fresh(_now):
+            return _entry.text
+
+        _headers = {}
+        if _entry is not None and _entry.text is not None:
+            if _entry.etag:
+                _headers['If-None-Match'] = _entry.etag
+            if _entry.last_modified:
+                _headers['If-Modified-Since'] = _entry.last_modified
+
+        try:
+            if _headers:
+                rsp = httpcli.http_request(url, headers=_headers)
+            else:
+                rsp = httpcli.http_request(url)
+        except Exception as err:
+            logger.error('Could not fetch {}: {}'.format(url, err))
+            return self._fail(url, _now)
+
+        if rsp.status_code == 304 and _headers:
+            _rsp_headers = getattr(rsp, 'headers', {}) or {}
+            _entry.fresh_until = self._fresh_until(_rsp_headers, _now)
+            self._db.set(url, _entry)
+            return _entry.text
+        elif rsp.status_code == 200:
+            return self._store(url, rsp, _now)
+        else:
+            return self._fail(url, _now)
@@ -14,7 +14,9 @@ class FederationEntity(Operator):
     An entity in a federation. For instance an OP or an RP.
     """
 
-    def __init__(self, srv, iss='', keyjar=None, signer=None, fo_bundle=None):
+    def __init__(self, srv, iss='', keyjar=None, signer=None, fo_bundle=None,
+                 statement_cache=None, executor=None, uri_cache=None,
+                 evaluation_cache=None):
         """
 
         :param srv: A Client or Provider instance
@@ -25,10 +27,20 @@ class FederationEntity(Operator):
             entity produces.
         :param fo_bundle: A bundle of keys that can be used to verify
             the root signature of a compounded metadata statement.
+        :param statement_cache: A
+            :py:class:`fedoidc.cache.VerifiedStatementCache` instance
+        :param executor: A :py:class:`concurrent.futures.Executor` instance
+            used to verify sibling metadata statements concurrently.
+        :param uri_cache: A :py:class:`fedoidc.cache.URICache` instance
+        :param evaluation_cache: A
+            :py:class:`fedoidc.cache.EvaluationCache` instance
         """
 
         Operator.__init__(self, iss=iss, keyjar=keyjar, httpcli=srv,
-                          jwks_bundle=fo_bundle)
+                          jwks_bundle=fo_bundle,
+                          statement_cache=statement_cache,
+                          executor=executor, uri_cache=uri_cache,
+                          evaluation_cache=evaluation_cache)
 
         # Who can sign request from this entity
         self.signer = signer
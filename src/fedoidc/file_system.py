@@ -1,10 +1,56 @@
 import logging
 import os
 import shutil
-import time
+import threading
+import uuid
+
+from fedoidc import instrument
+from fedoidc.watcher import get_watcher
 
 logger = logging.getLogger(__name__)
 
+# Placeholder for a value that has not been read from its file yet
+_UNREAD = object()
+
+# Temporary files are named TMP_PREFIX + '<pid>.<random>', keys may not
+# start with it.
+TMP_PREFIX = '.fedoidc-tmp.'
+
+
+def is_tmp_file(name):
+    """
+    Find out if a file name is the name of a temporary file.
+
+    :param name: File name, without the directory
+    :return: True/False
+    """
+    return name.startswith(TMP_PREFIX)
+
+
+def write_atomic(fname, value):
+    """
+    Write to a temporary file in the same directory, flush it to disc
+    and then rename it to the final name.
+
+    :param fname: File name
+    :param value: What to write
+    """
+    _tmp = os.path.join(os.path.dirname(fname), '{}{}.{}'.format(
+        TMP_PREFIX, os.getpid(), uuid.uuid4().hex))
+    fd = os.open(_tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(value)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(_tmp, fname)
+    except Exception:
+        try:
+            os.unlink(_tmp)
+        except OSError:
+            pass
+        raise
+
 
 class FileSystem(object):
     """
@@ -12,9 +58,13 @@ class FileSystem(object):
     It has a dictionary like interface.
     Each key maps one-to-one to a file on disc, where the content of the
     file is the value.
+    Values are written to a temporary file which is then renamed, so readers
+    never see a partially written file. The temporary files are named with
+    the prefix TMP_PREFIX, which therefore can not be used for keys.
     """
 
-    def __init__(self, fdir, key_conv=None, value_conv=None, c_size=0):
+    def __init__(self, fdir, key_conv=None, value_conv=None, c_size=0,
+                 watch=False, poll_interval=1.0, lazy=False):
         """
         :param fdir: The root of the directory
         :param key_conv: Converts to/from the key displayed by this class to
@@ -29,15 +79,80 @@ class FileSystem(object):
         be stored in a file. Like with key_conv the value of this parameter
         is a dictionary with the keys ['to', 'from'].
         :type value_conv: dictionary
+        :param watch: If True the directory is watched for changes and the
+            local cache is kept up to date from the change events. Reads
+            will then not touch the file system.
+        :param poll_interval: If the directory has to be watched by polling,
+            the number of seconds between scans.
+        :param lazy: If True a file is not read, and its value not
+            converted, until the value is asked for. Until the file changes
+            the converted value is then kept.
         """
         self.fdir = fdir
         self.fmtime = {}
         self.db = {}
+        # Incremented every time a change in the database is noticed
+        self.version = 0
         self.key_conv = key_conv or {}
         self.value_conv = value_conv or {}
+        self.lazy = lazy
         if not os.path.isdir(fdir):
             os.makedirs(fdir)
 
+        self.watcher = None
+        self._lock = threading.RLock()
+        if watch:
+            # Watch first, so nothing that changes while the cache is being
+            # built is missed.
+            self.watcher = get_watcher(fdir, self._file_changed,
+                                       interval=poll_interval)
+            self.watcher.start()
+            try:
+                with self._lock:
+                    self._sync()
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        """
+        Stop watching the directory.
+        """
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+
+    def _file_changed(self, name):
+        """
+        Callback used by the directory watcher.
+
+        :param name: Name of the file that changed, None means that
+            changes may have been lost.
+        """
+        if name is None:
+            # Readers do not take the lock so the cache is rebuilt on the
+            # side and then swapped in.
+            with self._lock:
+                self.fmtime, self.db = self._scan()
+                self.version += 1
+            return
+
+        if is_tmp_file(name):
+            return
+
+        fname = os.path.join(self.fdir, name)
+        with self._lock:
+            if os.path.isfile(fname):
+                try:
+                    self.fmtime[name] = self.get_stamp(fname)
+                    self.db[name] = self._read_or_defer(fname)
+                except Exception as err:
+                    logger.error('Could not read {}: {}'.format(fname, err))
+                    return
+            else:
+                self.fmtime.pop(name, None)
+                self.db.pop(name, None)
+            self.version += 1
 
     def __getitem__(self, item):
         """
@@ -51,12 +166,32 @@ class FileSystem(object):
         except KeyError:
             pass
 
+        if self.watcher:
+            return self._value(item)
+
         if self.is_changed(item):
             logger.info("File content change in {}".format(item))
             fname = os.path.join(self.fdir, item)
             self.db[item] = self._read_info(fname)
+            self.version += 1
+
+        return self._value(item)
+
+    def _value(self, item):
+        """
+        Return the value bound to a file name, reading it if that has not
+        been done yet.
+        """
+        _val = self.db[item]
+        if _val is _UNREAD:
+            _val = self._read_info(os.path.join(self.fdir, item))
+            self.db[item] = _val
+        return _val
 
-        return self.db[item]
+    def _read_or_defer(self, fname):
+        if self.lazy:
+            return _UNREAD
+        return self._read_info(fname)
 
     def __setitem__(self, key, value):
         """
@@ -68,7 +203,6 @@ class FileSystem(object):
         :param value: Value that should be bound to the identifier.
         :return:
         """
-
         if not os.path.isdir(self.fdir):
             os.makedirs(self.fdir, exist_ok=True)
 
@@ -77,23 +211,28 @@ class FileSystem(object):
         except KeyError:
             _key = key
 
-        fname = os.path.join(self.fdir, _key)
-        fp = open(fname, 'w')
+        if is_tmp_file(_key):
+            raise ValueError('Keys may not start with {}'.format(TMP_PREFIX))
+
         try:
-            fp.write(self.value_conv['to'](value))
+            _val = self.value_conv['to'](value)
         except KeyError:
-            fp.write(value)
-        fp.close()
+            _val = value
 
-        self.db[_key] = value
-        self.fmtime[_key] = self.get_mtime(fname)
+        fname = os.path.join(self.fdir, _key)
+        write_atomic(fname, _val)
+
+        with self._lock:
+            self.db[_key] = value
+            self.fmtime[_key] = self.get_stamp(fname)
+            self.version += 1
 
     def keys(self):
         """
         Implements the dict.keys() method
         """
         self.sync()
-        for k in self.db.keys():
+        for k in list(self.db.keys()):
             try:
                 yield self.key_conv['from'](k)
             except KeyError:
@@ -107,15 +246,20 @@ class FileSystem(object):
         :param fname: File name
         :return: The last time the file was modified.
         """
-        try:
-            mtime = os.stat(fname).st_mtime_ns
-        except OSError:
-            # The file might be right in the middle of being written
-            # so sleep
-            time.sleep(1)
-            mtime = os.stat(fname).st_mtime_ns
+        return os.stat(fname).st_mtime_ns
 
-        return mtime
+    @staticmethod
+    def get_stamp(fname):
+        """
+        What is used to tell if a file has changed. The inode number is
+        included since a file replaced by a rename within the same mtime
+        tick still gets a new inode.
+
+        :param fname: File name
+        :return: Tuple of inode number and modification time
+        """
+        _stat = os.stat(fname)
+        return _stat.st_ino, _stat.st_mtime_ns
 
     def is_changed(self, item):
         """
@@ -125,17 +269,20 @@ class FileSystem(object):
         :return: True/False
         """
         fname = os.path.join(self.fdir, item)
-        if os.path.isfile(fname):
-            mtime = self.get_mtime(fname)
+        try:
+            stamp = self.get_stamp(fname)
+        except OSError:
+            stamp = None
 
+        if stamp is not None:
             try:
-                _ftime = self.fmtime[item]
+                _fstamp = self.fmtime[item]
             except KeyError:  # Never been seen before
-                self.fmtime[item] = mtime
+                self.fmtime[item] = stamp
                 return True
 
-            if mtime > _ftime:  # has changed
-                self.fmtime[item] = mtime
+            if stamp != _fstamp:  # has changed
+                self.fmtime[item] = stamp
                 return True
             else:
                 return False
@@ -143,6 +290,7 @@ class FileSystem(object):
             logger.error('Could not access {}'.format(fname))
             raise KeyError(item)
 
+    @instrument.timed('file_system.read')
     def _read_info(self, fname):
         if os.path.isfile(fname):
             try:
@@ -159,32 +307,81 @@ class FileSystem(object):
             logger.error('No such file: {}'.format(fname))
         return None
 
+    @instrument.timed('file_system.sync')
     def sync(self):
         """
         Goes through the directory and builds a local cache based on
         the content of the directory.
+        If the directory is watched the cache is already up to date.
         """
+        if self.watcher:
+            return
+        self._sync()
+
+    def _sync(self):
         if not os.path.isdir(self.fdir):
             os.makedirs(self.fdir)
             #raise ValueError('No such directory: {}'.format(self.fdir))
         for f in os.listdir(self.fdir):
+            if is_tmp_file(f):
+                continue
             fname = os.path.join(self.fdir, f)
             if not os.path.isfile(fname):
                 continue
             if f in self.fmtime:
-                if self.is_changed(f):
-                    self.db[f] = self._read_info(fname)
+                try:
+                    _changed = self.is_changed(f)
+                except KeyError:  # removed in between
+                    continue
+                if _changed:
+                    self.db[f] = self._read_or_defer(fname)
+                    self.version += 1
+            else:
+                try:
+                    stamp = self.get_stamp(fname)
+                except OSError:  # removed in between
+                    continue
+                self.db[f] = self._read_or_defer(fname)
+                self.fmtime[f] = stamp
+                self.version += 1
+
+    def _scan(self):
+        """
+        Build a new cache from the content of the directory. Values of
+        files that have not changed are kept.
+
+        :return: Tuple of dictionaries, file stamps and values
+        """
+        fmtime = {}
+        db = {}
+        for f in os.listdir(self.fdir):
+            if is_tmp_file(f):
+                continue
+            fname = os.path.join(self.fdir, f)
+            if not os.path.isfile(fname):
+                continue
+            try:
+                stamp = self.get_stamp(fname)
+            except OSError:  # removed in between
+                continue
+            fmtime[f] = stamp
+            if self.fmtime.get(f) == stamp and f in self.db:
+                db[f] = self.db[f]
             else:
-                mtime = self.get_mtime(fname)
-                self.db[f] = self._read_info(fname)
-                self.fmtime[f] = mtime
+                db[f] = self._read_or_defer(fname)
+        return fmtime, db
 
     def items(self):
         """
         Implements the dict.items() method
         """
         self.sync()
-        for k, v in self.db.items():
+        for k, v in list(self.db.items()):
+            if v is _UNREAD:
+                try:
+                    v = self._value(k)
+                except KeyError:  # cleared in between
+                    continue
             try:
                 yield self.key_conv['from'](k), v
             except KeyError:
@@ -209,6 +406,8 @@ class FileSystem(object):
             except KeyError:
                 pass
 
+        self.version += 1
+
     def update(self, ava):
         """
         Implements the dict.update() method
@@ -0,0 +1,235 @@
+"""
+Instrumentation hooks.
+
+Timers and counters are placed around the hot paths in the library. By
+default they do nothing. To collect measurements install an instrument::
+
+    from fedoidc import instrument
+
+    hist = instrument.HistogramInstrument()
+    instrument.set_instrument(hist)
+    ...
+    print(hist.snapshot())
+
+Anything that implements the :py:class:`Instrument` interface can be
+installed, for instance an adapter to a metrics library.
+"""
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+__author__ = 'roland'
+
+#: Upper bounds, in seconds, of the default histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrument(object):
+    """
+    The instrument interface. This implementation does nothing.
+    """
+
+    #: If False the timed functions are called without any overhead
+    enabled = False
+
+    def timer(self, name):
+        """
+        A context manager that measures the time spent within it.
+
+        :param name: Name of the stage
+        """
+        return _NULL_TIMER
+
+    def observe(self, name, value):
+        """
+        Record a measurement.
+
+        :param name: Name of the stage
+        :param value: The measured value, for timers in seconds
+        """
+        pass
+
+    def count(self, name, value=1):
+        """
+        Increment a counter.
+
+        :param name: Name of the counter
+        :param value: How much to increment it with
+        """
+        pass
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """
+        Estimate a percentile. The upper bound of the bucket the percentile
+        falls into is returned, or the max value if it is in the last one.
+
+        :param pct: Percentile, 0-100
+        """
+        if not self.count:
+            return None
+
+        _rank = pct / 100.0 * self.count
+        _acc = 0
+        for _bound, _cnt in zip(self.buckets, self.counts):
+            _acc += _cnt
+            if _acc >= _rank:
+                return min(_bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        res = {'count': self.count, 'sum': self.sum, 'min': self.min,
+               'max': self.max,
+               'buckets': dict(zip(
+                   [str(b) for b in self.buckets] + ['+Inf'], self.counts))}
+        for pct in [50, 90, 99]:
+            res['p{}'.format(pct)] = self.percentile(pct)
+        return res
+
+
+class HistogramInstrument(Instrument):
+    """
+    Keeps histograms and counters in process.
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Upper bounds of the histogram buckets
+        """
+        self.bucket_bounds = buckets
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        _start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.observe(name, time.perf_counter() - _start)
+
+    def observe(self, name, value):
+        with self._lock:
+            try:
+                _hist = self.histograms[name]
+            except KeyError:
+                _hist = self.histograms[name] = Histogram(self.bucket_bounds)
+            _hist.observe(value)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        :return: A dictionary with the current histograms and counters
+        """
+        with self._lock:
+            return {
+                'histograms': dict(
+                    [(k, v.to_dict()) for k, v in self.histograms.items()]),
+                'counters': dict(self.counters)
+            }
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+
+_instrument = Instrument()
+
+
+def set_instrument(inst=None):
+    """
+    Install an instrument, None restores the no-op default.
+
+    :param inst: An :py:class:`Instrument` instance
+    """
+    global _instrument
+    if inst is None:
+        inst = Instrument()
+    _instrument = inst
+
+
+def get_instrument():
+    return _instrument
+
+
+def timer(name):
+    """
+    A context manager that times a stage with the installed instrument.
+
+    :param name: Name of the stage
+    """
+    return _instrument.timer(name)
+
+
+def count(name, value=1):
+    """
+    Increment a counter in the installed instrument.
+
+    :param name: Name of the counter
+    :param value: How much to increment it with
+    """
+    _instrument.count(name, value)
+
+
+def timed(name):
+    """
+    Decorator that times every call to a function.
+
+    :param name: Name of the stage
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _inst = _instrument
+            if not _inst.enabled:
+                return func(*args, **kwargs)
+            with _inst.timer(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
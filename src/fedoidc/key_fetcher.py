@@ -0,0 +1,329 @@
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+
+import requests
+from fedoidc import KeyBundle
+from fedoidc import instrument
+from fedoidc.cache import LRUCache
+from fedoidc.cache import cache_control
+from fedoidc.cache import digest
+
+from oic.utils.keyio import KeyJar
+from oic.utils.keyio import UpdateFailed
+
+__author__ = 'roland'
+
+logger = logging.getLogger(__name__)
+
+REMOTE_FAILED = "Remote key update from '{}' failed, {}"
+MALFORMED = "Remote key update from {} failed, malformed JWKS."
+
+
+class DeferredKeyBundle(KeyBundle):
+    """
+    A :py:class:`fedoidc.KeyBundle` with keys from a remote source that are
+    fetched in the background. Anyone asking for the keys before there are
+    any waits for the fetch to finish, but not longer than *timeout*
+    seconds.
+    The keys are kept as long as the Cache-Control max-age of the response,
+    or the exp of a signed JWKS, allows. Without either *cache_time* is
+    used. When they have expired they are refreshed in the background, one
+    refresh at the time, and the old keys are used until the new ones are
+    in place. If a fetch fails no new attempt is made for *retry_after*
+    seconds.
+    """
+
+    def __init__(self, source, verify_keys=None, timeout=10, retry_after=60,
+                 **kwargs):
+        """
+        :param source: Where the JWKS or signed JWKS can be found
+        :param verify_keys: Keys to verify a signed JWKS with
+        :param timeout: Max number of seconds to wait for the remote source
+            to answer and for a pending fetch to finish.
+        :param retry_after: Number of seconds to wait after a failed fetch
+            before trying again.
+        :param kwargs: Other arguments to :py:class:`fedoidc.KeyBundle`
+        """
+        KeyBundle.__init__(self, source=source, verify_keys=verify_keys,
+                           **kwargs)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.executor = None
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def fetch_in(self, executor):
+        """
+        Start fetching the keys. Later refreshes are also done by the
+        executor.
+
+        :param executor: A :py:class:`concurrent.futures.Executor` instance
+        :return: A Future
+        """
+        self.executor = executor
+        with self._lock:
+            self._pending = executor.submit(self._fetch_or_back_off)
+            return self._pending
+
+    def pending(self):
+        """
+        :return: True if a background fetch has not finished yet
+        """
+        with self._lock:
+            _pending = self._pending
+        return _pending is not None and not _pending.done()
+
+    def wait(self, timeout=None):
+        """
+        Wait for a background fetch to finish.
+
+        :param timeout: Max number of seconds to wait, default is the
+            timeout given when the instance was created.
+        :return: True if the keys were fetched
+        """
+        with self._lock:
+            _pending = self._pending
+        if _pending is None:
+            return False
+
+        try:
+            _pending.result(timeout=timeout or self.timeout)
+        except concurrent.futures.TimeoutError:
+            logger.warning('Still waiting for keys from {}'.format(
+                self.source))
+            return False
+        except Exception:  # Logged by _fetch_or_back_off
+            res = False
+        else:
+            res = True
+
+        with self._lock:
+            if self._pending is _pending:
+                self._pending = None
+        return res
+
+    def _submit(self):
+        """
+        Run :py:meth:`_fetch_or_back_off` in the executor or, if there is
+        none, in a thread of its own.
+
+        :return: A Future
+        """
+        if self.executor is not None:
+            return self.executor.submit(self._fetch_or_back_off)
+
+        _fut = concurrent.futures.Future()
+
+        def run():
+            try:
+                _fut.set_result(self._fetch_or_back_off())
+            except Exception as err:
+                _fut.set_exception(err)
+
+        threading.Thread(target=run, daemon=True).start()
+        return _fut
+
+    def _refresh(self):
+        """
+        Start a background refresh unless one is going on already.
+        """
+        with self._lock:
+            if self._pending is not None and not self._pending.done():
+                return
+            # Someone else may have done it while this thread waited
+            if time.time() <= self.time_out:
+                return
+            self._pending = self._submit()
+
+    def _uptodate(self):
+        if self._keys:
+            if time.time() > self.time_out:
+                self._refresh()
+            # The keys there are, are used until new ones are fetched
+            return False
+
+        # Nothing to hand out until a fetch is done
+        if time.time() > self.time_out:
+            self._refresh()
+        return self.wait()
+
+    def _fetch_or_back_off(self):
+        try:
+            return self.do_remote()
+        except Exception as err:
+            logger.error('Could not fetch keys from {}: {}'.format(
+                self.source, err))
+            self.time_out = time.time() + self.retry_after
+            raise
+
+    def update(self):
+        # Unlike KeyBundle.update the old keys are kept until new ones
+        # are fetched.
+        return self.do_remote()
+
+    def do_remote(self):
+        with instrument.timer('key_bundle.do_remote'):
+            return self._fetch()
+
+    def _fetch(self):
+        """
+        As :py:meth:`oic.utils.keyio.KeyBundle.do_remote` but with a timeout
+        on the request.
+        """
+        args = {'verify': self.verify_ssl, 'timeout': self.timeout}
+        if self.etag:
+            args['headers'] = {'If-None-Match': self.etag}
+
+        try:
+            logger.debug('KeyBundle fetch keys from: {}'.format(self.source))
+            r = requests.get(self.source, **args)
+        except Exception as err:
+            logger.error(err)
+            raise UpdateFailed(REMOTE_FAILED.format(self.source, err))
+
+        if r.status_code == 304 and self.imp_jwks:  # has not changed
+            _jwks = self.imp_jwks
+            res = False
+        elif r.status_code == 200:
+            _jwks = self._parse_remote_response(r)
+            if not isinstance(_jwks, dict) or 'keys' not in _jwks:
+                raise UpdateFailed(MALFORMED.format(self.source))
+            try:
+                self.etag = r.headers['Etag']
+            except KeyError:
+                pass
+            res = True
+        else:
+            raise UpdateFailed(REMOTE_FAILED.format(
+                self.source, 'HTTP status {}'.format(r.status_code)))
+
+        _kb = KeyBundle()
+        _kb.do_keys(_jwks['keys'])
+        self._keys = _kb._keys
+        self.imp_jwks = _jwks
+        self.time_out = self._fresh_until(r, _jwks)
+        self.last_updated = time.time()
+        return res
+
+    def _fresh_until(self, response, jwks):
+        _now = time.time()
+        try:
+            _until = _now + int(cache_control(response.headers)['max-age'])
+        except (KeyError, ValueError):
+            _until = _now + self.cache_time
+
+        try:
+            return min(_until, int(jwks['exp']))
+        except (KeyError, TypeError, ValueError):
+            return _until
+
+
+class KeyFetcher(object):
+    """
+    Fetches keys from remote sources in the background. At most
+    *max_workers* sources are fetched from at the same time, the rest have
+    to wait for their turn.
+    """
+
+    def __init__(self, max_workers=4, timeout=10):
+        """
+        :param max_workers: Max number of concurrent fetches
+        :param timeout: Max number of seconds to wait for a remote source
+        """
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+
+    def key_bundle(self, source, verify_keys=None, **kwargs):
+        """
+        Create a key bundle and start fetching its keys.
+
+        :param source: Where the JWKS or signed JWKS can be found
+        :param verify_keys: Keys to verify a signed JWKS with
+        :param kwargs: Other arguments to :py:class:`DeferredKeyBundle`
+        :return: A :py:class:`DeferredKeyBundle` instance
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        _kb = DeferredKeyBundle(source, verify_keys=verify_keys, **kwargs)
+        _kb.fetch_in(self.executor)
+        return _kb
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class SignedJWKSCache(object):
+    """
+    Keeps one :py:class:`DeferredKeyBundle` per signed JWKS URI and set of
+    keys the signed JWKS is verified with. Clients that share both also
+    share the key bundle, so the JWKS is only fetched and verified once for
+    all of them.
+    """
+
+    def __init__(self, max_size=1000, key_fetcher=None, timeout=10):
+        """
+        :param max_size: Max number of key bundles kept
+        :param key_fetcher: A :py:class:`KeyFetcher` instance. If given new
+            key bundles are fetched in the background otherwise before they
+            are returned.
+        :param timeout: Max number of seconds to wait for a remote source,
+            only used if there is no key_fetcher.
+        """
+        self.key_fetcher = key_fetcher
+        self.timeout = timeout
+        self._db = LRUCache(max_size=max_size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(uri, signing_keys, **kwargs):
+        """
+        :param uri: Where the signed JWKS can be found
+        :param signing_keys: The keys the signed JWKS is verified with, a
+            JWKS or a KeyJar instance.
+        :param kwargs: Other arguments to :py:class:`DeferredKeyBundle`
+        :return: A digest of the canonical JSON representation of the
+            arguments
+        """
+        if isinstance(signing_keys, KeyJar):
+            signing_keys = signing_keys.export_jwks(issuer='')
+        return digest(json.dumps([uri, signing_keys, kwargs], sort_keys=True,
+                                 separators=(',', ':')))
+
+    def key_bundle(self, uri, signing_keys, **kwargs):
+        """
+        Get the key bundle for a signed JWKS, creating it if necessary.
+
+        :param uri: Where the signed JWKS can be found
+        :param signing_keys: The keys the signed JWKS is verified with, a
+            JWKS or a KeyJar instance.
+        :param kwargs: Other arguments to :py:class:`DeferredKeyBundle`,
+            bundles created with other arguments are not shared.
+        :return: A :py:class:`DeferredKeyBundle` instance
+        """
+        _key = self.key(uri, signing_keys, **kwargs)
+        with self._lock:
+            _kb = self._db.get(_key)
+            if _kb is not None:
+                instrument.count('provider.signed_jwks_cache.hit')
+                return _kb
+
+            instrument.count('provider.signed_jwks_cache.miss')
+            if self.key_fetcher is not None:
+                _kb = self.key_fetcher.key_bundle(
+                    uri, verify_keys=signing_keys, **kwargs)
+            else:
+                kwargs.setdefault('timeout', self.timeout)
+                _kb = DeferredKeyBundle(uri, verify_keys=signing_keys,
+                                        **kwargs)
+            self._db.set(_key, _kb)
+
+        if self.key_fetcher is None:
+            # Any other thread asking for the same bundle waits for this.
+            _kb.keys()
+        return _kb
+
+    def clear(self):
+        self._db.clear()
@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+from fedoidc.cache import LRUCache
+from fedoidc.cache import SHA256_HEX
+from fedoidc.file_system import write_atomic
+from jwkest import as_bytes
+
+__author__ = 'roland'
+
+logger = logging.getLogger(__name__)
+
+INDEX = 'index'
+
+
+class MetaDataStore(object):
+    """
+    A content addressed store for signed metadata statements. Each
+    statement is kept in a file named by the SHA-256 digest of the
+    statement. The files are spread out over subdirectories named by
+    prefixes of the digest, so no directory grows too large, and the path
+    to a statement can be computed from the digest. Lookups therefore never
+    list a directory.
+    The digests of all the stored statements are appended to an index file
+    which is used to enumerate the store.
+    If *fs_cls* is given the statements are instead kept in an instance of
+    that class, for instance a
+    :py:class:`fedoidc.sqlite_store.SQLiteFileSystem`.
+    """
+
+    def __init__(self, fdir, levels=2, width=2, cache_size=1000,
+                 fs_cls=None):
+        """
+        :param fdir: The root of the directory
+        :param levels: The number of subdirectory levels
+        :param width: The number of hex digits used to name a subdirectory
+        :param cache_size: Max number of statements kept in memory
+        :param fs_cls: A class with the same interface as
+            :py:class:`fedoidc.file_system.FileSystem` to keep the statements
+            in.
+        """
+        self.fdir = fdir
+        self.levels = levels
+        self.width = width
+        self.index_file = os.path.join(fdir, INDEX)
+        self._cache = LRUCache(max_size=cache_size)
+        self._keys = {}  # digest -> None, keeps the order
+        self._offset = 0  # How much of the index file that has been read
+        self._lock = threading.Lock()
+        if not os.path.isdir(fdir):
+            os.makedirs(fdir, exist_ok=True)
+
+        if fs_cls is None:
+            self.backend = None
+        else:
+            self.backend = fs_cls(fdir)
+
+    @staticmethod
+    def hash(value):
+        _hash = hashlib.sha256()
+        _hash.update(as_bytes(value))
+        return _hash.hexdigest()
+
+    def path(self, key):
+        """
+        The path to the file where a statement is kept.
+
+        :param key: The digest of the statement
+        :return: File name
+        """
+        if not SHA256_HEX.match(key):
+            raise KeyError(key)
+
+        _parts = [key[i * self.width:(i + 1) * self.width]
+                  for i in range(self.levels)]
+        return os.path.join(self.fdir, *(_parts + [key]))
+
+    def add(self, value):
+        """
+        Store a statement.
+
+        :param value: A signed metadata statement
+        :return: The digest the statement can be found under
+        """
+        _key = self.hash(value)
+        self[_key] = value
+        return _key
+
+    def __setitem__(self, key, value):
+        if key != self.hash(value):
+            raise ValueError('Key does not match the digest of the value')
+
+        if self.backend is not None:
+            self.path(key)  # Only to check the key
+            self.backend[key] = value
+            self._cache.set(key, value)
+            return
+
+        fname = self.path(key)
+        if not os.path.isfile(fname):  # Content addressed so never changed
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            write_atomic(fname, value)
+
+        # If the file was there it may still be missing from the index, if
+        # the writer was interrupted.
+        self._read_index()
+        if key not in self._keys:
+            self._append_index(key)
+        self._cache.set(key, value)
+
+    def _append_index(self, key):
+        # One short write with O_APPEND, so lines from concurrent writers
+        # are not interleaved.
+        fd = os.open(self.index_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                     0o666)
+        try:
+            os.write(fd, as_bytes('{}\n'.format(key)))
+        finally:
+            os.close(fd)
+
+    def __getitem__(self, item):
+        """
+        Return the statement with the given digest.
+
+        :param item: The digest
+        :return: The signed metadata statement
+        """
+        _val = self._cache.get(item)
+        if _val is not None:
+            return _val
+
+        if self.backend is not None:
+            self.path(item)  # Only to check the key
+            _val = self.backend[item]
+        else:
+            try:
+                with open(self.path(item), 'r') as fp:
+                    _val = fp.read()
+            except (FileNotFoundError, NotADirectoryError):
+                raise KeyError(item)
+
+        self._cache.set(item, _val)
+        return _val
+
+    def __contains__(self, item):
+        try:
+            _fname = self.path(item)
+        except KeyError:
+            return False
+
+        if item in self._cache:
+            return True
+        elif self.backend is not None:
+            return item in self.backend
+        return os.path.isfile(_fname)
+
+    def _read_index(self):
+        """
+        Read what has been appended to the index since the last time.
+        """
+        with self._lock:
+            try:
+                with open(self.index_file, 'rb') as fp:
+                    if os.fstat(fp.fileno()).st_size < self._offset:
+                        # Cleared by someone else, start over
+                        self._keys = {}
+                        self._offset = 0
+                    fp.seek(self._offset)
+                    _data = fp.read()
+            except FileNotFoundError:
+                self._keys = {}
+                self._offset = 0
+                return
+
+            # Only complete lines
+            _end = _data.rfind(b'\n') + 1
+            for line in _data[:_end].decode('ascii').split('\n'):
+                if line:
+                    self._keys[line] = None
+            self._offset += _end
+
+    def keys(self):
+        if self.backend is not None:
+            return list(self.backend.keys())
+        self._read_index()
+        return list(self._keys.keys())
+
+    def items(self):
+        for key in self.keys():
+            try:
+                yield key, self[key]
+            except KeyError:  # Removed by someone else
+                continue
+
+    def __len__(self):
+        if self.backend is not None:
+            return len(self.backend)
+        self._read_index()
+        return len(self._keys)
+
+    def clear(self):
+        """
+        Remove all the statements and the index.
+        """
+        if self.backend is not None:
+            self.backend.clear()
+            self._cache.clear()
+            return
+
+        with self._lock:
+            for f in os.listdir(self.fdir):
+                fname = os.path.join(self.fdir, f)
+                if os.path.isdir(fname):
+                    shutil.rmtree(fname, ignore_errors=True)
+                elif f == INDEX:
+                    os.unlink(fname)
+            self._keys = {}
+            self._offset = 0
+            self._cache.clear()
@@ -1,20 +1,27 @@
-import copy
+import concurrent.futures
 import json
 import logging
+import threading
 import time
 
 from fedoidc import ClientMetadataStatement
+from fedoidc import CompactJWS
 from fedoidc import DoNotCompare
 from fedoidc import IgnoreKeys
+from fedoidc import JWKS_CACHE
 from fedoidc import MetadataStatementError
-from fedoidc import is_lesser
-from fedoidc import unfurl
+from fedoidc import compile_policy
+from fedoidc import instrument
+from fedoidc import shallow_copy_message
+from fedoidc.bundle import KeyIndex
+from fedoidc.bundle import shallow_copy_keyjar
 from jwkest import BadSignature
 from jwkest.jws import JWSException
 
 from oic.oauth2.message import Message
 from oic.oauth2.message import MissingSigningKey
 from oic.utils.jwt import JWT
+from oic.utils.keyio import KeyJar
 from oic.utils.keyio import build_keyjar
 
 __author__ = 'roland'
@@ -62,9 +69,11 @@ class LessOrEqual(object):
         self.le = {}
         self.exp = exp
         self.signing_keys = skeys
+        self._policy = {}
 
     def __setitem__(self, key, value):
         self.le[key] = value
+        self._policy.pop(key, None)
 
     def keys(self):
         return self.le.keys()
@@ -78,6 +87,21 @@ class LessOrEqual(object):
     def __contains__(self, item):
         return item in self.le
 
+    def policy(self, claim):
+        """
+        The compiled policy for a claim in this statement. Policies are
+        compiled the first time they are needed.
+
+        :param claim: Claim name
+        :return: A function as returned by :py:func:`fedoidc.compile_policy`
+        """
+        try:
+            return self._policy[claim]
+        except KeyError:
+            _policy = compile_policy(self.le[claim])
+            self._policy[claim] = _policy
+            return _policy
+
     def sup_items(self):
         """
         Items (key+values) from the superior        
@@ -102,7 +126,7 @@ class LessOrEqual(object):
             if k in DoNotCompare:
                 continue
             if k in orig:
-                if is_lesser(orig[k], v):
+                if self.sup.policy(k)(orig[k]):
                     _le[k] = v
                 else:
                     _err.append({'claim': k, 'policy': orig[k], 'err': v,
@@ -118,6 +142,7 @@ class LessOrEqual(object):
 
         self.le = _le
         self.err = _err
+        self._policy = {}
 
     def protected_claims(self):
         """
@@ -169,7 +194,8 @@ class Operator(object):
     """
 
     def __init__(self, keyjar=None, jwks_bundle=None, httpcli=None, iss=None,
-            lifetime=0):
+            lifetime=0, statement_cache=None, executor=None,
+            uri_cache=None, evaluation_cache=None):
         """
 
         :param keyjar: Contains the operators signing keys
@@ -180,6 +206,17 @@ class Operator(object):
             fetched from somewhere else
         :param iss: Issuer ID
         :param lifetime: Default lifetime of the signed statements
+        :param statement_cache: Where verified inner metadata statements are
+            kept. If present it MUST be a
+            :py:class:`fedoidc.cache.VerifiedStatementCache` instance.
+        :param executor: If given, a :py:class:`concurrent.futures.Executor`
+            instance (a thread pool) that is used to fetch and verify sibling
+            metadata statements concurrently.
+        :param uri_cache: If given, a :py:class:`fedoidc.cache.URICache`
+            instance through which metadata_statement_uris are fetched.
+        :param evaluation_cache: If given, a
+            :py:class:`fedoidc.cache.EvaluationCache` instance in which the
+            flattened result of inner metadata statements are kept.
         """
         self.keyjar = keyjar
         self.jwks_bundle = jwks_bundle
@@ -187,6 +224,11 @@ class Operator(object):
         self.iss = iss
         self.failed = {}
         self.lifetime = lifetime
+        self.statement_cache = statement_cache
+        self.executor = executor
+        self.uri_cache = uri_cache
+        self.evaluation_cache = evaluation_cache
+        self._local = threading.local()
 
     def signing_keys_as_jwks(self):
         """
@@ -200,22 +242,166 @@ class Operator(object):
                   self.keyjar.get_signing_key(owner=self.iss)]
         return {'keys': _l}
 
-    def _ums(self, pr, meta_s, keyjar):
+    def _bundle_index(self):
+        try:
+            return self.jwks_bundle.key_index()
+        except AttributeError:
+            return None
+
+    def _verify_jwt(self, jws, key_index, cls):
+        """
+        Verify the signature of a signed metadata statement. The key to use
+        is picked by the issuer, kid and alg of the statement, only that
+        key is tried.
+
+        :param jws: A :py:class:`fedoidc.CompactJWS` instance
+        :param key_index: A :py:class:`fedoidc.bundle.KeyIndex` over a
+            keyjar with the necessary keys
+        :param cls: What class to map the metadata into
+        :return: An instance of cls
+        """
+        _header = jws.header
+        _iss = jws.payload['iss']
+        _kid = _header.get('kid', '')
+        _key = key_index.get(_iss, _header.get('alg'), _kid)
+        if _key is None:
+            instrument.count('operator.key_index.miss')
+            raise MissingSigningKey(
+                'No key for iss={}, kid={}, alg={}'.format(
+                    _iss, _kid, _header.get('alg')))
+
+        _ms = cls().from_dict(jws.verify([_key]))
+        _ms.jwt = jws.jwt
+        _ms.jws_header = _header
+        return _ms
+
+    def _bundle_version(self):
         try:
-            _pi = self.unpack_metadata_statement(
-                jwt_ms=meta_s, keyjar=keyjar)
-        except (JWSException, BadSignature,
-                MissingSigningKey) as err:
-            logger.error('Encountered: {}'.format(err))
+            return self.jwks_bundle.version
+        except AttributeError:
+            return None
+
+    @instrument.timed('operator.verify')
+    def _verify_ms(self, meta_s, keyjar, version, key_index):
+        """
+        Unpack and verify one signed metadata statement.
+
+        :param meta_s: A signed metadata statement
+        :param keyjar: A keyjar with the necessary FO keys
+        :param version: The version of the JWKS bundle, None if keyjar was
+            not derived from the bundle.
+        :param key_index: A :py:class:`fedoidc.bundle.KeyIndex` over keyjar
+        :return: Tuple of ParseInfo instance and error, one of them None.
+        """
+        # Only verifications against the bundle's keys are shared, someone
+        # else's keyjar may hold other trust anchors.
+        _cache = self.statement_cache if version is not None else None
+        _pi = None
+        if _cache is not None:
+            _pi = _cache.get_statement(meta_s, version)
+            if _pi is None:
+                instrument.count('operator.statement_cache.miss')
+            else:
+                instrument.count('operator.statement_cache.hit')
+
+        if _pi is None:
+            try:
+                _jws = CompactJWS(meta_s)
+                _pi = self._unpack(_jws.payload, keyjar,
+                                   ClientMetadataStatement, meta_s,
+                                   jws=_jws, version=version,
+                                   key_index=key_index)
+            except (JWSException, BadSignature,
+                    MissingSigningKey) as err:
+                logger.error('Encountered: {}'.format(err))
+                return None, err
+
+            if _cache is not None and _pi.result:
+                _cache.set_statement(meta_s, _pi, version)
+
+        return _pi, None
+
+    @staticmethod
+    def _add_branch(pr, meta_s, pi, err):
+        if err is not None:
             pr.error[meta_s] = err
+            return pr
+
+        pr.branch[meta_s] = pi
+        if pi.result:
+            pr.parsed_statement.append(pi.result)
+            pr.signing_keys = pi.signing_keys
+        return pr
+
+    def _ums(self, pr, meta_s, keyjar, version, key_index):
+        _pi, _err = self._verify_ms(meta_s, keyjar, version, key_index)
+        return self._add_branch(pr, meta_s, _pi, _err)
+
+    @instrument.timed('operator.fetch')
+    def _fetch_ms(self, url):
+        """
+        Fetch a signed metadata statement.
+
+        :param url: Where the signed metadata statement can be found
+        :return: The signed metadata statement
+        """
+        if self.uri_cache is not None:
+            _jws = self.uri_cache.fetch(self.httpcli, url)
+            if _jws is None:
+                raise ParseError('Could not fetch jws from {}'.format(url))
+            return _jws
+
+        rsp = self.httpcli.http_request(url)
+        if rsp.status_code == 200:
+            return rsp.text
         else:
-            pr.branch[meta_s] = _pi
-            if _pi.result:
-                pr.parsed_statement.append(_pi.result)
-                pr.signing_keys = _pi.signing_keys
+            raise ParseError('Could not fetch jws from {}'.format(url))
+
+    def _branch(self, meta_s, url, keyjar, version, key_index):
+        """
+        Fetch, if necessary, and verify a signed metadata statement.
+        Run by the executor.
+        """
+        self._local.in_branch = True
+        try:
+            if url:
+                meta_s = self._fetch_ms(url)
+            return meta_s, self._verify_ms(meta_s, keyjar, version,
+                                           key_index)
+        finally:
+            self._local.in_branch = False
+
+    def _unpack_branches(self, pr, branches, keyjar, version, key_index):
+        """
+        Fetch and verify all the sibling metadata statements concurrently.
+        The result is added to the ParseInfo instance in the same order as
+        if it had been done sequentially.
+
+        :param pr: ParseInfo instance
+        :param branches: list of tuples (signed metadata statement, URL)
+        :param keyjar: A keyjar with the necessary FO keys
+        :param version: The version of the JWKS bundle
+        :param key_index: A :py:class:`fedoidc.bundle.KeyIndex` over keyjar
+        :return: ParseInfo instance
+        """
+        # Each branch gets its own KeyJar since they are not allowed to
+        # affect each other. Its index falls back on the one for keyjar.
+        _futures = []
+        for _ms, _url in branches:
+            _kj = shallow_copy_keyjar(keyjar)
+            _futures.append(
+                self.executor.submit(self._branch, _ms, _url, _kj, version,
+                                     KeyIndex(_kj, key_index)))
+        concurrent.futures.wait(_futures)
+
+        for _fut in _futures:
+            meta_s, (_pi, _err) = _fut.result()
+            pr = self._add_branch(pr, meta_s, _pi, _err)
         return pr
 
-    def _unpack(self, json_ms, keyjar, cls, jwt_ms=None, liss=None):
+    @instrument.timed('operator.unpack')
+    def _unpack(self, json_ms, keyjar, cls, jwt_ms=None, liss=None,
+                jws=None, version=None, key_index=None):
         """
         
         :param json_ms: Metadata statement as a JSON document 
@@ -223,20 +409,29 @@ class Operator(object):
         :param cls: What class to map the metadata into
         :param jwt_ms: Metadata statement as a JWS 
         :param liss: List of FO issuer IDs
+        :param jws: jwt_ms as a :py:class:`fedoidc.CompactJWS` instance
+        :param version: The version of the JWKS bundle, looked up once for
+            the whole chain of metadata statements. None if keyjar was not
+            derived from the bundle.
+        :param key_index: A :py:class:`fedoidc.bundle.KeyIndex` over keyjar,
+            also built once for the whole chain.
         :return: ParseInfo instance
         """
         if liss is None:
             liss = []
+        if key_index is None:
+            key_index = KeyIndex(keyjar)
 
         _pr = ParseInfo()
         _pr.input = json_ms
         ms_flag = False
+        _branches = []
         if 'metadata_statements' in json_ms:
             ms_flag = True
             for iss, _ms in json_ms['metadata_statements'].items():
                 if liss and iss not in liss:
                     continue
-                _pr = self._ums(_pr, _ms, keyjar)
+                _branches.append((_ms, None))
 
         if 'metadata_statement_uris' in json_ms:
             ms_flag = True
@@ -244,26 +439,38 @@ class Operator(object):
                 for iss, url in json_ms['metadata_statement_uris'].items():
                     if liss and iss not in liss:
                         continue
-                    rsp = self.httpcli.http_request(url)
-                    if rsp.status_code == 200:
-                        _pr = self._ums(_pr, rsp.text, keyjar)
-                    else:
-                        raise ParseError(
-                            'Could not fetch jws from {}'.format(url))
+                    _branches.append((None, url))
+
+        if self.executor and len(_branches) > 1 and not getattr(
+                self._local, 'in_branch', False):
+            _pr = self._unpack_branches(_pr, _branches, keyjar, version,
+                                        key_index)
+        else:
+            for _ms, _url in _branches:
+                if _url:
+                    _ms = self._fetch_ms(_url)
+                _pr = self._ums(_pr, _ms, keyjar, version, key_index)
 
         for _ms in _pr.parsed_statement:
             if _ms:  # can be None
                 try:
-                    keyjar.import_jwks(_ms['signing_keys'], json_ms['iss'])
+                    keyjar.add_kb(json_ms['iss'],
+                                  JWKS_CACHE.key_bundle(_ms['signing_keys']))
                 except KeyError:
                     pass
+                except ValueError as err:
+                    # Keys that can't be used, nothing can be verified
+                    # with them.
+                    logger.error('Encountered: {}'.format(err))
 
         if ms_flag is True and not _pr.parsed_statement:
             return _pr
 
         if jwt_ms:
             try:
-                _pr.result = cls().from_jwt(jwt_ms, keyjar=keyjar)
+                if jws is None:
+                    jws = CompactJWS(jwt_ms)
+                _pr.result = self._verify_jwt(jws, key_index, cls)
             except (JWSException, BadSignature, MissingSigningKey,
                     KeyError) as err:
                 logger.error('Encountered: {}'.format(err))
@@ -287,6 +494,8 @@ class Operator(object):
                     except KeyError:
                         continue
                     else:
+                        # Statements further in may expire earlier
+                        _exp = min(_exp, getattr(x, 'expires', 0) or _exp)
                         if isinstance(_prr, Message):
                             try:
                                 _expires = _prr.expires
@@ -322,17 +531,29 @@ class Operator(object):
         :return: A ParseInfo instance
         """
 
-        if not keyjar:
-            keyjar = self.jwks_bundle.as_keyjar()
-
+        if keyjar:
+            # The caller's own keys, not the bundle's, so the statement
+            # cache can not be used.
+            _version = None
+            _key_index = KeyIndex(keyjar)
+        else:
+            # Looking up the version may mean checking the file system, so
+            # it's only done once for all the statements in the chain.
+            _version = self._bundle_version()
+            # Only holds the keys picked up on the way, the bundle's keys
+            # are looked up by the index when they are needed.
+            keyjar = KeyJar()
+            _key_index = KeyIndex(keyjar, self._bundle_index())
+
+        _jws = None
         if jwt_ms:
-            try:
-                json_ms = unfurl(jwt_ms)
-            except JWSException:
-                raise
+            # Decoded once, the payload is also used when verifying
+            _jws = CompactJWS(jwt_ms)
+            json_ms = _jws.payload
 
         if json_ms:
-            return self._unpack(json_ms, keyjar, cls, jwt_ms, liss)
+            return self._unpack(json_ms, keyjar, cls, jwt_ms, liss, _jws,
+                                _version, _key_index)
         else:
             raise AttributeError('Need one of json_ms or jwt_ms')
 
@@ -360,8 +581,8 @@ class Operator(object):
         if lifetime == -1:
             lifetime = self.lifetime
 
-        # Own copy
-        _metadata = copy.deepcopy(metadata)
+        # Own copy, the claims added below must not show up in metadata
+        _metadata = shallow_copy_message(metadata)
         _metadata.update(kwargs)
         _jwt = JWT(keyjar, iss=iss, msgtype=_metadata.__class__,
                    lifetime=lifetime)
@@ -378,6 +599,41 @@ class Operator(object):
         else:
             return _jwt.pack(cls_instance=_metadata, owner=owner)
 
+    def _flatten(self, ms):
+        """
+        Evaluate an inner metadata statement. If there is an evaluation
+        cache the result is looked up there first using the signed JWT the
+        statement was verified from.
+
+        :param ms: The inner metadata statement as a JSON document or a
+            dictionary
+        :return: Tuple of a list of LessOrEqual instances, the expiration
+            time of the statement and its signing keys.
+        """
+        _key = None
+        if self.evaluation_cache is not None:
+            _key = self.evaluation_cache.key(ms)
+            _res = self.evaluation_cache.get_flattened(_key)
+            if _res is not None:
+                instrument.count('operator.evaluation_cache.hit')
+                return _res
+            instrument.count('operator.evaluation_cache.miss')
+
+        if isinstance(ms, str):
+            ms = json.loads(ms)
+
+        _les = self.evaluate_metadata_statement(ms)
+        try:
+            _skeys = ms['signing_keys']
+        except KeyError:
+            _skeys = None
+
+        if self.evaluation_cache is not None:
+            self.evaluation_cache.set_flattened(_key, _les, ms['exp'], _skeys)
+
+        return _les, ms['exp'], _skeys
+
+    @instrument.timed('operator.evaluate')
     def evaluate_metadata_statement(self, metadata, keyjar=None):
         """
         Computes the resulting metadata statement from a compounded metadata
@@ -393,36 +649,31 @@ class Operator(object):
 
         res = dict([(k, v) for k, v in metadata.items() if k not in IgnoreKeys])
 
-        les = []
+        try:
+            _iss = metadata['iss']
+        except KeyError:
+            _iss = None
 
-        if 'metadata_statements' in metadata:
-            for fo, ms in metadata['metadata_statements'].items():
-                if isinstance(ms, str):
-                    ms = json.loads(ms)
-                for _le in self.evaluate_metadata_statement(ms):
-                    try:
-                        _sign = metadata['iss']
-                    except KeyError:
-                        _sign = ''
-                    le = LessOrEqual(sup=_le, iss=_sign, exp=ms['exp'])
-                    try:
-                        le.signing_keys = ms['signing_keys']
-                    except KeyError:
-                        pass
-                    le.eval(res, _sign)
-                    les.append(le)
-            return les
-        else:  # this is the innermost
-            try:
-                _iss = metadata['iss']
-            except:
+        if 'metadata_statements' not in metadata:  # this is the innermost
+            if _iss is None:
                 le = LessOrEqual()
                 le.eval(res, '')
             else:
                 le = LessOrEqual(iss=_iss, exp=metadata['exp'])
                 le.eval(res, _iss)
-            les.append(le)
-            return les
+            return [le]
+
+        if _iss is None:
+            _iss = ''
+
+        les = []
+        for fo, ms in metadata['metadata_statements'].items():
+            _sups, _exp, _skeys = self._flatten(ms)
+            for _le in _sups:
+                le = LessOrEqual(sup=_le, iss=_iss, exp=_exp, skeys=_skeys)
+                le.eval(res, _iss)
+                les.append(le)
+        return les
 
     def correct_usage(self, metadata, federation_usage):
         """
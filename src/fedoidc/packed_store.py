@@ -0,0 +1,371 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+from fedoidc import instrument
+
+logger = logging.getLogger(__name__)
+
+#: Name of the log file within the directory
+LOG_NAME = 'store.log'
+
+# operation, key length, value length, crc32 of key and value
+RECORD_HEADER = struct.Struct('>BIII')
+OP_SET = 1
+OP_DELETE = 2
+
+
+class PackedFileSystem(object):
+    """
+    A dictionary like database, with the same interface as
+    :py:class:`fedoidc.file_system.FileSystem`, that keeps all the values in
+    one append-only log file.
+    An index from keys to offsets in the log is kept in memory and values
+    are read through a memory map of the log. Changes made by other
+    processes are picked up by reading what has been appended since the
+    last time. When too much of the log consists of overwritten or deleted
+    values it is compacted.
+    """
+
+    def __init__(self, fdir, key_conv=None, value_conv=None,
+                 compact_ratio=0.5, compact_min_size=1024 * 1024, lazy=True):
+        """
+        :param fdir: The directory where the log file is kept
+        :param key_conv: Converts to/from the key displayed by this class to
+            users of it to something that is stored in the log. A dictionary
+            with the keys ['to', 'from'].
+        :param value_conv: Converts values to/from strings. A dictionary
+            with the keys ['to', 'from'].
+        :param compact_ratio: The log is compacted when this fraction of it
+            is garbage.
+        :param compact_min_size: Logs smaller than this, in bytes, are never
+            compacted.
+        :param lazy: Only there for compatibility with FileSystem, values are
+            always converted the first time they are asked for.
+        """
+        self.fdir = fdir
+        self.fname = os.path.join(fdir, LOG_NAME)
+        self.key_conv = key_conv or {}
+        self.value_conv = value_conv or {}
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        # Incremented every time a change in the database is noticed
+        self.version = 0
+
+        self.index = {}  # key -> (offset of value, length of value)
+        self.db = {}  # key -> decoded value
+        self.garbage = 0
+        self._end = 0  # End of the last complete record read
+        self._fd = None
+        self._ino = None
+        self._mmap = None
+        self._lock = threading.RLock()
+
+        if not os.path.isdir(fdir):
+            os.makedirs(fdir, exist_ok=True)
+        self._open(repair=True)
+
+    def _open(self, repair=False):
+        if self._fd is not None:
+            self.close()
+
+        self._fd = os.open(self.fname, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                           0o666)
+        self._ino = os.fstat(self._fd).st_ino
+        self.index = {}
+        self.db = {}
+        self.garbage = 0
+        self._end = 0
+        if repair:
+            # Remove what is left of a write that was interrupted.
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._scan()
+                if os.fstat(self._fd).st_size > self._end:
+                    logger.warning('Truncating {} at {}'.format(self.fname,
+                                                                self._end))
+                    os.ftruncate(self._fd, self._end)
+                    self._remap(self._end)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            self._scan()
+        self.version += 1
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _remap(self, size):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if size:
+            self._mmap = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+
+    def _scan(self):
+        """
+        Read the records appended to the log since the last scan and update
+        the index.
+
+        :return: True if something was read.
+        """
+        _size = os.fstat(self._fd).st_size
+        if _size <= self._end:
+            return False
+
+        if self._mmap is None or len(self._mmap) < _size:
+            self._remap(_size)
+
+        _mm = self._mmap
+        _pos = self._end
+        _changed = False
+        while _pos + RECORD_HEADER.size <= _size:
+            op, klen, vlen, crc = RECORD_HEADER.unpack_from(_mm, _pos)
+            _kstart = _pos + RECORD_HEADER.size
+            _vstart = _kstart + klen
+            _next = _vstart + vlen
+            if op not in (OP_SET, OP_DELETE) or _next > _size:
+                break
+            if zlib.crc32(_mm[_kstart:_next]) & 0xffffffff != crc:
+                break
+
+            key = _mm[_kstart:_vstart].decode('utf8')
+            try:
+                self.garbage += self._record_size(key, self.index[key][1])
+            except KeyError:
+                pass
+
+            if op == OP_SET:
+                self.index[key] = (_vstart, vlen)
+            else:
+                self.garbage += _next - _pos
+                self.index.pop(key, None)
+            self.db.pop(key, None)
+            _pos = _next
+            _changed = True
+
+        self._end = _pos
+        if _changed:
+            self.version += 1
+        return _changed
+
+    @staticmethod
+    def _record_size(key, vlen):
+        return RECORD_HEADER.size + len(key.encode('utf8')) + vlen
+
+    @staticmethod
+    def _record(op, key, value=b''):
+        _body = key + value
+        return RECORD_HEADER.pack(
+            op, len(key), len(value),
+            zlib.crc32(_body) & 0xffffffff) + _body
+
+    def _replaced(self):
+        """
+        Check if the log has been replaced by a compaction.
+        """
+        try:
+            return os.stat(self.fname).st_ino != self._ino
+        except FileNotFoundError:
+            return True
+
+    @instrument.timed('file_system.sync')
+    def sync(self):
+        """
+        Pick up changes made by others.
+        """
+        with self._lock:
+            if self._replaced():
+                self._open()
+            else:
+                self._scan()
+
+    @contextmanager
+    def _write_lock(self):
+        """
+        Lock the log against other writers. If the log was replaced while
+        waiting for the lock, the new one is opened and locked instead.
+        """
+        while True:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            if not self._replaced():
+                break
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._open()
+
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _append(self, data):
+        with self._write_lock():
+            os.write(self._fd, data)
+            self._scan()
+
+    def _to_key(self, key):
+        try:
+            return self.key_conv['to'](key)
+        except KeyError:
+            return key
+
+    def _from_key(self, key):
+        try:
+            return self.key_conv['from'](key)
+        except KeyError:
+            return key
+
+    @instrument.timed('file_system.read')
+    def _read_info(self, key):
+        _offset, _len = self.index[key]
+        info = self._mmap[_offset:_offset + _len].decode('utf8')
+        try:
+            info = self.value_conv['from'](info)
+        except KeyError:
+            pass
+        return info
+
+    def __getitem__(self, item):
+        """
+        Return the value bound to an identifier.
+
+        :param item: The identifier.
+        :return:
+        """
+        with self._lock:
+            self.sync()
+            return self._get(self._to_key(item))
+
+    def _get(self, key):
+        try:
+            return self.db[key]
+        except KeyError:
+            _val = self._read_info(key)
+            self.db[key] = _val
+            return _val
+
+    def __setitem__(self, key, value):
+        """
+        Binds a value to a specific key.
+
+        :param key: Identifier
+        :param value: Value that should be bound to the identifier.
+        """
+        _key = self._to_key(key)
+        try:
+            _val = self.value_conv['to'](value)
+        except KeyError:
+            _val = value
+
+        with self._lock:
+            self._append(self._record(OP_SET, _key.encode('utf8'),
+                                      _val.encode('utf8')))
+            self.db[_key] = value
+            self._maybe_compact()
+
+    def __delitem__(self, key):
+        _key = self._to_key(key)
+        with self._lock:
+            self.sync()
+            if _key not in self.index:
+                raise KeyError(key)
+            self._append(self._record(OP_DELETE, _key.encode('utf8')))
+            self._maybe_compact()
+
+    def __contains__(self, item):
+        with self._lock:
+            self.sync()
+            return self._to_key(item) in self.index
+
+    def __len__(self):
+        with self._lock:
+            self.sync()
+            return len(self.index)
+
+    def keys(self):
+        """
+        Implements the dict.keys() method
+        """
+        with self._lock:
+            self.sync()
+            _keys = list(self.index.keys())
+        for k in _keys:
+            yield self._from_key(k)
+
+    def items(self):
+        """
+        Implements the dict.items() method
+        """
+        with self._lock:
+            self.sync()
+            _keys = list(self.index.keys())
+        for k in _keys:
+            with self._lock:
+                try:
+                    _val = self._get(k)
+                except KeyError:  # removed in between
+                    continue
+            yield self._from_key(k), _val
+
+    def update(self, ava):
+        """
+        Implements the dict.update() method
+        """
+        for key, val in ava.items():
+            self[key] = val
+
+    def clear(self):
+        """
+        Removes everything.
+        """
+        with self._lock:
+            with self._write_lock():
+                self._rewrite({})
+            self._open()
+
+    def _maybe_compact(self):
+        if self._end < self.compact_min_size:
+            return
+        if self.garbage < self._end * self.compact_ratio:
+            return
+        self.compact()
+
+    def compact(self):
+        """
+        Rewrite the log with only the current values in it.
+        """
+        with self._lock:
+            with self._write_lock():
+                self._scan()
+                _live = dict(
+                    [(k, self._mmap[o:o + l]) for k, (o, l) in
+                     self.index.items()])
+                self._rewrite(_live)
+            self._open()
+
+    def _rewrite(self, live):
+        """
+        Write a new log, containing the given keys and encoded values, and
+        atomically replace the old one with it.
+        The caller must hold the lock on the old log.
+
+        :param live: Dictionary with keys and encoded values
+        """
+        _tmp = '{}.tmp.{}'.format(self.fname, os.getpid())
+        with open(_tmp, 'wb') as fp:
+            for key, val in live.items():
+                fp.write(self._record(OP_SET, key.encode('utf8'), val))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(_tmp, self.fname)
@@ -9,6 +9,9 @@ from oic.utils.keyio import KeyJar
 
 from fedoidc import ClientMetadataStatement
 from fedoidc import KeyBundle
+from fedoidc import shallow_copy_message
+from fedoidc import unfurl
+from fedoidc.bundle import keyjar_version
 from fedoidc.signing_service import SigningServiceError
 
 from oic.oauth2 import error
@@ -35,7 +38,15 @@ class Provider(provider.Provider):
             jwks_uri='', jwks_name='', baseurl=None, client_cert=None,
             federation_entity=None, fo_priority=None,
             response_metadata_statements=None, signer=None,
-            signed_jwks_uri=''):
+            signed_jwks_uri='', pi_cache=None, key_fetcher=None,
+            jwks_cache=None):
+        if key_fetcher is not None and jwks_cache is not None:
+            # The cache creates the key bundles, it has to be given the
+            # key fetcher.
+            raise ValueError(
+                'Either key_fetcher or jwks_cache, not both. Give the key '
+                'fetcher to the SignedJWKSCache instead.')
+
         provider.Provider.__init__(
             self, name, sdb, cdb, authn_broker, userinfo, authz,
             client_authn, symkey, urlmap=urlmap, ca_certs=ca_certs,
@@ -50,6 +61,14 @@ class Provider(provider.Provider):
         self.signer = signer
         self.signed_jwks_uri = signed_jwks_uri
         self.federation = ''
+        # A fedoidc.cache.SignedDocumentCache instance
+        self.pi_cache = pi_cache
+        # A fedoidc.key_fetcher.KeyFetcher instance, if present the keys
+        # behind a client's signed_jwks_uri are fetched in the background.
+        self.key_fetcher = key_fetcher
+        # A fedoidc.key_fetcher.SignedJWKSCache instance, shared by all
+        # clients with the same signed_jwks_uri and signing keys.
+        self.jwks_cache = jwks_cache
 
     def get_signed_keys(self, uri, signing_keys):
         """
@@ -58,6 +77,9 @@ class Provider(provider.Provider):
         :param signing_keys: Dictionary representation of a JWKS
         :return: list of KeyBundle instances or None
         """
+        if self.jwks_cache is not None:
+            return [self.jwks_cache.key_bundle(uri, signing_keys)]
+
         r = self.server.http_request(uri, allow_redirects=True)
         if r.status_code == 200:
             _skj = KeyJar()
@@ -123,15 +145,81 @@ class Provider(provider.Provider):
         fp.close()
         return ''.join([self.baseurl, file_name])
 
+    def _pi_state(self, context):
+        """
+        Describes what a signed provider info document depends on. The
+        signing keys in use and the signed metadata statements available.
+        Only change counters are compared, the keys are not looked at.
+        With a watched FileSystem for the signed metadata statements this
+        does not touch the file system.
+        Of the OP's KeyJar only its own keys are used, the keys of the
+        registered clients do not matter.
+        """
+        _signer = self.federation_entity.signer
+        _kjs = [self.federation_entity.keyjar]
+        try:
+            _kjs.append(_signer.signing_service.signing_keys)
+        except AttributeError:
+            pass
+
+        _state = [keyjar_version(kj) for kj in _kjs if kj is not None]
+        if self.keyjar is not None:
+            _state.append(keyjar_version(self.keyjar, issuers=['']))
+        return tuple(_state), _signer.version(context)
+
+    @staticmethod
+    def _pi_expires(pcr):
+        """
+        The time the first of the signed metadata statements in a provider
+        info document expires.
+        """
+        _exp = 0
+        try:
+            _sms = pcr['metadata_statements']
+        except KeyError:
+            return _exp
+
+        for _jws in _sms.values():
+            try:
+                _e = unfurl(_jws)['exp']
+            except KeyError:
+                continue
+            if not _exp or _e < _exp:
+                _exp = _e
+        return _exp
+
     def create_fed_providerinfo(self, fos=None, pi_args=None, signed=True):
         """
         Create federation aware provider info.
+        If a signed document cache is configured the document is only
+        created when the signing keys or the signed metadata statements
+        change or when it is about to expire.
 
         :param fos: Which Federation Operators to use, None means all.
         :param pi_args: Extra provider info claims.
         :return: oic.oic.ProviderConfigurationResponse instance 
         """
 
+        if self.pi_cache is None:
+            return self._create_fed_providerinfo(fos, pi_args)
+
+        if fos is not None:
+            _fos = tuple(sorted(fos))
+        else:
+            _fos = None
+
+        _key = (_fos, json.dumps(pi_args, sort_keys=True, default=str),
+                'discovery')
+
+        def _build():
+            pcr = self._create_fed_providerinfo(fos, pi_args)
+            return pcr, self._pi_expires(pcr)
+
+        # The cached document is shared, callers get their own copy
+        return shallow_copy_message(
+            self.pi_cache.get(_key, self._pi_state('discovery'), _build))
+
+    def _create_fed_providerinfo(self, fos=None, pi_args=None):
         pcr = self.create_providerinfo(setup=pi_args)
 
         if self.federation_entity.signer.signing_service:
@@ -228,10 +316,19 @@ class Provider(provider.Provider):
                 **ms.unprotected_and_protected_claims())
         result = self.client_registration_setup(request)
         if 'signed_jwks_uri' in _pc:
-            _kb = KeyBundle(source=_pc['signed_jwks_uri'],
-                            verify_keys=ms.signing_keys,
-                            verify_ssl=False)
-            _kb.do_remote()
+            if self.jwks_cache is not None:
+                _kb = self.jwks_cache.key_bundle(_pc['signed_jwks_uri'],
+                                                 ms.signing_keys,
+                                                 verify_ssl=False)
+            elif self.key_fetcher is None:
+                _kb = KeyBundle(source=_pc['signed_jwks_uri'],
+                                verify_keys=ms.signing_keys,
+                                verify_ssl=False)
+                _kb.do_remote()
+            else:
+                _kb = self.key_fetcher.key_bundle(_pc['signed_jwks_uri'],
+                                                  verify_keys=ms.signing_keys,
+                                                  verify_ssl=False)
             replace_jwks_key_bundle(self.keyjar, result['client_id'], _kb)
             result['signed_jwks_uri'] = _pc['signed_jwks_uri']
 
@@ -1,20 +1,29 @@
-import copy
+import asyncio
+import concurrent.futures
 import json
 import logging
 import os
+import uuid
 from urllib.parse import quote_plus
 from urllib.parse import unquote_plus
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fedoidc import CONTEXTS
+from fedoidc import CompactJWS
 from fedoidc import MIN_SET
+from fedoidc import instrument
+from fedoidc import shallow_copy_message
 from fedoidc.file_system import FileSystem
-from jwkest import as_unicode
+from jwkest import BadSignature
 from jwkest.jws import JWSException
-from jwkest.jws import factory
+from jwkest.jws import NoSuitableSigningKeys
 
 from oic.oauth2 import Message
 from oic.utils.jwt import JWT
+from oic.utils.keyio import KeyBundle
+from oic.utils.time_util import utc_time_sans_frac
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +44,21 @@ class SigningService(object):
     def __call__(self, req, **kwargs):
         raise NotImplemented()
 
+    def sign_many(self, reqs, **kwargs):
+        """
+        Sign a batch of metadata statements.
+
+        :param reqs: List of :py:class:`MetadataStatement` instances
+        :param kwargs: Additional metadata statement attribute values, the
+            same for all the statements.
+        :return: List of signed JWTs in the same order as the requests
+        """
+        try:
+            del kwargs['processes']
+        except KeyError:
+            pass
+        return [self(req, **kwargs) for req in reqs]
+
     def name(self):
         raise NotImplemented()
 
@@ -59,7 +83,10 @@ class InternalSigningService(SigningService):
         self.signing_keys = signing_keys
         self.iss = iss
         self.lifetime = lifetime
+        # (state of the key jar, signing key), see _signing_key
+        self._prepared = None
 
+    @instrument.timed('signing_service.sign')
     def __call__(self, req, **kwargs):
         """
 
@@ -71,39 +98,152 @@ class InternalSigningService(SigningService):
         :param kwargs: Additional metadata statement attribute values
         :return: A JWT
         """
-        iss = self.iss
-        keyjar = self.signing_keys
-
-        # Own copy
-        _metadata = copy.deepcopy(req)
+        # Own copy, the claims added below must not show up in req
+        _metadata = shallow_copy_message(req)
         if self.add_ons:
             _metadata.update(self.add_ons)
 
-        _jwt = JWT(keyjar, iss=iss, msgtype=_metadata.__class__,
-                   lifetime=self.lifetime)
-        _jwt.sign_alg = self.alg
+        return _pack(_metadata, self._signing_key(), self.iss, self.alg,
+                     self.lifetime, **kwargs)
 
-        if iss in keyjar.issuer_keys:
-            owner = iss
+    def _owner(self):
+        if self.iss in self.signing_keys.issuer_keys:
+            return self.iss
         else:
-            owner = ''
+            return ''
 
-        if kwargs:
-            return _jwt.pack(cls_instance=_metadata, owner=owner, **kwargs)
-        else:
-            return _jwt.pack(cls_instance=_metadata, owner=owner)
+    def _keyjar_state(self, owner):
+        """
+        Something that changes if the set of keys the signing key is picked
+        from changes, or if one of them is deactivated.
+        """
+        _keys = []
+        for kb in self.signing_keys.issuer_keys.get(owner, []):
+            _keys.extend(kb.keys())
+        return (owner, self.alg, tuple(
+            [(id(k), bool(k.inactive_since)) for k in _keys])), _keys
+
+    def _signing_key(self):
+        """
+        Find the key to sign with. The key is picked the same way
+        :py:meth:`oic.utils.jwt.JWT.pack_key` does it but it is only done
+        again if the keys in the key jar have changed.
+
+        :return: A :py:class:`jwkest.jwk.Key` instance
+        """
+        _owner = self._owner()
+        _state, _keys = self._keyjar_state(_owner)
+        _prepared = self._prepared
+        if _prepared is not None and _prepared[0] == _state:
+            return _prepared[1]
+
+        _jwt = JWT(self.signing_keys, iss=self.iss, sign_alg=self.alg)
+        _key = _jwt.pack_key(owner=_owner)
+        # The keys are kept so their ids in the state aren't reused.
+        self._prepared = (_state, _key, _keys)
+        return _key
+
+    def sign_many(self, reqs, processes=0, **kwargs):
+        """
+        Sign a batch of metadata statements. The signing key is only looked
+        up once for the whole batch.
+
+        :param reqs: List of :py:class:`MetadataStatement` instances
+        :param processes: If larger then 1 the signing is spread out over
+            this number of processes.
+        :param kwargs: Additional metadata statement attribute values, the
+            same for all the statements.
+        :return: List of signed JWTs in the same order as the requests
+        """
+        _key = self._signing_key()
+
+        if processes > 1 and len(reqs) > 1:
+            _jwk = _key.serialize(private=True)
+            _size = -(-len(reqs) // processes)
+            _chunks = [
+                [(r.__class__, r.to_dict()) for r in reqs[i:i + _size]]
+                for i in range(0, len(reqs), _size)]
+            with concurrent.futures.ProcessPoolExecutor(processes) as _pool:
+                _futures = [
+                    _pool.submit(_sign_chunk, _jwk, self.iss, self.alg,
+                                 self.lifetime, self.add_ons, _chunk, kwargs)
+                    for _chunk in _chunks]
+                res = []
+                for _fut in _futures:
+                    res.extend(_fut.result())
+            return res
+
+        res = []
+        for req in reqs:
+            _metadata = shallow_copy_message(req)
+            if self.add_ons:
+                _metadata.update(self.add_ons)
+            res.append(_pack(_metadata, _key, self.iss, self.alg,
+                             self.lifetime, **kwargs))
+        return res
 
     def name(self):
         return self.iss
 
 
+def _pack(metadata, key, iss, alg, lifetime, **kwargs):
+    """
+    Add the JWT claims to a metadata statement and sign it.
+    Does the same as :py:meth:`oic.utils.jwt.JWT.pack` but with a signing
+    key that has already been picked.
+
+    :param metadata: A :py:class:`MetadataStatement` instance, will be
+        modified.
+    :param key: The signing key
+    :param iss: Issuer ID
+    :param alg: Signing algorithm
+    :param lifetime: Lifetime of the signed JWT
+    :param kwargs: Additional metadata statement attribute values
+    :return: A signed JWT
+    """
+    _iat = utc_time_sans_frac()
+    metadata.update({'iss': iss, 'iat': _iat, 'exp': _iat + lifetime,
+                     'kid': key.kid})
+    metadata.update(kwargs)
+
+    if 'jti' in metadata.c_param:
+        try:
+            metadata['jti'] = kwargs['jti']
+        except KeyError:
+            metadata['jti'] = uuid.uuid4().hex
+
+    return metadata.to_jwt([key], alg)
+
+
+def _sign_chunk(jwk, iss, alg, lifetime, add_ons, items, kwargs):
+    """
+    Sign a number of metadata statements in a separate process.
+
+    :param jwk: The signing key as a dictionary
+    :param items: List of (class, dictionary) tuples
+    :return: List of signed JWTs
+    """
+    _key = KeyBundle([jwk]).keys()[0]
+    res = []
+    for cls, _dict in items:
+        _metadata = cls(**_dict)
+        if add_ons:
+            _metadata.update(add_ons)
+        res.append(_pack(_metadata, _key, iss, alg, lifetime, **kwargs))
+    return res
+
+
 class WebSigningService(SigningService):
     """
     A client to a web base signing service.
     Uses HTTP Post to send the MetadataStatement to the service.
+    The HTTP connections to the service are pooled and kept alive between
+    calls.
     """
 
-    def __init__(self, iss, url, keyjar, add_ons=None, alg='RS256'):
+    def __init__(self, iss, url, keyjar, add_ons=None, alg='RS256',
+                 pool_size=10, timeout=10, retries=3, backoff_factor=0.3,
+                 verify_ssl=False):
         """
 
         :param iss: The issuer ID of the signer
@@ -112,44 +252,187 @@ class WebSigningService(SigningService):
         :param add_ons: Additional information the signing service must 
             add to the Metadata statement before signing it.
         :param alg: Signing algorithm 
+        :param pool_size: Max number of connections to keep open to the
+            signing service.
+        :param timeout: Seconds to wait for the signing service to respond,
+            or a (connect timeout, read timeout) tuple.
+        :param retries: Number of times a failed request will be retried
+        :param backoff_factor: Used to calculate the time to wait between
+            retries, see :py:class:`urllib3.util.retry.Retry`.
+        :param verify_ssl: Whether the signing service's TLS certificate
+            should be verified.
         """
         SigningService.__init__(self, add_ons=add_ons, alg=alg)
         self.url = url
         self.iss = iss
         self.keyjar = keyjar
+        self.timeout = timeout
+        self.verify_ssl = verify_ssl
+        self._verify_keys = None
+
+        self.session = requests.Session()
+        _adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size,
+            max_retries=_retry(retries, backoff_factor))
+        self.session.mount('http://', _adapter)
+        self.session.mount('https://', _adapter)
+
+    def verify_keys(self, refresh=False):
+        """
+        The keys that can be used to verify the signing service's
+        signatures. Picked from the keyjar the first time they are needed.
 
-    def __call__(self, req, **kwargs):
-        r = requests.post(self.url, json=req, verify=False)
-        if 200 <= r.status_code < 300:
-            _jw = factory(r.text)
+        :param refresh: Pick them from the keyjar again
+        :return: list of keys
+        """
+        if refresh or self._verify_keys is None:
+            self._verify_keys = self.keyjar.get_verify_key(owner=self.iss)
+        return self._verify_keys
 
-            # First Just checking the issuer ID *not* verifying the Signature
-            body = json.loads(as_unicode(_jw.jwt.part[1]))
-            assert body['iss'] == self.iss
+    def verify(self, sms):
+        """
+        Verify a signed metadata statement returned by the signing service.
 
-            # Now verifying the signature
+        :param sms: A signed metadata statement
+        :return: The body of the signed metadata statement
+        """
+        _jws = CompactJWS(sms)
+
+        # First Just checking the issuer ID *not* verifying the Signature
+        body = _jws.payload
+        if body.get('iss') != self.iss:
+            raise JWSException('Unexpected issuer: {}'.format(body.get('iss')))
+
+        # Now verifying the signature
+        try:
             try:
-                _jw.verify_compact(r.text,
-                                   self.keyjar.get_verify_key(
-                                       owner=self.iss))
-            except AssertionError:
-                raise JWSException('JWS signature verification error')
+                _jws.verify(self.verify_keys())
+            except (NoSuitableSigningKeys, BadSignature):
+                # The keys might have been rotated
+                _jws.verify(self.verify_keys(refresh=True))
+        except BadSignature:
+            raise JWSException('JWS signature verification error')
+
+        return body
 
+    @instrument.timed('signing_service.sign')
+    def _post(self, body):
+        """
+        Send a signing request to the signing service.
+
+        :param body: The request as a JSON document
+        :return: The verified signed metadata statement
+        """
+        r = self.session.post(self.url, data=body, verify=self.verify_ssl,
+                              timeout=self.timeout,
+                              headers={'Content-Type': 'application/json'})
+        if 200 <= r.status_code < 300:
+            self.verify(r.text)
             return r.text
         else:
             raise SigningServiceError("{}: {}".format(r.status_code, r.text))
 
+    def __call__(self, req, **kwargs):
+        return self._post(canonical_json(req))
+
+    def close(self):
+        self.session.close()
+
     def name(self):
         return self.url
 
 
+class AsyncWebSigningService(WebSigningService):
+    """
+    A client to a web based signing service for use with asyncio.
+    Many signing requests can be outstanding at the same time. Identical
+    requests (same canonical JSON document) that are in flight at the same
+    time are coalesced into one HTTP request and share the response.
+    The blocking HTTP requests are run in an executor. An instance
+    should only be used from one event loop.
+    """
+
+    def __init__(self, iss, url, keyjar, add_ons=None, alg='RS256',
+                 executor=None, **kwargs):
+        """
+        :param executor: A :py:class:`concurrent.futures.Executor` instance
+            to run the HTTP requests in. If None the event loop's default
+            executor is used.
+        :param kwargs: Connection pool arguments,
+            see :py:class:`WebSigningService`
+        """
+        WebSigningService.__init__(self, iss, url, keyjar, add_ons=add_ons,
+                                   alg=alg, **kwargs)
+        self.executor = executor
+        self._in_flight = {}
+
+    async def sign(self, req):
+        """
+        Have a metadata statement signed by the signing service.
+
+        :param req: The metadata statement, a dictionary or a
+            :py:class:`MetadataStatement` instance
+        :return: The verified signed metadata statement
+        """
+        _body = canonical_json(req)
+        try:
+            _fut = self._in_flight[_body]
+        except KeyError:
+            _loop = asyncio.get_running_loop()
+            _fut = _loop.run_in_executor(self.executor, self._post, _body)
+            self._in_flight[_body] = _fut
+            _fut.add_done_callback(
+                lambda f: self._in_flight.pop(_body, None))
+
+        # One waiter being cancelled must not affect the others
+        return await asyncio.shield(_fut)
+
+    async def sign_many_async(self, reqs):
+        """
+        Sign a number of metadata statements concurrently.
+
+        :param reqs: List of metadata statements
+        :return: List of signed metadata statements in the same order as
+            the requests.
+        """
+        return await asyncio.gather(*[self.sign(req) for req in reqs])
+
+
+def canonical_json(req):
+    """
+    A JSON document where the keys are sorted and no unnecessary white space
+    is used.
+
+    :param req: A dictionary or a :py:class:`oic.oauth2.message.Message`
+        instance
+    :return: JSON document
+    """
+    if isinstance(req, Message):
+        req = req.to_dict()
+    return json.dumps(req, sort_keys=True, separators=(',', ':'))
+
+
+def _retry(retries, backoff_factor):
+    """
+    Retry policy for the requests to a signing service. Signing is
+    idempotent so POST requests can safely be retried.
+    """
+    _args = {'total': retries, 'backoff_factor': backoff_factor,
+             'status_forcelist': (502, 503, 504)}
+    try:
+        return Retry(allowed_methods=False, **_args)
+    except TypeError:  # urllib3 < 1.26
+        return Retry(method_whitelist=False, **_args)
+
+
 class Signer(object):
     """
     A signer. Has no or one signing services it can use.
     Keeps a dictionary with the created signed metadata statements.
     """
 
-    def __init__(self, signing_service=None, ms_dir=None, def_context=''):
+    def __init__(self, signing_service=None, ms_dir=None, def_context='',
+                 fs_cls=FileSystem):
         """
         
         :param signing_service: Which signing service this signer can use. 
@@ -159,6 +442,9 @@ class Signer(object):
             One per operations where they are expected to used.
         :param def_context: Default operation, one out of 
             :py:data:`fedoidc.CONTEXTS`
+        :param fs_cls: The class used to store the signed metadata
+            statements, :py:class:`fedoidc.file_system.FileSystem` or
+            something with the same interface.
         """
 
         self.metadata_statements = {}
@@ -167,7 +453,7 @@ class Signer(object):
             for key, _dir in ms_dir.items():
                 if key not in CONTEXTS:
                     raise ValueError('{} not expected operation'.format(key))
-                self.metadata_statements[key] = FileSystem(
+                self.metadata_statements[key] = fs_cls(
                     _dir, key_conv={'to': quote_plus, 'from': unquote_plus})
         elif ms_dir:
             for item in os.listdir(ms_dir):
@@ -175,7 +461,7 @@ class Signer(object):
                     raise ValueError('{} not expected operation'.format(item))
                 _dir = os.path.join(ms_dir, item)
                 if os.path.isdir(_dir):
-                    self.metadata_statements[item] = FileSystem(
+                    self.metadata_statements[item] = fs_cls(
                         _dir, key_conv={'to': quote_plus, 'from': unquote_plus})
         else:
             self.metadata_statements = MIN_SET
@@ -194,6 +480,28 @@ class Signer(object):
             res[key] = list(fs.keys())
         return res
 
+    def version(self, context=''):
+        """
+        A counter that changes when the set of signed metadata statements
+        for a context changes.
+
+        :param context: One of :py:data:`CONTEXTS`
+        :rtype: int
+        """
+        if not context:
+            context = self.def_context
+
+        try:
+            _fs = self.metadata_statements[context]
+        except KeyError:
+            return 0
+
+        try:
+            _fs.sync()
+        except AttributeError:  # Not a FileSystem instance
+            return 0
+        return _fs.version
+
     def metadata_statement_fos(self, context=''):
         """
         Get all the FOs that have signed metadata statements for a specific 
@@ -210,6 +518,64 @@ class Signer(object):
         except KeyError:
             return []
 
+    def _fo_statements(self, context, fos, single=False):
+        """
+        Picks the signed metadata statements from the superiors that should
+        be added to a request.
+
+        :param context: The context in which the signed metadata statement
+            should be used
+        :param fos: Signed metadata statements from these Federation
+            Operators should be added, None means all.
+        :param single: If all the statements go into one signed metadata
+            statement, in which case it's not an error if none matched.
+        :return: List of (FO, claim, signed metadata statement or URI)
+            tuples, None if this signer has no superiors and so is a FO.
+        """
+        try:
+            cms = self.metadata_statements[context]
+        except KeyError:
+            if self.metadata_statements == {'register': {},
+                                            'discovery': {},
+                                            'response': {}}:
+                # No superior so an FO then.
+                return None
+
+            try:
+                logger.error(
+                    'Signer: {}, items: {}'.format(self.signing_service.iss,
+                                                   self.items()))
+            except AttributeError:
+                raise SigningServiceError(
+                    'This signer can not sign for that context')
+            logger.error(
+                'No metadata statements for this context: {}'.format(
+                    context))
+            raise
+
+        if cms == {}:
+            # No superior so a FO then.
+            return None
+
+        if fos is None:
+            fos = list(cms.keys())
+
+        _vals = []
+        for f in fos:
+            try:
+                val = cms[f]
+            except KeyError:
+                continue
+
+            if val.startswith('http'):
+                _vals.append((f, 'metadata_statement_uris', val))
+            else:
+                _vals.append((f, 'metadata_statements', val))
+
+        if fos and not _vals and not single:
+            raise KeyError('No metadata statements matched')
+        return _vals
+
     def create_signed_metadata_statement(self, req, context='', fos=None,
                                          single=False):
         """
@@ -233,78 +599,86 @@ class Signer(object):
         if not context:
             context = self.def_context
 
-        _sms = None
-        if self.metadata_statements:
-            try:
-                cms = self.metadata_statements[context]
-            except KeyError:
-                if self.metadata_statements == {'register': {},
-                                                'discovery': {},
-                                                'response': {}}:
-                    # No superior so an FO then.
-                    _sms = self.signing_service(req)
-                    return {self.signing_service.iss: _sms}
+        if not self.metadata_statements:
+            return None
 
-                try:
-                    logger.error(
-                        'Signer: {}, items: {}'.format(self.signing_service.iss,
-                                                       self.items()))
-                except AttributeError:
-                    raise SigningServiceError(
-                        'This signer can not sign for that context')
-                logger.error(
-                    'No metadata statements for this context: {}'.format(
-                        context))
-                raise
-            else:
-                if cms == {}:
-                    # No superior so a FO then.
-                    _sms = self.signing_service(req)
-                    return {self.signing_service.iss: _sms}
-
-                if fos is None:
-                    fos = list(cms.keys())
+        _vals = self._fo_statements(context, fos, single)
+        if _vals is None:
+            return {self.signing_service.iss: self.signing_service(req)}
 
-                if single:
-                    for f in fos:
-                        try:
-                            val = cms[f]
-                        except KeyError:
-                            continue
-
-                        if val.startswith('http'):
-                            try:
-                                req['metadata_statement_uris'][f] = val
-                            except KeyError:
-                                req['metadata_statement_uris'] = {f: val}
-                        else:
-                            try:
-                                req['metadata_statements'][f] = val
-                            except KeyError:
-                                req['metadata_statements'] = {f: val}
-
-                    _sms = self.signing_service(req)
-                else:
-                    _sms = {}
-                    for f in fos:
-                        try:
-                            val = cms[f]
-                        except KeyError:
-                            continue
+        if single:
+            for f, attr, val in _vals:
+                try:
+                    req[attr][f] = val
+                except KeyError:
+                    req[attr] = {f: val}
+            return self.signing_service(req)
+
+        _sms = {}
+        for f, attr, val in _vals:
+            req[attr] = {f: val}
+            _sms[f] = self.signing_service(req)
+            del req[attr]
+        return _sms
 
-                        if val.startswith('http'):
-                            req['metadata_statement_uris'] = {f: val}
-                            _sms[f] = self.signing_service(req)
-                            del req['metadata_statement_uris']
-                        else:
-                            req['metadata_statements'] = {f: val}
-                            _sms[f] = self.signing_service(req)
-                            del req['metadata_statements']
+    def sign_many(self, reqs, context='', fos=None, single=False,
+                  processes=0):
+        """
+        Does the same as :py:meth:`create_signed_metadata_statement` but for
+        a batch of requests. All the signing is done in one go by the
+        signing service. The requests are not modified.
+
+        :param reqs: List of metadata statements to be signed
+        :param context: The context in which the signed metadata
+            statements should be used
+        :param fos: Signed metadata statements from these Federation
+            Operators should be added.
+        :param single: Should only a single signed metadata statement be
+            returned per request or a set of such in a dictionary.
+        :param processes: Number of processes the signing service may use
+        :return: List with one result per request, in the same order as
+            the requests.
+        """
 
-                if fos and not _sms:
-                    raise KeyError('No metadata statements matched')
+        if not context:
+            context = self.def_context
 
-        return _sms
+        if not self.metadata_statements:
+            return [None for _ in reqs]
+
+        _vals = self._fo_statements(context, fos, single)
+        if _vals is None:
+            _iss = self.signing_service.iss
+            return [{_iss: _sms} for _sms in
+                    self.signing_service.sign_many(reqs, processes=processes)]
+
+        _batch = []
+        _layout = []
+        for req in reqs:
+            _base = req.to_dict()
+            if single:
+                _dict = dict(_base)
+                for f, attr, val in _vals:
+                    _dict[attr] = dict(_dict.get(attr, {}))
+                    _dict[attr][f] = val
+                _layout.append(len(_batch))
+                _batch.append(req.__class__(**_dict))
+            else:
+                _idx = []
+                for f, attr, val in _vals:
+                    _dict = dict(_base)
+                    _dict[attr] = {f: val}
+                    _idx.append((f, len(_batch)))
+                    _batch.append(req.__class__(**_dict))
+                _layout.append(_idx)
+
+        _signed = self.signing_service.sign_many(_batch, processes=processes)
+
+        if single:
+            return [_signed[i] for i in _layout]
+        else:
+            return [dict([(f, _signed[i]) for f, i in _idx])
+                    for _idx in _layout]
 
     def gather_metadata_statements(self, context='', fos=None):
         """
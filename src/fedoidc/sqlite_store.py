@@ -0,0 +1,310 @@
+import logging
+import os
+import sqlite3
+import threading
+
+from fedoidc import instrument
+
+logger = logging.getLogger(__name__)
+
+#: Name of the database file within the directory
+DB_NAME = 'store.sqlite'
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, '
+    'version INTEGER NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS kv_version ON kv (version)',
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, '
+    'value INTEGER NOT NULL)',
+    "INSERT OR IGNORE INTO meta (name, value) VALUES ('version', 0)",
+    "INSERT OR IGNORE INTO meta (name, value) VALUES ('epoch', 0)",
+    # The version at which removed keys were last pruned
+    "INSERT OR IGNORE INTO meta (name, value) VALUES ('pruned', 0)",
+    # Number of keys removed since then
+    "INSERT OR IGNORE INTO meta (name, value) VALUES ('removed', 0)",
+]
+
+
+class SQLiteFileSystem(object):
+    """
+    A dictionary like database, with the same interface as
+    :py:class:`fedoidc.file_system.FileSystem`, backed by a SQLite database
+    in WAL mode so that many processes can read while one writes.
+
+    Every write increments a change counter in the database. Each instance
+    keeps the values it has seen in memory and only has to read the
+    counter to know whether they are still current. If they are not, only
+    the rows changed since then are read.
+    Removed keys are kept as rows without a value so that the removal is
+    seen by the others. When there are more than *max_removed* of them they
+    are pruned, those who have not seen all the changes up to then have to
+    read everything again.
+    """
+
+    def __init__(self, fdir, key_conv=None, value_conv=None, timeout=30.0,
+                 lazy=True, max_removed=1000):
+        """
+        :param fdir: The directory where the database file is kept
+        :param key_conv: Converts to/from the key displayed by this class to
+            users of it to something that is stored in the database. A
+            dictionary with the keys ['to', 'from'].
+        :param value_conv: Converts values to/from strings. A dictionary
+            with the keys ['to', 'from'].
+        :param timeout: How many seconds to wait for a lock held by another
+            process.
+        :param lazy: Only there for compatibility with FileSystem, values are
+            always converted the first time they are asked for.
+        :param max_removed: Max number of rows for removed keys that are
+            kept.
+        """
+        self.fdir = fdir
+        self.fname = os.path.join(fdir, DB_NAME)
+        self.key_conv = key_conv or {}
+        self.value_conv = value_conv or {}
+        self.timeout = timeout
+        self.max_removed = max_removed
+
+        self.raw = {}  # key -> value as stored
+        self.db = {}  # key -> decoded value
+        self._seen = None  # (epoch, version) last synced
+        self.version = 0
+        self._local = threading.local()
+        self._lock = threading.RLock()
+
+        if not os.path.isdir(fdir):
+            os.makedirs(fdir, exist_ok=True)
+
+        _conn = self._conn()
+        _conn.execute('PRAGMA journal_mode=WAL')
+        with _conn:
+            for stmt in SCHEMA:
+                _conn.execute(stmt)
+
+    def _conn(self):
+        """
+        One connection per thread.
+        """
+        try:
+            return self._local.conn
+        except AttributeError:
+            _conn = sqlite3.connect(self.fname, timeout=self.timeout,
+                                    isolation_level=None)
+            _conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = _conn
+            return _conn
+
+    def close(self):
+        try:
+            self._local.conn.close()
+        except AttributeError:
+            pass
+        else:
+            del self._local.conn
+
+    def _to_key(self, key):
+        try:
+            return self.key_conv['to'](key)
+        except KeyError:
+            return key
+
+    def _from_key(self, key):
+        try:
+            return self.key_conv['from'](key)
+        except KeyError:
+            return key
+
+    def _counters(self, conn):
+        return dict(conn.execute('SELECT name, value FROM meta').fetchall())
+
+    @instrument.timed('file_system.sync')
+    def sync(self):
+        """
+        Bring the local cache up to date with the database.
+        """
+        _conn = self._conn()
+        with self._lock:
+            _cnt = self._counters(_conn)
+            _now = (_cnt['epoch'], _cnt['version'])
+            if _now == self._seen:
+                return
+
+            # Read the counters again and the rows from the same snapshot
+            _conn.execute('BEGIN')
+            try:
+                self._reload(_conn)
+            finally:
+                _conn.execute('COMMIT')
+
+    def _reload(self, conn):
+        _cnt = self._counters(conn)
+        _now = (_cnt['epoch'], _cnt['version'])
+
+        if self._seen is None or self._seen[0] != _now[0]:
+            _full = True
+        else:
+            # Removals that have been pruned can't be seen
+            _full = self._seen[1] < _cnt['pruned']
+
+        if _full:
+            _rows = conn.execute(
+                'SELECT key, value FROM kv WHERE value IS NOT NULL').fetchall()
+            self.raw = dict(_rows)
+            self.db = {}
+        else:
+            _rows = conn.execute(
+                'SELECT key, value FROM kv WHERE version > ?',
+                (self._seen[1],)).fetchall()
+            for key, value in _rows:
+                self.db.pop(key, None)
+                if value is None:
+                    self.raw.pop(key, None)
+                else:
+                    self.raw[key] = value
+
+        self._seen = _now
+        self.version += 1
+
+    @instrument.timed('file_system.read')
+    def _read_info(self, key):
+        info = self.raw[key]
+        try:
+            info = self.value_conv['from'](info)
+        except KeyError:
+            pass
+        return info
+
+    def _get(self, key):
+        try:
+            return self.db[key]
+        except KeyError:
+            _val = self._read_info(key)
+            self.db[key] = _val
+            return _val
+
+    def __getitem__(self, item):
+        """
+        Return the value bound to an identifier.
+
+        :param item: The identifier.
+        :return:
+        """
+        self.sync()
+        with self._lock:
+            return self._get(self._to_key(item))
+
+    def _write(self, rows):
+        """
+        Write a number of rows in one transaction.
+
+        :param rows: List of (key, value as string or None) tuples
+        """
+        _conn = self._conn()
+        _conn.execute('BEGIN IMMEDIATE')
+        try:
+            _conn.execute(
+                "UPDATE meta SET value = value + 1 WHERE name = 'version'")
+            _version = self._counters(_conn)['version']
+            _conn.executemany(
+                'INSERT OR REPLACE INTO kv (key, value, version) '
+                'VALUES (?, ?, ?)',
+                [(k, v, _version) for k, v in rows])
+            _removed = len([k for k, v in rows if v is None])
+            if _removed:
+                self._count_removed(_conn, _removed, _version)
+        except Exception:
+            _conn.execute('ROLLBACK')
+            raise
+        else:
+            _conn.execute('COMMIT')
+
+    def _count_removed(self, conn, removed, version):
+        """
+        Keep track of the number of removed keys and prune them when there
+        are too many. Must be called within a write transaction.
+        """
+        conn.execute(
+            "UPDATE meta SET value = value + ? WHERE name = 'removed'",
+            (removed,))
+        if self._counters(conn)['removed'] <= self.max_removed:
+            return
+
+        conn.execute('DELETE FROM kv WHERE value IS NULL')
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'pruned'",
+                     (version,))
+        conn.execute("UPDATE meta SET value = 0 WHERE name = 'removed'")
+
+    def _encode(self, value):
+        try:
+            return self.value_conv['to'](value)
+        except KeyError:
+            return value
+
+    def __setitem__(self, key, value):
+        """
+        Binds a value to a specific key.
+
+        :param key: Identifier
+        :param value: Value that should be bound to the identifier.
+        """
+        self._write([(self._to_key(key), self._encode(value))])
+
+    def update(self, ava):
+        """
+        Implements the dict.update() method. All the values are written in
+        one transaction.
+        """
+        self._write([(self._to_key(k), self._encode(v))
+                     for k, v in ava.items()])
+
+    def __delitem__(self, key):
+        self.sync()
+        _key = self._to_key(key)
+        if _key not in self.raw:
+            raise KeyError(key)
+        self._write([(_key, None)])
+
+    def __contains__(self, item):
+        self.sync()
+        return self._to_key(item) in self.raw
+
+    def __len__(self):
+        self.sync()
+        return len(self.raw)
+
+    def keys(self):
+        """
+        Implements the dict.keys() method
+        """
+        self.sync()
+        for k in list(self.raw.keys()):
+            yield self._from_key(k)
+
+    def items(self):
+        """
+        Implements the dict.items() method
+        """
+        self.sync()
+        for k in list(self.raw.keys()):
+            with self._lock:
+                try:
+                    _val = self._get(k)
+                except KeyError:  # removed in between
+                    continue
+            yield self._from_key(k), _val
+
+    def clear(self):
+        """
+        Removes everything.
+        """
+        _conn = self._conn()
+        _conn.execute('BEGIN IMMEDIATE')
+        try:
+            _conn.execute('DELETE FROM kv')
+            _conn.execute(
+                "UPDATE meta SET value = value + 1 WHERE name = 'epoch'")
+            _conn.execute("UPDATE meta SET value = 0 WHERE name = 'removed'")
+        except Exception:
+            _conn.execute('ROLLBACK')
+            raise
+        else:
+            _conn.execute('COMMIT')
@@ -1,5 +1,4 @@
 import copy
-import hashlib
 import json
 import os
 from urllib.parse import quote_plus
@@ -13,10 +12,10 @@ from fedoidc.bundle import JWKSBundle
 from fedoidc.bundle import keyjar_to_jwks_private
 from fedoidc.entity import FederationEntity
 from fedoidc.file_system import FileSystem
+from fedoidc.metadata_store import MetaDataStore
 from fedoidc.operator import Operator
 from fedoidc.signing_service import InternalSigningService
 from fedoidc.signing_service import Signer
-from jwkest import as_bytes
 
 from oic.utils.keyio import KeyJar
 from oic.utils.keyio import build_keyjar
@@ -86,7 +85,8 @@ def make_ms(desc, leaf, operator, sup=None):
 
     :param desc: A description of who wants who to signed what.
         represented as a dictionary containing: 'request', 'requester',
-        'signer' and 'signer_add'.
+        'signer' and 'signer_add'. Optionally also 'alg', the signing
+        algorithm to use.
     :param leaf: if the requester is the entity operator/agent
     :param operator: A dictionary containing Operator instance as values.
     :param ms: Metadata statements to be added, dict. The values are
@@ -136,7 +136,12 @@ def make_ms(desc, leaf, operator, sup=None):
     else:
         jwt_args = {}
 
-    ms = _signer.pack_metadata_statement(req, jwt_args=jwt_args)
+    try:
+        _alg = desc['alg']
+    except KeyError:
+        _alg = ''
+
+    ms = _signer.pack_metadata_statement(req, jwt_args=jwt_args, alg=_alg)
 
     return {_fo: ms}
 
@@ -308,19 +313,6 @@ def create_federation_entity(iss, jwks_dir, sup='', fo_jwks=None, ms_dir='',
                             fo_bundle=_public_keybundle)
 
 
-class MetaDataStore(FileSystem):
-    @staticmethod
-    def hash(value):
-        _hash = hashlib.sha256()
-        _hash.update(as_bytes(value))
-        return _hash.hexdigest()
-
-    def add(self, value):
-        _key = self.hash(value)
-        self[_key] = value
-        return _key
-
-
 def unpack_using_metadata_store(url, mds):
     p = urlparse(url)
     _jws0 = mds[p.path.split('/')[-1]]
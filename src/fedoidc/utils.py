@@ -1,10 +1,7 @@
-import json
-
+from fedoidc import CompactJWS
 from fedoidc import MetadataStatement
 from fedoidc.bundle import jwks_to_keyjar
-from jwkest import as_unicode
 from jwkest.jws import JWS, alg2keytype
-from jwkest.jws import factory
 
 from oic.oic import JasonWebToken
 from oic.utils.jwt import JWT
@@ -46,22 +43,21 @@ def verify_self_signed_jwks(sjwt):
         the JWT)
     """
 
-    _jws = factory(sjwt)
-    _json = _jws.jwt.part[1]
-    _body = json.loads(as_unicode(_json))
+    _jws = CompactJWS(sjwt)
+    _body = _jws.payload
     iss = _body['iss']
     _jwks = _body['jwks']
 
     _kj = jwks_to_keyjar(_jwks, iss)
 
     try:
-        _kid = _jws.jwt.headers['kid']
+        _kid = _jws.header['kid']
     except KeyError:
         _keys = _kj.get_signing_key(owner=iss)
     else:
         _keys = _kj.get_signing_key(owner=iss, kid=_kid)
 
-    _ver = _jws.verify_compact(sjwt, _keys)
+    _ver = _jws.verify(_keys)
     return {'jwks': _ver['jwks'], 'iss': iss}
 
 
@@ -98,22 +94,21 @@ def verify_request_signed_by_signing_keys(smsreq):
         issuer of the JWT).
     """
 
-    _jws = factory(smsreq)
-    _json = _jws.jwt.part[1]
-    _body = json.loads(as_unicode(_json))
+    _jws = CompactJWS(smsreq)
+    _body = _jws.payload
     iss = _body['iss']
     _jwks = _body['signing_keys']
 
     _kj = jwks_to_keyjar(_jwks, iss)
 
     try:
-        _kid = _jws.jwt.headers['kid']
+        _kid = _jws.header['kid']
     except KeyError:
         _keys = _kj.get_signing_key(owner=iss)
     else:
         _keys = _kj.get_signing_key(owner=iss, kid=_kid)
 
-    _ver = _jws.verify_compact(smsreq, _keys)
+    _ver = _jws.verify(_keys)
     # remove the JWT specific claims
     for k in JasonWebToken.c_param.keys():
         try:
@@ -149,10 +144,19 @@ def store_signed_jwks(keyjar, sign_keyjar, path, alg, iss=''):
 
 
 def replace_jwks_key_bundle(keyjar, owner, new_kb):
+    """
+    Replace the key bundles of an owner that were fetched from somewhere
+    with a new one. The same key bundle instance may be shared by many
+    owners.
+
+    :param keyjar: A KeyJar instance
+    :param owner: The owner of the keys
+    :param new_kb: A KeyBundle instance
+    """
     try:
         kbl = keyjar.issuer_keys[owner]
     except KeyError:
-        pass
+        keyjar.issuer_keys[owner] = [new_kb]
     else:
         res = [new_kb]
         for kb in kbl:
@@ -0,0 +1,211 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_DELETE)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatcherError(Exception):
+    pass
+
+
+class Watcher(object):
+    """
+    Base class for directory watchers. A watcher runs in a thread of its
+    own and calls *callback* with the name of a file in the directory
+    every time that file is created, modified or removed.
+    If the watcher can not tell which files has changed the callback is
+    called with None as argument.
+    """
+
+    def __init__(self, fdir, callback):
+        """
+        :param fdir: The directory to watch
+        :param callback: Function to call when something in the directory
+            has changed.
+        """
+        self.fdir = fdir
+        self.callback = callback
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.close()
+
+    def close(self):
+        """
+        Release what the watcher holds, also if it was never started.
+        """
+        pass
+
+    def run(self):
+        raise NotImplementedError()
+
+
+class PollingWatcher(Watcher):
+    """
+    A watcher that periodically lists the directory and compares the
+    inode numbers and modification times of the files with what it saw the
+    last time.
+    """
+
+    def __init__(self, fdir, callback, interval=1.0):
+        """
+        :param interval: Seconds between each scan of the directory
+        """
+        Watcher.__init__(self, fdir, callback)
+        self.interval = interval
+        self._seen = self._scan()
+
+    def _scan(self):
+        res = {}
+        try:
+            names = os.listdir(self.fdir)
+        except OSError as err:
+            logger.error(err)
+            return res
+
+        for f in names:
+            try:
+                _stat = os.stat(os.path.join(self.fdir, f))
+            except OSError:  # removed in between
+                continue
+            res[f] = (_stat.st_ino, _stat.st_mtime_ns)
+        return res
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            _now = self._scan()
+            for f, stamp in _now.items():
+                if self._seen.get(f) != stamp:
+                    self.callback(f)
+            for f in set(self._seen.keys()).difference(_now.keys()):
+                self.callback(f)
+            self._seen = _now
+
+
+class InotifyWatcher(Watcher):
+    """
+    A watcher that uses the Linux inotify interface. Only events for
+    complete writes, renames and removals are reported.
+    """
+
+    def __init__(self, fdir, callback, timeout=0.5):
+        """
+        :param timeout: How long to wait for events before checking if the
+            watcher should be stopped.
+        """
+        Watcher.__init__(self, fdir, callback)
+        self.timeout = timeout
+        self._fd = -1
+
+        _libc = _load_libc()
+        self._fd = _libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise WatcherError(os.strerror(ctypes.get_errno()))
+
+        _wd = _libc.inotify_add_watch(self._fd, os.fsencode(fdir),
+                                      WATCH_MASK)
+        if _wd < 0:
+            _err = ctypes.get_errno()
+            self.close()
+            raise WatcherError(os.strerror(_err))
+
+    def close(self):
+        """
+        Close the inotify file descriptor.
+        """
+        _fd, self._fd = self._fd, -1
+        if _fd >= 0:
+            os.close(_fd)
+
+    def __del__(self):
+        # The descriptor is only closed by run() or stop(), a watcher that
+        # is dropped without being started would otherwise leak it.
+        if getattr(self, '_fd', -1) >= 0:
+            self.close()
+
+    def _events(self, buf):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            _wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield mask, os.fsdecode(name)
+
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                _ready, _, _ = select.select([self._fd], [], [], self.timeout)
+                if not _ready:
+                    continue
+                for mask, name in self._events(os.read(self._fd, 65536)):
+                    if mask & IN_Q_OVERFLOW:
+                        self.callback(None)
+                    elif mask & IN_ISDIR or not name:
+                        continue
+                    else:
+                        self.callback(name)
+        finally:
+            self.close()
+
+
+def _load_libc():
+    _name = ctypes.util.find_library('c')
+    if not _name:
+        raise WatcherError('No libc')
+    _libc = ctypes.CDLL(_name, use_errno=True)
+    try:
+        _libc.inotify_init1
+        _libc.inotify_add_watch
+    except AttributeError:
+        raise WatcherError('No inotify support')
+    return _libc
+
+
+def get_watcher(fdir, callback, interval=1.0):
+    """
+    Get the best watcher available on this platform. That is inotify on
+    Linux with polling as fallback.
+
+    :param fdir: The directory to watch
+    :param callback: Function to call when something in the directory
+        changes.
+    :param interval: Seconds between scans if polling is used
+    :return: A :py:class:`Watcher` instance, not yet started
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(fdir, callback)
+        except WatcherError as err:
+            logger.warning('Falling back to polling: {}'.format(err))
+
+    return PollingWatcher(fdir, callback, interval=interval)
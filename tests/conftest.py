@@ -0,0 +1,17 @@
+import os
+import shutil
+import tempfile
+
+
+def pytest_configure(config):
+    # The tests write keys, signed metadata statements and stores to the
+    # current directory, some of them when the test modules are imported.
+    # Run them in a directory of their own so nothing ends up in the tree.
+    config.fedoidc_cwd = os.getcwd()
+    config.fedoidc_tmp = tempfile.mkdtemp(prefix='fedoidc_tests_')
+    os.chdir(config.fedoidc_tmp)
+
+
+def pytest_unconfigure(config):
+    os.chdir(config.fedoidc_cwd)
+    shutil.rmtree(config.fedoidc_tmp, ignore_errors=True)
@@ -1,23 +1,33 @@
+import copy
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+import pytest
 from fedoidc import ClientMetadataStatement
+from fedoidc import CompactJWS
 from fedoidc import MetadataStatement
 from fedoidc import ProviderConfigurationResponse
+from fedoidc import compile_policy
 from fedoidc import is_lesser
+from fedoidc import shallow_copy_message
 from fedoidc import unfurl
 from fedoidc.bundle import JWKSBundle
 from fedoidc.bundle import verify_signed_bundle
 from fedoidc.operator import Operator
 from fedoidc.operator import le_dict
+from jwkest import BadSignature
 from jwkest import jws
+from jwkest.jws import FormatError
+from jwkest.jws import NoSuitableSigningKeys
 
+from oic.oauth2.exception import VerificationError
 from oic.oauth2.message import Message
 from oic.oauth2.message import MissingSigningKey
 from oic.utils.keyio import KeyJar
 from oic.utils.keyio import build_keyjar
 
-BASE_PATH = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), "data/keys"))
+BASE_PATH = os.path.abspath("data/keys")
 
 KEYDEFS = [
     {"type": "RSA", "key": '', "use": ["sig"]},
@@ -68,6 +78,17 @@ def test_create_metadata_statement_simple():
     assert len(ms['signing_keys']['keys']) == 2
 
 
+def test_metadata_statement_verify_signing_keys():
+    ms = MetadataStatement(signing_keys=KEYS['org']['jwks'])
+    assert ms.verify()
+
+    _jwks = json.loads(json.dumps(KEYS['org']['jwks']))
+    _jwks['keys'][0]['n'] = 'not base64url!'
+    ms = MetadataStatement(signing_keys=_jwks)
+    with pytest.raises(VerificationError):
+        ms.verify()
+
+
 def test_create_client_metadata_statement():
     ms = MetadataStatement(signing_keys=KEYS['org']['jwks'])
     ms_jwt = ms.to_jwt(KEYS['fo']['keyjar'].get_signing_key('rsa'))
@@ -120,6 +141,95 @@ def test_pack_ms_wrong_fo():
     #     assert False
 
 
+def test_unpack_ms_key_by_kid():
+    _key = copy.copy(FOP.keyjar.get_signing_key('rsa', owner='')[0])
+    _payload = json.dumps({'iss': FOP.iss, 'contacts': ['info@example.com']})
+    member = fo_member(FOP)
+
+    # Unknown kid, no other key is tried
+    _key.kid = 'unknown'
+    _jwt = jws.JWS(_payload, alg='RS256').sign_compact([_key])
+    pr = member.unpack_metadata_statement(jwt_ms=_jwt)
+    assert pr.result is None
+    assert isinstance(pr.error[_jwt], MissingSigningKey)
+
+    # No kid, the issuer has only one RSA key
+    _key.kid = ''
+    _jwt = jws.JWS(_payload, alg='RS256').sign_compact([_key])
+    pr = member.unpack_metadata_statement(jwt_ms=_jwt)
+    assert pr.result['contacts'] == ['info@example.com']
+
+
+def test_compact_jws():
+    _payload = {'iss': FOP.iss, 'contacts': ['info@example.com']}
+    _key = FOP.keyjar.get_signing_key('rsa', owner='')[0]
+    _jwt = jws.JWS(json.dumps(_payload), alg='RS256').sign_compact([_key])
+
+    _jws = CompactJWS(_jwt)
+    assert _jws.header == {'alg': 'RS256', 'kid': _key.kid}
+    assert _jws.payload == _payload
+    assert _jws.payload == unfurl(_jwt)
+    assert _jws.verify(FOP.keyjar.get_issuer_keys('')) is _jws.payload
+
+    # Right kind of key but the wrong one
+    _other = copy.copy(ORGOP.keyjar.get_signing_key('rsa', owner='')[0])
+    _other.kid = _key.kid
+    with pytest.raises(BadSignature):
+        _jws.verify([_other])
+
+    with pytest.raises(NoSuitableSigningKeys):
+        _jws.verify(FOP.keyjar.get_signing_key('ec', owner=''))
+
+    with pytest.raises(FormatError):
+        CompactJWS(_jwt.rsplit('.', 1)[0])
+
+    with pytest.raises(FormatError):
+        CompactJWS('e30.bm90IGpzb24.').payload
+
+    # Not a JSON object
+    with pytest.raises(FormatError):
+        CompactJWS('e30.W10.').payload
+
+    # Bad padding in the signature
+    _bad = CompactJWS(_jwt.rsplit('.', 1)[0] + '.abcde')
+    with pytest.raises(FormatError):
+        _bad.verify(FOP.keyjar.get_issuer_keys(''))
+
+
+def test_unpack_bad_signature_encoding():
+    cms_org = ClientMetadataStatement(
+        signing_keys=ORGOP.keyjar.export_jwks(), contacts=['info@example.com'])
+    ms_org = FOP.pack_metadata_statement(cms_org, alg='RS256')
+    # Bad padding in the signature
+    _bad = ms_org.rsplit('.', 1)[0] + '.abcde'
+    cms_inter = ClientMetadataStatement(
+        signing_keys=ORGOP.keyjar.export_jwks(),
+        metadata_statements={FOP.iss: _bad})
+    ms_inter = ORGOP.pack_metadata_statement(cms_inter, alg='RS256')
+
+    receiver = fo_member(FOP)
+    ri = receiver.unpack_metadata_statement(jwt_ms=ms_inter)
+    assert ri.result is None
+    assert isinstance(ri.branch[_bad].error[_bad], FormatError)
+
+
+def test_unpack_unusable_signing_keys():
+    # Looks like a JWKS but the certificate can not be parsed
+    cms_org = ClientMetadataStatement(
+        signing_keys={'keys': [{'kty': 'RSA', 'x5c': ['AAAA']}]},
+        contacts=['info@example.com'])
+    ms_org = FOP.pack_metadata_statement(cms_org, alg='RS256')
+    cms_inter = ClientMetadataStatement(
+        signing_keys=ORGOP.keyjar.export_jwks(),
+        metadata_statements={FOP.iss: ms_org})
+    ms_inter = ORGOP.pack_metadata_statement(cms_inter, alg='RS256')
+
+    receiver = fo_member(FOP)
+    ri = receiver.unpack_metadata_statement(jwt_ms=ms_inter)
+    assert ri.result is None
+    assert isinstance(ri.error[ms_inter], MissingSigningKey)
+
+
 def test_pack_and_unpack_ms_lev1():
     # metadata statement created by the organization
     cms_org = ClientMetadataStatement(
@@ -244,6 +354,39 @@ def test_multiple_fo_all_working():
     assert set(_iss) == {ISSUER['fo'], ISSUER['fo1']}
 
 
+def test_multiple_fo_executor():
+    cms_org = ClientMetadataStatement(
+        signing_keys=KEYS['org']['jwks'],
+        contacts=['info@example.com']
+    )
+
+    ms_org1 = FOP.pack_metadata_statement(cms_org, alg='RS256',
+                                          scope=['openid'])
+    ms_org2 = FO1P.pack_metadata_statement(cms_org, alg='RS256',
+                                           scope=['openid', 'address'])
+
+    cms_rp = ClientMetadataStatement(
+        signing_keys=KEYS['admin']['jwks'],
+        redirect_uris=['https://rp.example.com/auth_cb']
+    )
+
+    ms_rp = ORGOP.pack_metadata_statement(
+        cms_rp, alg='RS256', metadata_statements=Message(**{FOP.iss: ms_org1,
+                                                            FO1P.iss: ms_org2}))
+
+    receiver = fo_member(FOP, FO1P)
+    ri = receiver.unpack_metadata_statement(jwt_ms=ms_rp)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        receiver.executor = executor
+        pri = receiver.unpack_metadata_statement(jwt_ms=ms_rp)
+
+    assert pri.result.to_dict() == ri.result.to_dict()
+    assert [x.to_dict() for x in pri.parsed_statement] == [
+        x.to_dict() for x in ri.parsed_statement]
+    assert set(pri.branch.keys()) == {ms_org1, ms_org2}
+
+
 def test_is_lesser_strings():
     assert is_lesser('foo', 'foo')
     assert is_lesser('foo', 'fox') is False
@@ -260,6 +403,23 @@ def test_is_lesser_list():
     assert is_lesser(['fee', 'fum'], ['fee']) is False
 
 
+def test_compile_policy():
+    values = [
+        'foo', 'fox', True, False, 1, 3, 2.5, ['foo'], ['foo', 'fox'],
+        ['fee', 'fum'], [1, 2], [True], [['foo'], 'fee'],
+        {'a': 'foo'}, {'a': ['foo', 'fee'], 'b': 1}, {'a': ['foo']}]
+    for b in values:
+        policy = compile_policy(b)
+        for a in values:
+            assert policy(a) == is_lesser(a, b)
+
+    policy = compile_policy(['foo', 'fee', 'fum', 1, 4])
+    assert policy(['fum', 'foo', 3])
+    assert policy(['fum', 'foo', 5]) is False
+    # booleans are not integers
+    assert policy([True]) is False
+
+
 def test_evaluate_metadata_statement_1():
     cms_org = ClientMetadataStatement(
         signing_keys=ORGOP.keyjar.export_jwks(), contacts=['info@example.com'])
@@ -516,3 +676,23 @@ def test_create_verify_fo_keys_bundle():
     _jwt = verify_signed_bundle(sb, kj)
     bundle = _jwt["bundle"]
     assert set(bundle.keys()) == {FOP.iss, FO1P.iss}
+
+
+def test_shallow_copy_message():
+    _keys = [{'kty': 'RSA', 'kid': 'k{}'.format(i), 'e': 'AQAB',
+              'n': str(i) * 30, 'use': 'sig'} for i in range(5)]
+    _sms = dict([('https://fo{}.example.org'.format(i), 'x' * 40)
+                 for i in range(5)])
+    req = MetadataStatement(signing_keys={'keys': _keys},
+                            metadata_statements=_sms)
+    _ms = req['metadata_statements']
+
+    _copy = shallow_copy_message(req)
+    assert isinstance(_copy, MetadataStatement)
+    assert _copy._dict is not req._dict
+    _copy['iss'] = 'https://example.org'
+    _copy.update({'metadata_statements': {}})
+    assert 'iss' not in req
+    assert req['metadata_statements'] is _ms
+    # Nothing below the top level is copied
+    assert _copy['signing_keys'] is req['signing_keys']
@@ -1,8 +1,20 @@
 import os
 import shutil
+import sys
+import threading
 from time import sleep
+from time import time
 
+import pytest
+from fedoidc import file_system
 from fedoidc.file_system import FileSystem
+from fedoidc.metadata_store import MetaDataStore
+from fedoidc.packed_store import LOG_NAME
+from fedoidc.packed_store import PackedFileSystem
+from fedoidc.sqlite_store import SQLiteFileSystem
+from fedoidc.watcher import InotifyWatcher
+from fedoidc.watcher import PollingWatcher
+from fedoidc.watcher import get_watcher
 
 ROOT = 'test_dir'
 
@@ -73,3 +85,427 @@ def test_detect_change():
     assert set(fs.keys()) == {'1', '2', '3'}
     assert dict([(k, v) for k, v in fs.items()]) == {'1': 'one', '2': 'twee',
                                                      '3': 'Three'}
+
+
+def _wait_for(func, timeout=5.0):
+    _end = time() + timeout
+    while time() < _end:
+        if func():
+            return True
+        sleep(0.05)
+    return False
+
+
+def _watched(fs):
+    fs['1'] = 'one'
+
+    fname = os.path.join(ROOT, '2')
+    fp = open(fname, 'w')
+    fp.write('two')
+    fp.close()
+
+    assert _wait_for(lambda: '2' in fs.db)
+    assert fs['2'] == 'two'
+    assert set(fs.keys()) == {'1', '2'}
+
+    os.unlink(os.path.join(ROOT, '1'))
+    assert _wait_for(lambda: '1' not in fs.db)
+    assert dict([(k, v) for k, v in fs.items()]) == {'2': 'two'}
+
+
+def test_watch():
+    if os.path.isdir(ROOT):
+        shutil.rmtree(ROOT)
+
+    fs = FileSystem(ROOT, watch=True)
+    try:
+        _watched(fs)
+    finally:
+        fs.close()
+
+
+def test_watch_polling():
+    if os.path.isdir(ROOT):
+        shutil.rmtree(ROOT)
+
+    fs = FileSystem(ROOT)
+    fs.watcher = PollingWatcher(ROOT, fs._file_changed, interval=0.1)
+    fs.watcher.start()
+    try:
+        _watched(fs)
+    finally:
+        fs.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='inotify is Linux only')
+def test_inotify_watcher_close():
+    if os.path.isdir(ROOT):
+        shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+
+    # Never started
+    watcher = InotifyWatcher(ROOT, lambda name: None)
+    _fd = watcher._fd
+    os.fstat(_fd)
+    watcher.stop()
+    with pytest.raises(OSError):
+        os.fstat(_fd)
+
+    watcher = InotifyWatcher(ROOT, lambda name: None)
+    _fd = watcher._fd
+    del watcher
+    with pytest.raises(OSError):
+        os.fstat(_fd)
+
+    # Can not be watched, nothing is left open
+    _open = len(os.listdir('/proc/self/fd'))
+    watcher = get_watcher(os.path.join(ROOT, 'missing'), lambda name: None)
+    assert isinstance(watcher, PollingWatcher)
+    assert len(os.listdir('/proc/self/fd')) == _open
+
+
+def test_watch_change_before_start(monkeypatch):
+    if os.path.isdir(ROOT):
+        shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+
+    def get_watcher(fdir, callback, interval=1.0):
+        # Changed before the watcher takes notice
+        fp = open(os.path.join(ROOT, '1'), 'w')
+        fp.write('one')
+        fp.close()
+        return PollingWatcher(fdir, callback, interval=interval)
+
+    monkeypatch.setattr(file_system, 'get_watcher', get_watcher)
+    fs = FileSystem(ROOT, watch=True)
+    try:
+        assert fs['1'] == 'one'
+    finally:
+        fs.close()
+
+
+def test_watch_lost_events():
+    if os.path.isdir(ROOT):
+        shutil.rmtree(ROOT)
+
+    fs = FileSystem(ROOT, watch=True)
+    try:
+        for i in range(200):
+            fs[str(i)] = 'value'
+        fs['1'] = 'one'
+        _errors = []
+        _done = threading.Event()
+
+        def reader():
+            while not _done.is_set():
+                try:
+                    assert fs['1'] == 'one'
+                except Exception as err:
+                    _errors.append(err)
+
+        _thr = threading.Thread(target=reader)
+        _thr.start()
+        for i in range(20):
+            fs._file_changed(None)
+        _done.set()
+        _thr.join()
+        assert _errors == []
+    finally:
+        fs.close()
+
+
+def test_atomic_write():
+    if os.path.isdir(ROOT):
+        shutil.rmtree(ROOT)
+
+    values = ['a' * 100000, 'b' * 200000]
+    fs = FileSystem(ROOT)
+    fs['1'] = values[0]
+
+    def writer():
+        for i in range(50):
+            fs['1'] = values[i % 2]
+
+    _thr = threading.Thread(target=writer)
+    _thr.start()
+    reader = FileSystem(ROOT)
+    while _thr.is_alive():
+        assert reader['1'] in values
+        assert set(reader.keys()) == {'1'}
+    _thr.join()
+
+    # No temporary files left behind
+    assert os.listdir(ROOT) == ['1']
+
+
+def test_dot_keys():
+    if os.path.isdir(ROOT):
+        shutil.rmtree(ROOT)
+
+    fs = FileSystem(ROOT)
+    fs['.hidden'] = 'one'
+    fs2 = FileSystem(ROOT)
+    assert dict(fs2.items()) == {'.hidden': 'one'}
+
+    with pytest.raises(ValueError):
+        fs['{}1'.format(file_system.TMP_PREFIX)] = 'two'
+    assert os.listdir(ROOT) == ['.hidden']
+
+
+def test_detect_replace_same_mtime():
+    if os.path.isdir(ROOT):
+        shutil.rmtree(ROOT)
+
+    fs = FileSystem(ROOT)
+    fs['1'] = 'one'
+    fname = os.path.join(ROOT, '1')
+    _mtime = os.stat(fname).st_mtime_ns
+
+    # Replaced by someone else within the same mtime tick
+    _tmp = os.path.join(ROOT, 'tmp')
+    fp = open(_tmp, 'w')
+    fp.write('ett')
+    fp.close()
+    os.utime(_tmp, ns=(_mtime, _mtime))
+    os.replace(_tmp, fname)
+
+    assert fs['1'] == 'ett'
+
+
+def test_metadata_store():
+    _root = 'mds_sharded'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    mds = MetaDataStore(_root)
+    _key = mds.add('statement')
+    assert _key == MetaDataStore.hash('statement')
+    # sharded by prefix
+    assert os.path.isfile(os.path.join(_root, _key[:2], _key[2:4], _key))
+    assert mds[_key] == 'statement'
+    assert _key in mds
+
+    # adding the same content again doesn't change anything
+    mds.add('statement')
+    assert mds.keys() == [_key]
+
+    # Another instance sees the content through the index
+    _key2 = MetaDataStore(_root).add('other')
+    assert mds.keys() == [_key, _key2]
+    assert len(mds) == 2
+    assert dict(mds.items()) == {_key: 'statement', _key2: 'other'}
+
+
+def test_metadata_store_repair_index():
+    _root = 'mds_sharded'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    mds = MetaDataStore(_root)
+    _key = mds.add('statement')
+    # As if the writer was interrupted before the index was updated
+    os.unlink(os.path.join(_root, 'index'))
+
+    mds = MetaDataStore(_root)
+    assert mds.keys() == []
+    mds.add('statement')
+    assert mds.keys() == [_key]
+    mds.add('statement')
+    assert MetaDataStore(_root).keys() == [_key]
+
+
+def test_metadata_store_failed_write(monkeypatch):
+    _root = 'mds_sharded'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    mds = MetaDataStore(_root)
+    _fname = mds.path(mds.hash('statement'))
+
+    def fsync(fd):
+        # Written the same way as FileSystem writes
+        _tmp = os.listdir(os.path.dirname(_fname))
+        assert len(_tmp) == 1 and file_system.is_tmp_file(_tmp[0])
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(file_system.os, 'fsync', fsync)
+    with pytest.raises(OSError):
+        mds.add('statement')
+
+    # The temporary file is removed and nothing is indexed
+    assert os.listdir(os.path.dirname(_fname)) == []
+    assert mds.keys() == []
+
+
+def test_metadata_store_bad_key():
+    mds = MetaDataStore('mds_sharded')
+    for key in ['../../etc/passwd', 'abc', '0' * 64]:
+        try:
+            _ = mds[key]
+        except KeyError:
+            pass
+        else:
+            assert False
+        assert key not in mds
+
+    try:
+        mds['0' * 64] = 'statement'
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    mds.clear()
+    assert mds.keys() == []
+
+
+def test_packed_file_system():
+    _root = 'packed_dir'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    fs = PackedFileSystem(_root)
+    fs['1'] = 'on'
+    fs['2'] = 'off'
+    fs['1'] = 'again'
+    assert os.listdir(_root) == [LOG_NAME]
+    assert dict(fs.items()) == {'1': 'again', '2': 'off'}
+
+    # Another instance sees the same thing
+    fs2 = PackedFileSystem(_root)
+    assert fs2['1'] == 'again'
+
+    # and picks up changes
+    del fs['2']
+    fs['3'] = 'new'
+    assert sorted(fs2.keys()) == ['1', '3']
+    assert fs2['3'] == 'new'
+
+    fs.clear()
+    assert list(fs2.keys()) == []
+
+
+def test_packed_file_system_compact():
+    _root = 'packed_dir'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    fs = PackedFileSystem(_root, compact_min_size=1000)
+    fs2 = PackedFileSystem(_root)
+    for i in range(100):
+        fs['a'] = 'x' * 100 + str(i)
+    # Only a few versions of 'a' left
+    assert os.path.getsize(os.path.join(_root, LOG_NAME)) < 2000
+    assert fs2['a'] == 'x' * 100 + '99'
+
+    # A write that was interrupted is removed
+    with open(os.path.join(_root, LOG_NAME), 'ab') as fp:
+        fp.write(b'\x01\x00\x00')
+    fs3 = PackedFileSystem(_root)
+    assert list(fs3.keys()) == ['a']
+    fs3['b'] = 'b'
+    assert fs['b'] == 'b'
+
+
+def test_sqlite_file_system():
+    _root = 'sqlite_dir'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    fs = SQLiteFileSystem(_root)
+    fs['1'] = 'on'
+    fs.update({'2': 'off', '3': 'maybe'})
+    assert dict(fs.items()) == {'1': 'on', '2': 'off', '3': 'maybe'}
+
+    fs2 = SQLiteFileSystem(_root)
+    assert fs2['2'] == 'off'
+    _version = fs2.version
+
+    # Nothing changed
+    fs2.sync()
+    assert fs2.version == _version
+
+    del fs['2']
+    fs['1'] = 'again'
+    assert sorted(fs2.keys()) == ['1', '3']
+    assert fs2['1'] == 'again'
+    assert fs2.version != _version
+
+    fs.clear()
+    assert list(fs2.keys()) == []
+
+
+def test_sqlite_file_system_prune():
+    _root = 'sqlite_dir'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    fs = SQLiteFileSystem(_root, max_removed=2)
+    fs.update(dict([(str(i), 'value') for i in range(5)]))
+    fs2 = SQLiteFileSystem(_root)
+    fs3 = SQLiteFileSystem(_root)
+    assert len(fs2) == 5
+    assert len(fs3) == 5
+
+    del fs['0']
+    del fs['1']
+    # fs2 keeps up, fs3 doesn't
+    assert sorted(fs2.keys()) == ['2', '3', '4']
+    del fs['2']
+
+    def removed():
+        return fs._conn().execute(
+            'SELECT COUNT(*) FROM kv WHERE value IS NULL').fetchone()[0]
+
+    # Pruned
+    assert removed() == 0
+    assert sorted(fs2.keys()) == ['3', '4']
+    assert sorted(fs3.keys()) == ['3', '4']
+
+    del fs['3']
+    assert removed() == 1
+    assert sorted(fs3.keys()) == ['4']
+
+
+def test_metadata_store_sqlite():
+    _root = 'mds_sqlite'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    mds = MetaDataStore(_root, fs_cls=SQLiteFileSystem)
+    _key = mds.add('statement')
+    assert not os.path.isdir(os.path.join(_root, _key[:2]))
+    assert MetaDataStore(_root, fs_cls=SQLiteFileSystem)[_key] == 'statement'
+    assert mds.keys() == [_key]
+
+
+def test_lazy():
+    _root = 'lazy_dir'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    fs = FileSystem(_root)
+    fs['1'] = 'on'
+    fs['2'] = 'off'
+
+    converted = []
+
+    def conv(value):
+        converted.append(value)
+        return value.upper()
+
+    fs2 = FileSystem(_root, value_conv={'from': conv}, lazy=True)
+    assert sorted(fs2.keys()) == ['1', '2']
+    assert converted == []
+
+    assert fs2['1'] == 'ON'
+    assert fs2['1'] == 'ON'
+    assert converted == ['on']
+
+    # A changed file is converted again
+    sleep(0.01)
+    fs['1'] = 'again'
+    assert fs2['1'] == 'AGAIN'
+    assert dict(fs2.items()) == {'1': 'AGAIN', '2': 'OFF'}
+    assert converted == ['on', 'again', 'off']
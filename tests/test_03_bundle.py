@@ -1,5 +1,17 @@
+import os
+import shutil
+import time
+from urllib.parse import quote_plus
+from urllib.parse import unquote_plus
+
+from fedoidc.bundle import FSJWKSBundle
 from fedoidc.bundle import JWKSBundle
+from fedoidc.bundle import KeyIndex
+from fedoidc.bundle import jwks_to_keyjar
+from fedoidc.bundle import keyjar_version
+from fedoidc.bundle import shallow_copy_keyjar
 
+from oic.utils.keyio import KeyJar
 from oic.utils.keyio import build_keyjar
 
 ISS = 'https://example.com'
@@ -95,3 +107,173 @@ def test_sign_verify():
 
     for iss, kj in bundle.items():
         assert bundle2[iss] == kj
+
+
+def test_as_keyjar_cached():
+    bundle = JWKSBundle(ISS, SIGN_KEYS)
+    bundle['https://www.swamid.se'] = KEYJAR['https://www.swamid.se']
+    bundle['https://www.sunet.se'] = KEYJAR['https://www.sunet.se']
+
+    kj = bundle.as_keyjar()
+    assert set(kj.keys()) == {'https://www.swamid.se', 'https://www.sunet.se'}
+    # Same instance as long as nothing changes
+    assert bundle.as_keyjar() is kj
+
+    bundle['https://www.feide.no'] = KEYJAR['https://www.feide.no']
+    kj2 = bundle.as_keyjar()
+    assert kj2 is not kj
+    assert set(kj2.keys()) == {'https://www.swamid.se', 'https://www.sunet.se',
+                               'https://www.feide.no'}
+
+    del bundle['https://www.sunet.se']
+    assert set(bundle.as_keyjar().keys()) == {'https://www.swamid.se',
+                                              'https://www.feide.no'}
+
+
+def test_shallow_copy_keyjar():
+    bundle = JWKSBundle(ISS, SIGN_KEYS)
+    bundle['https://www.swamid.se'] = KEYJAR['https://www.swamid.se']
+
+    kj = bundle.as_keyjar()
+    _kj = shallow_copy_keyjar(kj)
+    _kj.import_jwks(KEYJAR['https://www.sunet.se'].export_jwks(),
+                    'https://www.swamid.se')
+    _kj.import_jwks(KEYJAR['https://www.sunet.se'].export_jwks(),
+                    'https://www.sunet.se')
+
+    # The original is not affected
+    assert list(kj.keys()) == ['https://www.swamid.se']
+    assert len(kj.issuer_keys['https://www.swamid.se']) == 1
+    assert len(_kj.issuer_keys['https://www.swamid.se']) == 2
+
+
+def test_key_index():
+    bundle = JWKSBundle(ISS, SIGN_KEYS)
+    bundle['https://www.swamid.se'] = KEYJAR['https://www.swamid.se']
+
+    idx = bundle.key_index()
+    assert bundle.key_index() is idx
+
+    for key in KEYJAR['https://www.swamid.se'].get_issuer_keys(''):
+        _alg = 'RS256' if key.kty == 'RSA' else 'ES256'
+        assert idx.get('https://www.swamid.se', _alg, key.kid) is not None
+        # One key of each type so no kid is needed
+        assert idx.get('https://www.swamid.se', _alg).kid == key.kid
+
+    assert idx.get('https://www.swamid.se', 'RS256', 'unknown') is None
+    assert idx.get('https://www.swamid.se', 'none') is None
+    assert idx.get('https://www.sunet.se', 'RS256') is None
+
+    # Keys added to those of the bundle
+    _kj = KeyJar()
+    _kj.import_jwks(KEYJAR['https://www.sunet.se'].export_jwks(),
+                    'https://www.swamid.se')
+    _idx = KeyIndex(_kj, idx)
+    _kid = KEYJAR['https://www.sunet.se'].get_issuer_keys('')[0].kid
+    assert _idx.get('https://www.swamid.se', 'RS256', _kid)
+    # Now there are two RSA keys so which one is not known
+    assert _idx.get('https://www.swamid.se', 'RS256') is None
+    # The original is not affected
+    assert idx.get('https://www.swamid.se', 'RS256', _kid) is None
+    # A copy of a copy falls back on the bundle's index too
+    _copy = KeyIndex(KeyJar(), idx)
+    _copy2 = KeyIndex(shallow_copy_keyjar(_copy.keyjar), _copy)
+    assert _copy2.get('https://www.swamid.se', 'RS256') is \
+           idx.get('https://www.swamid.se', 'RS256')
+    assert _copy._index == {}
+    assert _copy2._index == {}
+
+    # Changes to the bundle are seen
+    bundle['https://www.sunet.se'] = KEYJAR['https://www.sunet.se']
+    assert bundle.key_index() is idx
+    assert idx.get('https://www.sunet.se', 'RS256', _kid)
+    del bundle['https://www.sunet.se']
+    assert idx.get('https://www.sunet.se', 'RS256', _kid) is None
+
+
+def test_keyjar_version():
+    kj = build_keyjar(KEYDEFS)[1]
+    _version = keyjar_version(kj)
+    assert keyjar_version(kj) == _version
+
+    # Rotating keys adds a key bundle
+    build_keyjar(KEYDEFS, keyjar=kj)
+    _version2 = keyjar_version(kj)
+    assert _version2 != _version
+
+    # A key removed from a key bundle
+    kb = kj.issuer_keys[''][0]
+    kb.remove(kb.keys()[0])
+    assert keyjar_version(kj) != _version2
+
+    # Only some of the issuers
+    _own = keyjar_version(kj, issuers=[''])
+    kj.add_symmetric('client', 'secret')
+    assert keyjar_version(kj, issuers=['']) == _own
+    assert keyjar_version(kj) != _own
+
+
+def test_fs_bundle_as_keyjar_converts_changed():
+    _root = 'fs_bundle_03'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    jb = FSJWKSBundle('https://example.com', fdir=_root,
+                      key_conv={'to': quote_plus, 'from': unquote_plus})
+    for iss, kj in KEYJAR.items():
+        jb[iss] = kj
+
+    converted = []
+
+    def conv(jwks):
+        converted.append(jwks)
+        return jwks_to_keyjar(jwks)
+
+    jb = FSJWKSBundle('https://example.com', fdir=_root,
+                      key_conv={'to': quote_plus, 'from': unquote_plus})
+    jb.bundle.value_conv['from'] = conv
+    assert set(jb.keys()) == set(KEYJAR.keys())
+    assert converted == []
+
+    # All of them are needed for the KeyJar
+    jb.as_keyjar()
+    assert len(converted) == len(KEYJAR)
+
+    # Changed on disc by someone else
+    time.sleep(0.01)
+    _fs = FSJWKSBundle('https://example.com', fdir=_root,
+                       key_conv={'to': quote_plus, 'from': unquote_plus})
+    _fs['https://www.swamid.se'] = build_keyjar(KEYDEFS)[1]
+    jb.as_keyjar()
+    assert len(converted) == len(KEYJAR) + 1
+
+
+def test_fs_bundle_key_index_lazy():
+    _root = 'fs_bundle_03'
+    if os.path.isdir(_root):
+        shutil.rmtree(_root)
+
+    jb = FSJWKSBundle('https://example.com', fdir=_root,
+                      key_conv={'to': quote_plus, 'from': unquote_plus})
+    for iss, kj in KEYJAR.items():
+        jb[iss] = kj
+
+    converted = []
+
+    def conv(jwks):
+        converted.append(jwks)
+        return jwks_to_keyjar(jwks)
+
+    jb = FSJWKSBundle('https://example.com', fdir=_root,
+                      key_conv={'to': quote_plus, 'from': unquote_plus})
+    jb.bundle.value_conv['from'] = conv
+
+    # Only the issuer that is looked up is converted
+    _key = KEYJAR['https://www.swamid.se'].get_issuer_keys('')[0]
+    _idx = KeyIndex(KeyJar(), jb.key_index())
+    assert _idx.get('https://www.swamid.se', 'RS256', _key.kid).kid == _key.kid
+    assert len(converted) == 1
+    assert _idx.get('https://www.swamid.se', 'RS256', _key.kid)
+    assert KeyIndex(KeyJar(), jb.key_index()).get(
+        'https://www.swamid.se', 'RS256', _key.kid)
+    assert len(converted) == 1
@@ -7,8 +7,7 @@ from fedoidc.test_utils import make_jwks_bundle
 from oic.utils.keyio import KeyJar
 from oic.utils.keyio import build_keyjar
 
-BASE_PATH = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), "data/keys"))
+BASE_PATH = os.path.abspath("data/keys")
 
 KEYDEFS = [
     {"type": "RSA", "key": '', "use": ["sig"]},
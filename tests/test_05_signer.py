@@ -1,8 +1,26 @@
+import asyncio
+import json
 import os
 import shutil
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
 
+import pytest
 from fedoidc import MetadataStatement
 from fedoidc import test_utils
+from fedoidc import unfurl
+from fedoidc.signing_service import AsyncWebSigningService
+from fedoidc.signing_service import InternalSigningService
+from fedoidc.signing_service import Signer
+from fedoidc.signing_service import WebSigningService
+from jwkest.jws import JWSException
+from jwkest.jws import factory
+
+from oic.utils.keyio import KeyJar
+from oic.utils.keyio import build_keyjar
 
 KEYDEFS = [
     {"type": "RSA", "key": '', "use": ["sig"]},
@@ -60,3 +78,250 @@ def test_create_sms():
     req = MetadataStatement(issuer='https://example.org/op')
     r = s.create_signed_metadata_statement(req, 'discovery')
     assert r
+
+
+def test_sign_many():
+    s = signer[OA['sunet']]
+    reqs = [MetadataStatement(issuer='https://example.org/op{}'.format(i))
+            for i in range(3)]
+    res = s.sign_many(reqs, 'discovery')
+    assert len(res) == 3
+    for i, r in enumerate(res):
+        assert set(r.keys()) == {FO['swamid']}
+        _body = unfurl(r[FO['swamid']])
+        assert _body['issuer'] == 'https://example.org/op{}'.format(i)
+        assert _body['iss'] == OA['sunet']
+        assert list(_body['metadata_statements'].keys()) == [FO['swamid']]
+
+    # The requests are left as they were
+    assert reqs[0].to_dict() == {'issuer': 'https://example.org/op0'}
+
+
+def test_sign_many_single():
+    s = signer[OA['sunet']]
+    reqs = [MetadataStatement(issuer='https://example.org/op{}'.format(i))
+            for i in range(2)]
+    res = s.sign_many(reqs, 'registration', single=True)
+    assert len(res) == 2
+    _body = unfurl(res[1])
+    assert _body['issuer'] == 'https://example.org/op1'
+    assert list(_body['metadata_statements'].keys()) == [FO['swamid']]
+
+
+def test_sign_many_like_create():
+    s = signer[OA['sunet']]
+    req = MetadataStatement(issuer='https://example.org/op')
+
+    # A FO the signer has no statement from
+    for _fos in [['https://unknown.example.org'], []]:
+        _body = unfurl(s.sign_many([req], 'discovery', fos=_fos,
+                                   single=True)[0])
+        assert 'metadata_statements' not in _body
+        _body = unfurl(s.create_signed_metadata_statement(
+            req.copy(), 'discovery', fos=_fos, single=True))
+        assert 'metadata_statements' not in _body
+    with pytest.raises(KeyError):
+        s.sign_many([req], 'discovery', fos=['https://unknown.example.org'])
+    with pytest.raises(KeyError):
+        s.create_signed_metadata_statement(
+            req.copy(), 'discovery', fos=['https://unknown.example.org'])
+    assert s.sign_many([req], 'discovery', fos=[]) == [{}]
+    assert s.create_signed_metadata_statement(req.copy(), 'discovery',
+                                              fos=[]) == {}
+
+    # No superiors so a FO
+    _kj = build_keyjar(KEYDEFS)[1]
+    fo = Signer(InternalSigningService('https://fo.example.org', _kj))
+    res = fo.sign_many([req], 'discovery')
+    assert list(res[0].keys()) == ['https://fo.example.org']
+    assert list(fo.create_signed_metadata_statement(
+        req.copy(), 'discovery').keys()) == ['https://fo.example.org']
+
+
+def test_internal_signing_service_sign_many():
+    _kj = build_keyjar(KEYDEFS)[1]
+    iss = InternalSigningService('https://example.com', _kj,
+                                 add_ons={'federation_usage': 'registration'})
+    reqs = [MetadataStatement(issuer='https://example.org/op{}'.format(i))
+            for i in range(4)]
+    for res in [iss.sign_many(reqs), iss.sign_many(reqs, processes=2)]:
+        assert len(res) == 4
+        for i, sms in enumerate(res):
+            _jws = factory(sms)
+            _body = _jws.verify_compact(sms, _kj.get_signing_key())
+            assert _body['issuer'] == 'https://example.org/op{}'.format(i)
+            assert _body['iss'] == 'https://example.com'
+            assert _body['federation_usage'] == 'registration'
+            assert _body['jti']
+
+
+def test_internal_signing_service_key_rotation():
+    _kj = build_keyjar(KEYDEFS)[1]
+    iss = InternalSigningService('https://example.com', _kj)
+    req = MetadataStatement(issuer='https://example.org/op')
+
+    _kid = factory(iss(req)).jwt.headers['kid']
+    # The prepared key is reused
+    assert factory(iss(req)).jwt.headers['kid'] == _kid
+    assert req.to_dict() == {'issuer': 'https://example.org/op'}
+
+    # Deactivate the old keys and add new ones
+    for key in _kj.get_issuer_keys(''):
+        key.inactive_since = time.time()
+    build_keyjar(KEYDEFS, keyjar=_kj)
+
+    sms = iss(req)
+    assert factory(sms).jwt.headers['kid'] != _kid
+    _body = factory(sms).verify_compact(sms, _kj.get_signing_key())
+    assert _body['issuer'] == 'https://example.org/op'
+
+
+def test_internal_signing_service_large_chain():
+    _kj = build_keyjar(KEYDEFS)[1]
+    iss = InternalSigningService('https://example.com', _kj,
+                                 add_ons={'federation_usage': 'registration'})
+    _keys = [{'kty': 'RSA', 'kid': 'k{}'.format(i), 'e': 'AQAB',
+              'n': str(i) * 300, 'use': 'sig'} for i in range(200)]
+    _sms = dict([('https://fo{}.example.org'.format(i), 'x' * 4000)
+                 for i in range(20)])
+    req = MetadataStatement(signing_keys={'keys': _keys},
+                            metadata_statements=_sms)
+    _ms = req['metadata_statements']
+    _orig = json.dumps(req.to_dict(), sort_keys=True)
+
+    for sms in [iss(req)] + iss.sign_many([req, req]):
+        _body = factory(sms).verify_compact(sms, _kj.get_signing_key())
+        assert _body['iss'] == 'https://example.com'
+        assert _body['federation_usage'] == 'registration'
+        assert _body['metadata_statements'] == _sms
+
+    # The callers instance is left as it was
+    assert set(req.keys()) == {'signing_keys', 'metadata_statements'}
+    assert req['metadata_statements'] is _ms
+    assert json.dumps(req.to_dict(), sort_keys=True) == _orig
+
+
+class SigningHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    signing_service = None
+    clients = set()
+
+    def do_POST(self):
+        self.clients.add(self.client_address)
+        _len = int(self.headers['Content-Length'])
+        req = MetadataStatement(**json.loads(self.rfile.read(_len).decode()))
+        _sms = self.signing_service(req).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/jose')
+        self.send_header('Content-Length', str(len(_sms)))
+        self.end_headers()
+        self.wfile.write(_sms)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_web_signing_service():
+    _kj = build_keyjar(KEYDEFS)[1]
+    _iss = 'https://example.com'
+    SigningHandler.signing_service = InternalSigningService(_iss, _kj)
+
+    srv = HTTPServer(('127.0.0.1', 0), SigningHandler)
+    _thr = threading.Thread(target=srv.serve_forever, daemon=True)
+    _thr.start()
+
+    _pub = KeyJar()
+    _pub.import_jwks(_kj.export_jwks(), _iss)
+    ws = WebSigningService(
+        _iss, 'http://127.0.0.1:{}/sign'.format(srv.server_port), _pub)
+    try:
+        for i in range(3):
+            sms = ws({'issuer': 'https://example.org/op{}'.format(i)})
+            assert unfurl(sms)['issuer'] == 'https://example.org/op{}'.format(i)
+    finally:
+        ws.close()
+        srv.shutdown()
+        srv.server_close()
+
+    # One connection used for all requests
+    assert len(SigningHandler.clients) == 1
+    # verify keys picked once
+    assert ws._verify_keys
+
+
+def test_web_signing_service_verify():
+    _kj = build_keyjar(KEYDEFS)[1]
+    _iss = 'https://example.com'
+    sms = InternalSigningService(_iss, _kj)(
+        MetadataStatement(issuer='https://example.org/op'))
+
+    _pub = KeyJar()
+    _pub.import_jwks(_kj.export_jwks(), _iss)
+    _other = KeyJar()
+    _other.import_jwks(build_keyjar(KEYDEFS)[1].export_jwks(), _iss)
+
+    ws = WebSigningService(_iss, 'https://127.0.0.1/sign', _pub)
+    assert ws.verify(sms)['issuer'] == 'https://example.org/op'
+    ws.close()
+
+    # Signed by someone else
+    ws = WebSigningService(_iss, 'https://127.0.0.1/sign', _other)
+    with pytest.raises(JWSException):
+        ws.verify(sms)
+    ws.close()
+
+    # Or claiming to be
+    ws = WebSigningService('https://example.net', 'https://127.0.0.1/sign',
+                           _pub)
+    with pytest.raises(JWSException):
+        ws.verify(sms)
+    ws.close()
+
+
+class SlowSigningHandler(SigningHandler):
+    requests = []
+
+    def do_POST(self):
+        self.requests.append(self.path)
+        time.sleep(0.2)
+        SigningHandler.do_POST(self)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def test_async_web_signing_service():
+    _kj = build_keyjar(KEYDEFS)[1]
+    _iss = 'https://example.com'
+    SlowSigningHandler.signing_service = InternalSigningService(_iss, _kj)
+
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), SlowSigningHandler)
+    _thr = threading.Thread(target=srv.serve_forever, daemon=True)
+    _thr.start()
+
+    _pub = KeyJar()
+    _pub.import_jwks(_kj.export_jwks(), _iss)
+    ws = AsyncWebSigningService(
+        _iss, 'http://127.0.0.1:{}/sign'.format(srv.server_port), _pub)
+
+    reqs = [{'issuer': 'https://example.org/op', 'scope': ['openid']},
+            {'scope': ['openid'], 'issuer': 'https://example.org/op'},
+            MetadataStatement(issuer='https://example.org/op',
+                              scope=['openid']),
+            {'issuer': 'https://example.org/other'}]
+    loop = asyncio.new_event_loop()
+    try:
+        res = loop.run_until_complete(ws.sign_many_async(reqs))
+    finally:
+        loop.close()
+        ws.close()
+        srv.shutdown()
+        srv.server_close()
+
+    assert len(res) == 4
+    # Identical requests share one response
+    assert res[0] == res[1] == res[2]
+    assert unfurl(res[3])['issuer'] == 'https://example.org/other'
+    assert len(SlowSigningHandler.requests) == 2
+    assert ws._in_flight == {}
@@ -0,0 +1,384 @@
+import shutil
+import time
+from urllib.parse import quote_plus
+from urllib.parse import unquote_plus
+
+import pytest
+from fedoidc import ClientMetadataStatement
+from fedoidc import instrument
+from fedoidc import operator
+from fedoidc.bundle import FSJWKSBundle
+from fedoidc.bundle import JWKSBundle
+from fedoidc.bundle import KeyIndex
+from fedoidc.cache import LRUCache
+from fedoidc.cache import SignedDocumentCache
+from fedoidc.cache import URICache
+from fedoidc.cache import EvaluationCache
+from fedoidc.cache import JWKSCache
+from fedoidc.cache import digest
+from fedoidc.cache import VerifiedStatementCache
+from fedoidc.instrument import HistogramInstrument
+from fedoidc.operator import Operator
+
+from oic.oauth2.message import Message
+from oic.utils.keyio import KeyJar
+from oic.utils.keyio import build_keyjar
+
+KEYDEFS = [
+    {"type": "RSA", "key": '', "use": ["sig"]},
+    {"type": "EC", "crv": "P-256", "use": ["sig"]}
+]
+
+OPERATOR = {}
+
+for entity in ['fo', 'org', 'inter', 'admin']:
+    _keyjar = build_keyjar(KEYDEFS)[1]
+    OPERATOR[entity] = Operator(keyjar=_keyjar,
+                                iss='https://{}.example.org'.format(entity),
+                                lifetime=3600)
+
+FOP = OPERATOR['fo']
+ORGOP = OPERATOR['org']
+INTEROP = OPERATOR['inter']
+
+
+def make_chain():
+    cms_org = ClientMetadataStatement(
+        signing_keys=ORGOP.signing_keys_as_jwks(),
+        contacts=['info@example.com'])
+    ms_org = FOP.pack_metadata_statement(cms_org, scope=['openid'])
+
+    cms_inter = ClientMetadataStatement(
+        signing_keys=INTEROP.signing_keys_as_jwks())
+    ms_inter = ORGOP.pack_metadata_statement(
+        cms_inter, metadata_statements=Message(**{FOP.iss: ms_org}))
+
+    cms_rp = ClientMetadataStatement(
+        signing_keys=OPERATOR['admin'].signing_keys_as_jwks(),
+        redirect_uris=['https://rp.example.com/auth_cb'])
+    ms_rp = INTEROP.pack_metadata_statement(
+        cms_rp, metadata_statements=Message(**{FOP.iss: ms_inter}))
+
+    return ms_inter, ms_rp
+
+
+def receiver():
+    _jb = JWKSBundle('https://sunet.se/op')
+    _jb[FOP.iss] = FOP.signing_keys_as_jwks()
+    return Operator(jwks_bundle=_jb,
+                    statement_cache=VerifiedStatementCache(max_size=10))
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' was least recently used
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_expires():
+    cache = LRUCache()
+    cache.set('a', 1, time.time() - 1)
+    cache.set('b', 2, time.time() + 60)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+def test_verified_statement_cached():
+    ms_inter, ms_rp = make_chain()
+    op = receiver()
+
+    ri = op.unpack_metadata_statement(jwt_ms=ms_rp)
+    assert ri.result
+    _branch = ri.branch[ms_inter]
+    assert len(op.statement_cache) == 2
+
+    ri2 = op.unpack_metadata_statement(jwt_ms=ms_rp)
+    assert ri2.result
+    assert ri2.result.to_dict() == ri.result.to_dict()
+    # The inner statement was not verified again
+    assert ri2.branch[ms_inter] is _branch
+
+
+def test_verified_statement_cache_bundle_change():
+    ms_inter, ms_rp = make_chain()
+    op = receiver()
+
+    ri = op.unpack_metadata_statement(jwt_ms=ms_rp)
+    _branch = ri.branch[ms_inter]
+
+    # Changing the bundle invalidates what's in the cache
+    op.jwks_bundle['https://example.com'] = build_keyjar(KEYDEFS)[1]
+    ri2 = op.unpack_metadata_statement(jwt_ms=ms_rp)
+    assert ri2.result
+    assert ri2.branch[ms_inter] is not _branch
+
+    # After removing the FO nothing verifies
+    del op.jwks_bundle[FOP.iss]
+    ri3 = op.unpack_metadata_statement(jwt_ms=ms_rp)
+    assert ri3.result is None
+
+
+def test_verified_statement_cache_other_keyjar():
+    ms_inter, ms_rp = make_chain()
+    op = receiver()
+    assert op.unpack_metadata_statement(jwt_ms=ms_rp).result
+
+    # Keys given by the caller are not the ones the cached statements were
+    # verified with
+    ri = op.unpack_metadata_statement(jwt_ms=ms_rp, keyjar=KeyJar())
+    assert ri.result is None
+    _foreign = KeyJar()
+    _foreign.import_jwks(ORGOP.signing_keys_as_jwks(), FOP.iss)
+    ri = op.unpack_metadata_statement(jwt_ms=ms_rp, keyjar=_foreign)
+    assert ri.result is None
+
+    # With the right keys it verifies, without using the cache
+    _kj = KeyJar()
+    _kj.import_jwks(FOP.signing_keys_as_jwks(), FOP.iss)
+    ri = op.unpack_metadata_statement(jwt_ms=ms_rp, keyjar=_kj)
+    assert ri.result
+
+
+def test_verified_statement_cache_earliest_exp():
+    cms_org = ClientMetadataStatement(
+        signing_keys=ORGOP.signing_keys_as_jwks())
+    ms_org = FOP.pack_metadata_statement(cms_org, lifetime=60)
+    cms_inter = ClientMetadataStatement(
+        signing_keys=INTEROP.signing_keys_as_jwks())
+    ms_inter = ORGOP.pack_metadata_statement(
+        cms_inter, metadata_statements=Message(**{FOP.iss: ms_org}))
+    ms_rp = INTEROP.pack_metadata_statement(
+        ClientMetadataStatement(contacts=['info@example.com']),
+        metadata_statements=Message(**{FOP.iss: ms_inter}))
+
+    op = receiver()
+    ri = op.unpack_metadata_statement(jwt_ms=ms_rp)
+    assert ri.result
+
+    _pi, _ = op.statement_cache.get(digest(ms_inter))
+    assert _pi.result['exp'] > _pi.result.expires
+    # The entry goes when the innermost statement expires
+    _, _expires = op.statement_cache._db[digest(ms_inter)]
+    assert _expires == _pi.result.expires
+
+
+def test_verified_statement_cache_bundle_synced_once():
+    shutil.rmtree('fs_bundle_08', ignore_errors=True)
+    _jb = FSJWKSBundle('https://sunet.se/op', fdir='fs_bundle_08',
+                       key_conv={'to': quote_plus, 'from': unquote_plus})
+    _jb[FOP.iss] = FOP.signing_keys_as_jwks()
+    op = Operator(jwks_bundle=_jb,
+                  statement_cache=VerifiedStatementCache(max_size=10))
+    ms_inter, ms_rp = make_chain()
+    assert op.unpack_metadata_statement(jwt_ms=ms_rp).result
+
+    _synced = []
+    _sync = _jb.bundle.sync
+
+    def sync():
+        _synced.append(1)
+        _sync()
+
+    _jb.bundle.sync = sync
+    assert op.unpack_metadata_statement(jwt_ms=ms_rp).result
+    assert len(_synced) == 1
+
+
+def test_key_index_built_once(monkeypatch):
+    _built = []
+
+    class CountingKeyIndex(KeyIndex):
+        def __init__(self, keyjar, parent=None):
+            _built.append(1)
+            KeyIndex.__init__(self, keyjar, parent)
+
+    monkeypatch.setattr(operator, 'KeyIndex', CountingKeyIndex)
+    op = receiver()
+    ms_inter, ms_rp = make_chain()
+    assert op.unpack_metadata_statement(jwt_ms=ms_rp).result
+    # Three statements in the chain but only one index
+    assert len(_built) == 1
+
+
+def test_signed_document_cache():
+    built = []
+
+    def build():
+        built.append(1)
+        return len(built), time.time() + 3600
+
+    cache = SignedDocumentCache(refresh_margin=60)
+    assert cache.get('pi', 1, build) == 1
+    assert cache.get('pi', 1, build) == 1
+    # state changed
+    assert cache.get('pi', 2, build) == 2
+
+
+def test_signed_document_cache_refresh():
+    built = []
+
+    def build():
+        built.append(1)
+        return len(built), time.time() + 30
+
+    cache = SignedDocumentCache(refresh_margin=60)
+    assert cache.get('pi', 1, build) == 1
+    # Within the refresh margin, old document returned, new built in the
+    # background
+    assert cache.get('pi', 1, build) == 1
+    for _ in range(50):
+        if not cache._refreshing:
+            break
+        time.sleep(0.1)
+    assert cache.get('pi', 1, build) == 2
+
+
+class Response(object):
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class HTTPClient(object):
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def http_request(self, url, **kwargs):
+        self.requests.append((url, kwargs.get('headers')))
+        return self.responses.pop(0)
+
+
+def test_uri_cache_max_age():
+    cli = HTTPClient([Response(200, 'jws', {'Cache-Control': 'max-age=60'})])
+    cache = URICache()
+    assert cache.fetch(cli, 'https://example.com/ms') == 'jws'
+    assert cache.fetch(cli, 'https://example.com/ms') == 'jws'
+    assert len(cli.requests) == 1
+
+
+def test_uri_cache_conditional():
+    cli = HTTPClient([Response(200, 'jws', {'ETag': '"abc"',
+                                           'Cache-Control': 'no-cache'}),
+                      Response(304)])
+    cache = URICache()
+    assert cache.fetch(cli, 'https://example.com/ms') == 'jws'
+    assert cache.fetch(cli, 'https://example.com/ms') == 'jws'
+    assert cli.requests[1] == ('https://example.com/ms',
+                               {'If-None-Match': '"abc"'})
+
+
+def test_uri_cache_negative():
+    cli = HTTPClient([Response(404), Response(200, 'jws')])
+    cache = URICache(negative_ttl=60)
+    assert cache.fetch(cli, 'https://example.com/ms') is None
+    assert cache.fetch(cli, 'https://example.com/ms') is None
+    assert len(cli.requests) == 1
+
+
+def test_uri_cache_content_addressed():
+    ms_inter, _ = make_chain()
+    url = 'https://example.com/{}'.format(digest(ms_inter))
+    cli = HTTPClient([Response(200, ms_inter,
+                               {'Cache-Control': 'no-cache'})])
+    cache = URICache()
+    assert cache.fetch(cli, url) == ms_inter
+    assert cache.fetch(cli, url) == ms_inter
+    assert len(cli.requests) == 1
+
+    # Content that doesn't match the digest is not trusted to be immutable
+    url = 'https://example.com/{}'.format(digest('foo'))
+    cli = HTTPClient([Response(200, ms_inter, {'Cache-Control': 'no-cache'}),
+                      Response(200, ms_inter, {'Cache-Control': 'no-cache'})])
+    cache.fetch(cli, url)
+    cache.fetch(cli, url)
+    assert len(cli.requests) == 2
+
+
+def test_evaluation_cache():
+    ms_inter, ms_rp = make_chain()
+    op = receiver()
+    ri = op.unpack_metadata_statement(jwt_ms=ms_rp)
+    _expected = op.evaluate_metadata_statement(ri.result)
+
+    op.evaluation_cache = EvaluationCache(max_size=10)
+    les = op.evaluate_metadata_statement(ri.result)
+    # inter and org
+    assert len(op.evaluation_cache) == 2
+    assert [dict(l.items()) for l in les] == [
+        dict(l.items()) for l in _expected]
+    assert [l.fo for l in les] == [l.fo for l in _expected]
+
+    les2 = op.evaluate_metadata_statement(ri.result)
+    assert [dict(l.items()) for l in les2] == [dict(l.items()) for l in les]
+    # Only the outermost level was evaluated again
+    assert les2[0] is not les[0]
+    assert les2[0].sup is les[0].sup
+
+    # Keyed on the signed JWT
+    _inner = ri.result['metadata_statements'][FOP.iss]
+    assert EvaluationCache.key(_inner) == ms_inter
+    assert EvaluationCache.key(_inner.to_dict()) is None
+
+
+def test_evaluation_cache_uri():
+    ms_inter, ms_rp = make_chain()
+    op = receiver()
+    ri = op.unpack_metadata_statement(jwt_ms=ms_rp)
+    _inner = ri.result['metadata_statements'][FOP.iss]
+    assert EvaluationCache.key(_inner) == ms_inter
+
+    # What's published at a metadata_statement_uri may change
+    _inner['metadata_statement_uris'] = Message(
+        **{FOP.iss: 'https://example.com/ms'})
+    assert EvaluationCache.key(_inner) is None
+    _inner2 = Message(metadata_statements=Message(**{FOP.iss: _inner}))
+    _inner2.jwt = 'jwt'
+    assert EvaluationCache.key(_inner2) is None
+
+
+def test_jwks_cache():
+    cache = JWKSCache()
+    _jwks = build_keyjar(KEYDEFS)[0]
+    hist = HistogramInstrument()
+    instrument.set_instrument(hist)
+    try:
+        assert cache.is_valid(_jwks)
+        assert cache.is_valid(_jwks)
+    finally:
+        instrument.set_instrument()
+    assert hist.snapshot()['counters'] == {'operator.jwks_cache.miss': 1,
+                                           'operator.jwks_cache.hit': 1}
+    # Same JWKS, other order of the members
+    _same = {'keys': [dict(reversed(list(k.items()))) for k in _jwks['keys']]}
+    assert JWKSCache.key(_same) == JWKSCache.key(_jwks)
+    assert len(cache) == 1
+
+    # The keys are only imported once
+    kb = cache.key_bundle(_jwks)
+    assert len(kb.keys()) == 2
+    assert cache.key_bundle(_same) is kb
+
+    assert not cache.is_valid({'keys': [{'kty': 'RSA', 'e': 'AQAB'}]})
+    assert not cache.is_valid({'keys': [{'kty': 'XYZ'}]})
+    assert not cache.is_valid({'kid': 'abc'})
+    assert not cache.is_valid(set())
+    # Can't be base64 decoded
+    assert not cache.is_valid({'keys': [{'kty': 'RSA', 'e': 'AQAB',
+                                         'n': 'abcde'}]})
+    assert not cache.is_valid({'keys': [{'kty': 'RSA', 'x5c': ['a-b_']}]})
+    assert not cache.is_valid({'keys': [{'kty': 'RSA', 'x5c': []}]})
+
+    # Passes the check but is not a certificate
+    _x5c = {'keys': [{'kty': 'RSA', 'x5c': ['AAAA']}]}
+    assert cache.is_valid(_x5c)
+    with pytest.raises(ValueError):
+        cache.key_bundle(_x5c)
+    assert not cache.is_valid(_x5c)
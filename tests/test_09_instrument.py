@@ -0,0 +1,55 @@
+import shutil
+
+from fedoidc import instrument
+from fedoidc.file_system import FileSystem
+from fedoidc.instrument import Histogram
+from fedoidc.instrument import HistogramInstrument
+from fedoidc.instrument import Instrument
+
+ROOT = 'instrumented_fs'
+
+
+def test_histogram():
+    hist = Histogram(buckets=(1, 2, 5))
+    for v in [0.5, 1.5, 1.5, 3, 10]:
+        hist.observe(v)
+    assert hist.count == 5
+    assert hist.counts == [1, 2, 1, 1]
+    assert hist.min == 0.5
+    assert hist.max == 10
+    assert hist.percentile(50) == 2
+    assert hist.percentile(99) == 10
+
+
+def test_default_is_noop():
+    assert isinstance(instrument.get_instrument(), Instrument)
+    assert instrument.get_instrument().enabled is False
+
+    @instrument.timed('noop')
+    def func(a, b=1):
+        return a + b
+
+    assert func(1, b=2) == 3
+
+
+def test_histogram_instrument():
+    shutil.rmtree(ROOT, ignore_errors=True)
+    hist = HistogramInstrument()
+    instrument.set_instrument(hist)
+    try:
+        fs = FileSystem(ROOT)
+        fs['foo'] = 'bar'
+        fs.sync()
+        instrument.count('requests')
+        instrument.count('requests', 2)
+    finally:
+        instrument.set_instrument()
+
+    snap = hist.snapshot()
+    assert snap['counters'] == {'requests': 3}
+    assert snap['histograms']['file_system.sync']['count'] == 1
+
+    # Nothing is recorded after the default has been restored
+    fs.sync()
+    assert hist.snapshot()['histograms']['file_system.sync']['count'] == 1
+    shutil.rmtree(ROOT, ignore_errors=True)
@@ -1,25 +1,40 @@
 import json
 import os
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
 from time import time
 
 import pytest
 from fedoidc import ClientMetadataStatement
+from fedoidc import instrument
 from fedoidc import test_utils
+from fedoidc.cache import SignedDocumentCache
 from fedoidc.entity import FederationEntity
 from fedoidc.file_system import FileSystem
+from fedoidc.instrument import HistogramInstrument
+from fedoidc.key_fetcher import KeyFetcher
+from fedoidc.key_fetcher import SignedJWKSCache
 from fedoidc.operator import Operator
+from fedoidc.utils import replace_jwks_key_bundle
 from fedoidc.provider import Provider
 from jwkest import as_unicode
 from jwkest import jws
+from jwkest.jws import JWS
 
 from oic import rndstr
+from oic.oic.message import RegistrationRequest
 from oic.utils.authn.authn_context import AuthnBroker
 from oic.utils.authn.client import verify_client
 from oic.utils.authn.user import UserAuthnMethod
 from oic.utils.authz import AuthzHandling
 from oic.utils.http_util import Created
 from oic.utils.http_util import Response
+from oic.utils.keyio import KeyBundle
+from oic.utils.keyio import KeyJar
 from oic.utils.keyio import build_keyjar
 from oic.utils.sdb import SessionDB
 from oic.utils.sdb import create_session_db
@@ -174,6 +189,42 @@ class TestProvider(object):
         _body = json.loads(as_unicode(_js.jwt.part[1]))
         assert _body['iss'] == self.op.federation_entity.signer.signing_service.iss
 
+    def test_create_fed_provider_info_cached(self):
+        self.op.pi_cache = SignedDocumentCache()
+        fedpi = self.op.create_fed_providerinfo()
+        _sms = fedpi['metadata_statements']
+        _fedpi = self.op.create_fed_providerinfo()
+        # A copy of the same document
+        assert _fedpi is not fedpi
+        assert _fedpi['metadata_statements'] is _sms
+
+        # Changing the copy does not change what's cached
+        _fedpi['issuer'] = 'https://example.com/other'
+        assert self.op.create_fed_providerinfo()['issuer'] == fedpi['issuer']
+
+        # Different arguments different document
+        assert self.op.create_fed_providerinfo(
+            pi_args={'op_policy_uri': 'https://example.com/p'})[
+                   'metadata_statements'] is not _sms
+
+        # New signing keys means a new document
+        _fe = self.op.federation_entity
+        build_keyjar(KEYDEFS, keyjar=_fe.keyjar)
+        _sms2 = self.op.create_fed_providerinfo()['metadata_statements']
+        assert _sms2 is not _sms
+        assert self.op.create_fed_providerinfo()[
+                   'metadata_statements'] is _sms2
+
+        # Registering clients adds keys to the OP's KeyJar but not to the
+        # ones the document depends on
+        _resp = self.op.client_registration_setup(
+            RegistrationRequest(redirect_uris=['https://example.com/rp']))
+        assert _resp['client_id'] in self.op.keyjar.issuer_keys
+        replace_jwks_key_bundle(self.op.keyjar, _resp['client_id'],
+                                KeyBundle(build_keyjar(KEYDEFS)[0]['keys']))
+        assert self.op.create_fed_providerinfo()[
+                   'metadata_statements'] is _sms2
+
     def test_provider_endpoint(self):
         pi_resp = self.op.providerinfo_endpoint()
 
@@ -208,3 +259,201 @@ class TestProvider(object):
 
         clresp = json.loads(resp.message)
         assert list(clresp['metadata_statements'].keys()) == [FO['swamid']]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class JWKSHandler(BaseHTTPRequestHandler):
+    jwks = ''
+    release = None
+
+    def do_GET(self):
+        self.release.wait(10)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.jwks)))
+        self.end_headers()
+        self.wfile.write(self.jwks.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_key_fetcher():
+    _kj = build_keyjar(KEYDEFS)[1]
+    JWKSHandler.jwks = json.dumps(_kj.export_jwks())
+    JWKSHandler.release = threading.Event()
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), JWKSHandler)
+    _thr = threading.Thread(target=srv.serve_forever, daemon=True)
+    _thr.start()
+    _url = 'http://127.0.0.1:{}/jwks'.format(srv.server_port)
+
+    fetcher = KeyFetcher(max_workers=2, timeout=0.5)
+    try:
+        # Returns while the remote source is still thinking
+        _start = time()
+        kb = fetcher.key_bundle(_url)
+        assert time() - _start < 0.5
+        assert kb.pending()
+
+        # Gives up waiting after the timeout
+        assert kb.keys() == []
+
+        JWKSHandler.release.set()
+        kb = fetcher.key_bundle(_url, timeout=5)
+        assert len(kb.keys()) == len(KEYDEFS)
+        assert not kb.pending()
+    finally:
+        JWKSHandler.release.set()
+        fetcher.shutdown()
+        srv.shutdown()
+
+
+class RefreshHandler(BaseHTTPRequestHandler):
+    jwks = ''
+    status = 200
+    max_age = 0
+    hits = 0
+    release = None
+
+    def do_GET(self):
+        RefreshHandler.hits += 1
+        self.release.wait(10)
+        self.send_response(self.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'max-age={}'.format(self.max_age))
+        self.send_header('Content-Length', str(len(self.jwks)))
+        self.end_headers()
+        self.wfile.write(self.jwks.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_key_fetcher_refresh():
+    _kj = build_keyjar(KEYDEFS)[1]
+    RefreshHandler.jwks = json.dumps(_kj.export_jwks())
+    RefreshHandler.release = threading.Event()
+    RefreshHandler.release.set()
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), RefreshHandler)
+    _thr = threading.Thread(target=srv.serve_forever, daemon=True)
+    _thr.start()
+    _url = 'http://127.0.0.1:{}/jwks'.format(srv.server_port)
+
+    fetcher = KeyFetcher(timeout=5)
+    try:
+        kb = fetcher.key_bundle(_url, retry_after=60)
+        _keys = kb.keys()
+        assert len(_keys) == len(KEYDEFS)
+
+        # Expired, the old keys are used while new ones are fetched
+        RefreshHandler.release.clear()
+        RefreshHandler.jwks = json.dumps(
+            build_keyjar(KEYDEFS)[1].export_jwks())
+        RefreshHandler.max_age = 600
+        _start = time()
+        assert kb.keys() == _keys
+        assert time() - _start < 1
+        assert kb.pending()
+        RefreshHandler.release.set()
+        assert kb.wait()
+        assert kb.keys() != _keys
+        _keys = kb.keys()
+
+        # A failed fetch keeps the old keys and is not retried at once
+        RefreshHandler.status = 500
+        _hits = RefreshHandler.hits
+        kb.time_out = 0
+        assert kb.keys() == _keys
+        assert kb.wait() is False
+        assert kb.time_out > time() + 30
+        assert kb.keys() == _keys
+        assert RefreshHandler.hits == _hits + 1
+    finally:
+        RefreshHandler.release.set()
+        fetcher.shutdown()
+        srv.shutdown()
+
+
+class SignedJWKSHandler(BaseHTTPRequestHandler):
+    signed_jwks = ''
+    hits = 0
+
+    def do_GET(self):
+        SignedJWKSHandler.hits += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/jose')
+        self.send_header('Cache-Control', 'max-age=600')
+        self.send_header('Content-Length', str(len(self.signed_jwks)))
+        self.end_headers()
+        self.wfile.write(self.signed_jwks.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_signed_jwks_cache():
+    _sign_kj = build_keyjar(KEYDEFS)[1]
+    _kj = build_keyjar(KEYDEFS)[1]
+    _exp = int(time()) + 300
+    _payload = _kj.export_jwks()
+    _payload['exp'] = _exp
+    SignedJWKSHandler.signed_jwks = JWS(json.dumps(_payload),
+                                        alg='RS256').sign_compact(
+        _sign_kj.get_signing_key('RSA'))
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), SignedJWKSHandler)
+    _thr = threading.Thread(target=srv.serve_forever, daemon=True)
+    _thr.start()
+    _url = 'http://127.0.0.1:{}/signed_jwks'.format(srv.server_port)
+
+    _signing_keys = _sign_kj.export_jwks()
+    _cache = SignedJWKSCache(timeout=5)
+    hist = HistogramInstrument()
+    instrument.set_instrument(hist)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            kbs = list(executor.map(
+                lambda _: _cache.key_bundle(_url, _signing_keys),
+                range(16)))
+        assert SignedJWKSHandler.hits == 1
+        assert hist.snapshot()['counters'] == {
+            'provider.signed_jwks_cache.miss': 1,
+            'provider.signed_jwks_cache.hit': 15}
+        _kb = kbs[0]
+        assert all(kb is _kb for kb in kbs)
+        assert len(_kb.keys()) == len(KEYDEFS)
+        # The exp in the signed JWKS comes before max-age
+        assert _kb.time_out == _exp
+
+        # Shared by the clients
+        keyjar = KeyJar()
+        for client_id in ['client1', 'client2']:
+            replace_jwks_key_bundle(keyjar, client_id, _kb)
+        assert keyjar.issuer_keys['client1'][0] is \
+               keyjar.issuer_keys['client2'][0]
+
+        # Other verification keys, other bundle
+        _other = build_keyjar(KEYDEFS)[1].export_jwks()
+        assert _cache.key(_url, _other) != _cache.key(_url, _signing_keys)
+        # The same keys in a KeyJar, same bundle
+        assert _cache.key(_url, _sign_kj) == _cache.key(_url, _signing_keys)
+        # Other arguments, other bundle
+        _kb2 = _cache.key_bundle(_url, _signing_keys, verify_ssl=False)
+        assert _kb2 is not _kb
+        assert _kb2.verify_ssl is False
+        assert _cache.key_bundle(_url, _signing_keys, verify_ssl=False) is _kb2
+    finally:
+        instrument.set_instrument()
+        srv.shutdown()
+
+
+def test_provider_key_fetcher_and_jwks_cache():
+    _fetcher = KeyFetcher(max_workers=1)
+    try:
+        with pytest.raises(ValueError):
+            Provider('op', None, {}, None, None, None, None, '',
+                     key_fetcher=_fetcher, jwks_cache=SignedJWKSCache())
+    finally:
+        _fetcher.shutdown()